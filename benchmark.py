@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the Multi-AI Research Bot.
+Runs against fake Discord channels - no bot token, API keys or network needed.
+
+Usage:
+    python benchmark.py pipeline
+    python benchmark.py commands --users 20 --queries 5
+    python benchmark.py chunker --chunker-mb 8
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+
+def write_bench_config() -> str:
+    """Throwaway config.json with every channel configured; returns its path"""
+    channel_names = ["general", "research", "build", "findings", "archive", "testcase", "completed", "task"]
+    bench_config = {
+        "discord": {"channels": {name: 1000 + i for i, name in enumerate(channel_names)}},
+    }
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(bench_config, config_file)
+    config_file.close()
+    return config_file.name
+
+
+def load_bot():
+    """Import main.py with a throwaway config (importing has no side effects - no token needed)"""
+    os.environ["RESEARCHBOT_CONFIG"] = write_bench_config()
+    
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    
+    # Keep benchmark state out of the real databases and routing log
+    data_dir = tempfile.mkdtemp(prefix="researchbot-bench-")
+    main.Memory.MEMORY_DB = os.path.join(data_dir, "memory.db")
+    main.Memory.LEGACY_FILE = os.path.join(data_dir, "memory.json")
+    main.ResponseCache.CACHE_DB = os.path.join(data_dir, "response_cache.db")
+    main.RouteClassifier.LOG_FILE = os.path.join(data_dir, "routing_log.jsonl")
+    main.PromptIndex.INDEX_DB = os.path.join(data_dir, "prompt_index.db")
+    main.TaskStore.TASK_DB = os.path.join(data_dir, "tasks.db")
+    main.UsageLedger.USAGE_DB = os.path.join(data_dir, "usage.db")
+    return main
+
+
+# ============================================================
+# FAKE DISCORD
+# ============================================================
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False):
+        self.name = name
+        self.bot = bot
+
+
+BOT_USER = FakeUser("ResearchBot", bot=True)
+
+
+class FakeMessage:
+    _next_id = 1
+    
+    def __init__(self, channel, content: str, author: FakeUser = BOT_USER):
+        self.id = FakeMessage._next_id
+        FakeMessage._next_id += 1
+        self.channel = channel
+        self.content = content
+        self.author = author
+        self.created_at = datetime.now(timezone.utc)
+        self.attachments = []
+    
+    async def edit(self, content: str):
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+    
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+
+
+class FakeChannel:
+    """Discord channel with a fixed round-trip latency and a per-channel rate limit.
+    
+    Like discord.py, a send that would exceed the limit waits out the 429 before succeeding.
+    """
+    
+    def __init__(self, channel_id: int, name: str, latency: float = 0.05,
+                 rate_limit: int = 5, rate_window: float = 5.0):
+        self.id = channel_id
+        self.name = name
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.messages: list[FakeMessage] = []
+        self.sent_at: list[float] = []
+        self.rate_limited = 0
+        # Called with every sent message, like the gateway echoing it back to on_message
+        self.on_send = None
+    
+    async def send(self, content: str) -> FakeMessage:
+        assert 0 < len(content) <= 2000, f"invalid message length {len(content)}"
+        now = time.monotonic()
+        recent = [t for t in self.sent_at if now - t < self.rate_window]
+        if len(recent) >= self.rate_limit:
+            self.rate_limited += 1
+            await asyncio.sleep(self.rate_window - (now - recent[0]))
+        self.sent_at.append(time.monotonic())
+        
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self, content)
+        self.messages.append(message)
+        if self.on_send:
+            self.on_send(message)
+        return message
+    
+    async def history(self, limit: int = 100):
+        """Newest first, like discord.py"""
+        await asyncio.sleep(self.latency)
+        for message in reversed(self.messages[-limit:]):
+            yield message
+    
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        raise LookupError(message_id)
+
+
+class FakeContext:
+    """Just enough of commands.Context for the command handlers"""
+    
+    def __init__(self, command, channel: FakeChannel, author: FakeUser):
+        self.command = command
+        self.channel = channel
+        self.author = author
+        self.message = FakeMessage(channel, "", author)
+    
+    async def send(self, content: str) -> FakeMessage:
+        return await self.channel.send(content)
+    
+    def typing(self):
+        return contextlib.AsyncExitStack()
+
+
+# ============================================================
+# FAKE LLM PROVIDERS
+# ============================================================
+
+class FakeProviderError(Exception):
+    """Stands in for an SDK's 503 (transient, so failover retries it)"""
+    status_code = 503
+
+
+def install_fake_providers(main, args):
+    """Replace the Anthropic/OpenAI/Gemini providers with fakes that simulate latency, streaming, prompt caching and errors"""
+    rng = random.Random(args.seed)
+    
+    class FakeProvider(main.LLMProvider):
+        def __init__(self, name: str, label: str):
+            super().__init__(api_key="benchmark")
+            self.name = name
+            self.label = label
+            self.seen_prefixes: set[int] = set()
+            self.routes = 0
+        
+        def _create_client(self):
+            return None
+        
+        def _respond(self, model, prompt, system, max_tokens) -> tuple:
+            if "routing AI" in prompt:
+                self.routes += 1
+                text = "RESEARCH" if self.routes % 2 else "BUILD"
+            else:
+                text = (f"[{self.name}/{model}] " + "The evidence supports the hypothesis under the stated assumptions. " * 60)
+                text = text[:args.response_chars]
+            
+            result = main.LLMResult(text="", provider=self.name, model=model)
+            result.input_tokens = (len(prompt) + len(system or "")) // 4
+            result.output_tokens = len(text) // 4
+            if system:
+                # Simulate a provider prompt cache keyed by the system prefix
+                prefix = hash(system)
+                if prefix in self.seen_prefixes:
+                    result.cache_read_tokens = len(system) // 4
+                else:
+                    result.cache_write_tokens = len(system) // 4
+                    self.seen_prefixes.add(prefix)
+            return text, result
+        
+        async def _fail_sometimes(self):
+            if rng.random() < args.llm_error_rate:
+                await asyncio.sleep(args.llm_ttft)
+                raise FakeProviderError(f"{self.name} unavailable")
+        
+        async def _complete(self, model, prompt, system, max_tokens):
+            text, result = self._respond(model, prompt, system, max_tokens)
+            await self._fail_sometimes()
+            await asyncio.sleep(args.llm_ttft + result.output_tokens / args.llm_tokens_per_second)
+            result.text = text
+            return result
+        
+        async def _stream(self, model, prompt, system, max_tokens, result):
+            text, final = self._respond(model, prompt, system, max_tokens)
+            await self._fail_sometimes()
+            await asyncio.sleep(args.llm_ttft)
+            piece = 80
+            for i in range(0, len(text), piece):
+                await asyncio.sleep(piece / 4 / args.llm_tokens_per_second)
+                yield text[i:i + piece]
+            result.input_tokens = final.input_tokens
+            result.output_tokens = final.output_tokens
+            result.cache_read_tokens = final.cache_read_tokens
+            result.cache_write_tokens = final.cache_write_tokens
+    
+    for name, provider in list(main.providers.items()):
+        main.providers[name] = FakeProvider(provider.name, provider.label)
+
+
+# ============================================================
+# BENCHMARKS
+# ============================================================
+
+def consensus_sections(response_chars: int) -> list[tuple]:
+    """The header/response layout !consensus posts to each channel"""
+    paragraph = "The evidence supports the hypothesis only under the stated assumptions. " * 6
+    response = "\n\n".join([paragraph] * (response_chars // len(paragraph) + 1))[:response_chars]
+    return [
+        ("**🗳️ Consensus Query:** *benchmark question...*", None),
+        ("**🔵 Claude:**", response),
+        ("**🟢 GPT-4:**", response),
+        ("**🟡 Gemini:**", response),
+    ]
+
+
+async def bench_pipeline(main, args):
+    """Serial send loop (old behaviour) vs MessagePipeline for a burst of !consensus posts"""
+    window = args.rate_window
+    
+    def channels():
+        return [FakeChannel(1, "findings", args.latency, 5, window), FakeChannel(2, "general", args.latency, 5, window)]
+    
+    sections = consensus_sections(args.response_chars)
+    
+    # Old behaviour: every header and chunk is its own awaited send, one channel after the other
+    serial = channels()
+    started = time.perf_counter()
+    for _ in range(args.queries):
+        for channel in serial:
+            for header, text in sections:
+                if header:
+                    await channel.send(header)
+                for chunk in main.split_message(text or ""):
+                    if chunk.strip():
+                        await channel.send(chunk)
+    serial_time = time.perf_counter() - started
+    
+    # Pipeline: ordered per-channel queues, header coalescing, local pacing, channels in parallel
+    piped = channels()
+    pipeline = main.MessagePipeline(burst=5, window=window)
+    started = time.perf_counter()
+    for _ in range(args.queries):
+        await asyncio.gather(*(pipeline.post_many(channel, sections) for channel in piped))
+    pipeline_time = time.perf_counter() - started
+    
+    for label, chans, elapsed in (("serial loop", serial, serial_time), ("MessagePipeline", piped, pipeline_time)):
+        sent = sum(len(c.messages) for c in chans)
+        limited = sum(c.rate_limited for c in chans)
+        print(f"  {label:<16} {elapsed:7.2f}s  {sent:4d} messages  {sent / elapsed:7.1f} msg/s  {limited:3d} rate-limit hits")
+
+
+QUESTIONS = [
+    "why does the effect disappear when we control for the confounder",
+    "implement a python function that loads the csv and drops duplicates",
+    "analyze the assumptions behind this hypothesis",
+    "debug this traceback from the data loader",
+    "what does the literature say about sample size here",
+    "refactor the pipeline module so the api is testable",
+]
+
+# (command, weight) - roughly how the bot is used
+COMMAND_MIX = [
+    ("ask", 4),
+    ("auto", 3),
+    ("code", 2),
+    ("deep", 1),
+    ("build", 1),
+    ("crosscheck", 1),
+    ("consensus", 1),
+    ("task", 2),
+]
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def bench_commands(main, args):
+    """Drive the real command handlers with N concurrent users against fake Discord and fake providers"""
+    install_fake_providers(main, args)
+    
+    channels = {}
+    for name, channel_id in main.config["discord"]["channels"].items():
+        channel = FakeChannel(channel_id, name, args.latency, 5, args.rate_window)
+        channel.on_send = main.ChannelHistory.record
+        channels[channel_id] = channel
+    main.bot.get_channel = channels.get
+    # Pace the real outbox to the fake channels' rate-limit window
+    main.outbox = main.MessagePipeline(window=args.rate_window)
+    general = channels[main.GENERAL_CHANNEL_ID]
+    
+    commands_, weights = zip(*COMMAND_MIX)
+    rng = random.Random(args.seed)
+    latencies: dict[str, list[float]] = {name: [] for name in commands_}
+    errors: dict[str, int] = {}
+    
+    async def user(index: int):
+        author = FakeUser(f"user{index}")
+        for n in range(args.queries):
+            name = rng.choices(commands_, weights)[0]
+            command = main.bot.get_command(name)
+            ctx = FakeContext(command, general, author)
+            if rng.random() < args.duplicate_rate:
+                text = rng.choice(QUESTIONS)  # the same question another user may be asking right now
+            else:
+                text = f"{rng.choice(QUESTIONS)} (user {index}, query {n})"
+            kwargs = {"description": text} if name == "task" else {"query": text}
+            
+            started = time.perf_counter()
+            await main.set_request_context(ctx)
+            if not args.cache:
+                main.current_request.get()["no_cache"] = True
+            try:
+                await command.callback(ctx, **kwargs)
+            except Exception as e:
+                errors[f"{name}: {type(e).__name__}"] = errors.get(f"{name}: {type(e).__name__}", 0) + 1
+            else:
+                await main.record_command_time(ctx)
+            latencies[name].append(time.perf_counter() - started)
+    
+    tracemalloc.start()
+    log = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        await asyncio.gather(*(user(i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    everything = [value for samples in latencies.values() for value in samples]
+    sent = sum(len(c.messages) for c in channels.values())
+    limited = sum(c.rate_limited for c in channels.values())
+    
+    print(f"  {args.users} users x {args.queries} commands = {len(everything)} commands in {elapsed:.2f}s "
+          f"({len(everything) / elapsed:.1f} cmd/s)")
+    print(f"  latency p50 {percentile(everything, 0.5):.2f}s  p95 {percentile(everything, 0.95):.2f}s  "
+          f"p99 {percentile(everything, 0.99):.2f}s  max {max(everything):.2f}s")
+    print(f"  peak traced memory {peak / 1024 / 1024:.1f} MiB")
+    print(f"  Discord: {sent} messages, {limited} rate-limit hits")
+    print()
+    print(f"  {'command':<12} {'n':>4} {'p50':>7} {'p95':>7} {'p99':>7}")
+    for name, samples in latencies.items():
+        if samples:
+            print(f"  {name:<12} {len(samples):4d} {percentile(samples, 0.5):6.2f}s {percentile(samples, 0.95):6.2f}s "
+                  f"{percentile(samples, 0.99):6.2f}s")
+    
+    failovers = sum(main.Metrics.counters.get("failovers_total", {}).values())
+    if failovers:
+        print(f"  failovers: {failovers:.0f}")
+    coalesced = sum(main.Metrics.counters.get("coalesced_requests_total", {}).values())
+    if args.duplicate_rate or args.cache:
+        print(f"  coalesced: {coalesced:.0f}  response cache: {main.ResponseCache.hits} hits, "
+              f"{main.ResponseCache.near_hits} near, {main.ResponseCache.misses} misses")
+    for name in ("context_assembly_seconds", "queue_wait_seconds", "discord_send_seconds"):
+        histogram = main.Metrics.merged(name)
+        if histogram and histogram.count:
+            print(f"  {name:<28} p50 {histogram.percentile(0.5) * 1000:8.1f} ms  p95 {histogram.percentile(0.95) * 1000:8.1f} ms")
+    
+    if errors:
+        print("\n  Errors:")
+        for key, count in sorted(errors.items()):
+            print(f"    {key}: {count}")
+
+
+def legacy_split_message(text: str, limit: int = 1900) -> list[str]:
+    """The line-by-line split_message that MessageChunker replaced (kept for comparison)"""
+    if len(text) <= limit:
+        return [text]
+    
+    chunks = []
+    current_chunk = ""
+    code_block_open = False
+    language = ""
+    
+    for line in text.split('\n'):
+        if line.strip().startswith('```'):
+            if code_block_open:
+                code_block_open = False
+                language = ""
+            else:
+                code_block_open = True
+                language = line.strip()[3:]
+        
+        if len(current_chunk) + len(line) + 1 > limit:
+            if current_chunk:
+                if code_block_open:
+                    current_chunk += "```"
+                chunks.append(current_chunk)
+                current_chunk = ""
+                if code_block_open:
+                    current_chunk += f"```{language}\n"
+            
+            while len(line) > limit - len(current_chunk):
+                space_left = limit - len(current_chunk)
+                part = line[:space_left]
+                line = line[space_left:]
+                current_chunk += part
+                if code_block_open:
+                    current_chunk += "```"
+                chunks.append(current_chunk)
+                current_chunk = ""
+                if code_block_open:
+                    current_chunk += f"```{language}\n"
+            
+            current_chunk += line + "\n"
+        else:
+            current_chunk += line + "\n"
+    
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
+def chunker_input(size: int, seed: int) -> str:
+    """Prose paragraphs, fenced code blocks and the odd very long line (e.g. minified data)"""
+    rng = random.Random(seed)
+    sentence = "The result holds only under the stated assumptions, so we test them first. "
+    code = "\n".join(f"    value_{i} = compute(frame, window={i})  # step {i}" for i in range(60))
+    blocks = []
+    total = 0
+    while total < size:
+        roll = rng.random()
+        if roll < 0.2:
+            block = f"```python\n{code}\n```\n\n"
+        elif roll < 0.25:
+            block = "x" * rng.randint(3000, 12000) + "\n\n"
+        else:
+            block = sentence * rng.randint(1, 20) + "\n\n"
+        blocks.append(block)
+        total += len(block)
+    return "".join(blocks)
+
+
+async def bench_chunker(main, args):
+    """split_message throughput on multi-megabyte input: old line loop vs MessageChunker (whole and streamed)"""
+    text = chunker_input(int(args.chunker_mb * 1024 * 1024), args.seed)
+    mb = len(text) / 1024 / 1024
+    fragments = [text[i:i + 64] for i in range(0, len(text), 64)]
+    
+    def legacy_stream():
+        # Old StreamingReply: re-split everything received so far on every flush (here every 16 KB)
+        received = ""
+        for i, fragment in enumerate(fragments):
+            received += fragment
+            if i % 256 == 0:
+                legacy_split_message(received)
+        return legacy_split_message(received)
+    
+    runs = [
+        ("legacy split", lambda: legacy_split_message(text)),
+        ("legacy stream", legacy_stream),
+        ("split_message", lambda: main.split_message(text)),
+        ("chunker, 64B feeds", lambda: list(main.iter_chunks(fragments))),
+    ]
+    for label, run in runs:
+        started = time.perf_counter()
+        chunks = run()
+        elapsed = time.perf_counter() - started
+        over = sum(1 for chunk in chunks if len(chunk) > main.DISCORD_MESSAGE_LIMIT)
+        print(f"  {label:<20} {elapsed * 1000:8.1f} ms  {mb / elapsed:7.1f} MB/s  {len(chunks):5d} chunks"
+              + (f"  {over} over the limit" if over else ""))
+
+
+LAZY_MODULES = ("anthropic", "openai", "google.genai", "tiktoken")
+
+STARTUP_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.create_app()
+total = time.perf_counter() - started
+# Checked in this (timed) interpreter - the SDKs should not be loaded until first use
+loaded = ",".join(module for module in %r if module in sys.modules) or "-"
+print(imported - started, total, main.STARTUP_BUDGET_SECONDS, loaded)
+""" % (LAZY_MODULES,)
+
+
+async def bench_startup(main, args):
+    """Cold import + create_app() time in fresh interpreters, against the configured startup budget"""
+    env = {**os.environ, "RESEARCHBOT_CONFIG": write_bench_config(), "DISCORD_BOT_TOKEN": "benchmark"}
+    here = os.path.dirname(os.path.abspath(__file__))
+    
+    imports, totals, budget = [], [], 0.0
+    loaded: set[str] = set()
+    for _ in range(args.queries):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", STARTUP_SCRIPT, cwd=here, env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            print(stderr.decode(errors="replace"))
+            return
+        *timings, modules = stdout.decode().split()[-4:]
+        imported, total, budget = (float(value) for value in timings)
+        imports.append(imported)
+        totals.append(total)
+        loaded.update(module for module in modules.split(",") if module != "-")
+    
+    print(f"  {len(totals)} cold starts: import p50 {percentile(imports, 0.5):.2f}s  "
+          f"create_app p50 {percentile(totals, 0.5):.2f}s  max {max(totals):.2f}s  (budget {budget:.1f}s)")
+    for module in LAZY_MODULES:
+        print(f"  {module:<12} imported at startup: {'yes' if module in loaded else 'no'}")
+
+
+BENCHMARKS = {
+    "pipeline": bench_pipeline,
+    "commands": bench_commands,
+    "startup": bench_startup,
+    "chunker": bench_chunker,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Research Bot")
+    parser.add_argument("suite", choices=sorted(BENCHMARKS), help="benchmark to run")
+    parser.add_argument("--queries", type=int, default=3, help="number of commands to simulate")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Discord round trip (s)")
+    parser.add_argument("--rate-window", type=float, default=0.5,
+                        help="window for the 5-message per-channel limit (Discord: 5.0s; shorter runs faster)")
+    parser.add_argument("--response-chars", type=int, default=4000, help="length of each fake AI response")
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users (commands suite)")
+    parser.add_argument("--llm-ttft", type=float, default=0.3, help="fake provider time to first token (s)")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=2000.0,
+                        help="fake provider generation speed (the default keeps runs short)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0,
+                        help="fraction of fake provider calls that fail with a 503 (exercises failover)")
+    parser.add_argument("--cache", action="store_true", help="allow response cache hits (off by default)")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0,
+                        help="fraction of commands that repeat a shared question (commands suite)")
+    parser.add_argument("--chunker-mb", type=float, default=4.0, help="input size for the chunker suite (MB)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the command mix")
+    args = parser.parse_args()
+    
+    bot = load_bot()
+    print(f"Running '{args.suite}' benchmark...")
+    asyncio.run(BENCHMARKS[args.suite](bot, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,54 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # the startup budget is measured from here
+
 import discord
 from discord.ext import commands
-import anthropic
-from openai import OpenAI
-from google import genai
+from dotenv import load_dotenv
+
+# Provider SDKs (anthropic, openai, google-genai) and tiktoken are imported on first use
 import os
 import json
 import sys
+import sqlite3
 from typing import Optional
+from dataclasses import dataclass
+from collections import OrderedDict, deque
 import asyncio
 import aiohttp
+from aiohttp import web
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
+import math
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import threading
 import json
 
-# Load environment variables from .env file
-load_dotenv()
-
 # ============================================================
 # CONFIGURATION LOADING
 # ============================================================
 
-def load_config():
-    """Load configuration from config.json. Exit if not found."""
-    config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-    
-    if not os.path.exists(config_path):
-        print("=" * 60)
-        print("  ❌ Configuration Not Found!")
-        print("=" * 60)
-        print()
-        print("  config.json not found. Please run setup first:")
-        print("    python setup.py")
-        print()
-        print("  Or copy config.example.json to config.json and edit it.")
-        print("=" * 60)
-        sys.exit(1)
+CONFIG_PATH = os.getenv("RESEARCHBOT_CONFIG") or os.path.join(os.path.dirname(__file__), 'config.json')
+
+
+def load_config() -> dict:
+    """Load configuration from config.json (or $RESEARCHBOT_CONFIG). Empty if not found - create_app() reports it."""
+    if not os.path.exists(CONFIG_PATH):
+        return {}
     
-    with open(config_path, 'r') as f:
+    with open(CONFIG_PATH, 'r') as f:
         return json.load(f)
 
-# Load configuration
+# Load configuration (importing main.py never exits or touches the network - see create_app)
 config = load_config()
 
-# API Keys from environment
-DISCORD_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Validate Discord token
-if not DISCORD_TOKEN:
-    print("❌ DISCORD_BOT_TOKEN not found in .env file!")
-    print("   Run 'python setup.py' or add it to your .env file.")
-    sys.exit(1)
-
 # Channel IDs from config.json
 channels = config.get("discord", {}).get("channels", {})
 GENERAL_CHANNEL_ID = channels.get("general")
@@ -67,13 +63,8 @@ TASK_CHANNEL_ID = channels.get("task")
 # Primary coordination channel
 COORD_CHANNEL_ID = GENERAL_CHANNEL_ID
 
-# Validate required channels
-required_channels = ["general", "research", "build", "findings", "task", "completed"]
-missing_channels = [ch for ch in required_channels if not channels.get(ch)]
-if missing_channels:
-    print(f"❌ Missing channel IDs in config.json: {', '.join(missing_channels)}")
-    print("   Run 'python setup.py' to configure channels.")
-    sys.exit(1)
+# Channels that must be configured before the bot can start
+REQUIRED_CHANNELS = ["general", "research", "build", "findings", "task", "completed"]
 
 # AI Model configuration (optional - uses defaults if not specified)
 ai_models = config.get("ai_models", {})
@@ -83,113 +74,2187 @@ GENERAL_MODEL = ai_models.get("general", "gpt-4")
 CODE_MODEL = ai_models.get("code", "gemini-3-flash-preview")
 ROUTER_MODEL = ai_models.get("router", "gemini-3-flash-preview")
 
+# Streaming replies (optional - progressive message edits for long answers)
+streaming = config.get("streaming", {})
+STREAMING_ENABLED = streaming.get("enabled", True)
+STREAM_EDIT_INTERVAL = streaming.get("edit_interval", 1.0)  # seconds between message edits
+
+# Metrics (optional - Prometheus-style endpoint on localhost)
+metrics_config = config.get("metrics", {})
+METRICS_ENABLED = metrics_config.get("enabled", True)
+METRICS_HOST = metrics_config.get("host", "127.0.0.1")
+METRICS_PORT = metrics_config.get("port", 9108)
+
+# Request scheduling (optional - per-provider concurrency and rate limits)
+scheduler_config = config.get("scheduler", {})
+DEFAULT_PROVIDER_LIMITS = {
+    "claude": {"max_concurrent": 4, "requests_per_minute": 50, "tokens_per_minute": 40000, "max_queue": 20},
+    "openai": {"max_concurrent": 4, "requests_per_minute": 60, "tokens_per_minute": 40000, "max_queue": 20},
+    "gemini": {"max_concurrent": 4, "requests_per_minute": 15, "tokens_per_minute": 250000, "max_queue": 20},
+}
+PROVIDER_LIMITS = {
+    name: {**DEFAULT_PROVIDER_LIMITS.get(name, {}), **limits}
+    for name, limits in {**DEFAULT_PROVIDER_LIMITS, **scheduler_config.get("providers", {})}.items()
+}
+# Lower number = served first when a provider is saturated
+COMMAND_PRIORITIES = {
+    "ask": 0, "code": 0, "gemini": 0,
+    "auto": 1,
+    "deep": 2, "research": 2, "build": 2,
+    "crosscheck": 3, "consensus": 3,
+    "hardmode": 4,
+    **scheduler_config.get("priorities", {}),
+}
+QUEUE_NOTICE_SECONDS = scheduler_config.get("notice_after", 2.0)  # tell the user once they have waited this long
+
+# Response cache (optional - reuse answers to repeated queries)
+response_cache_config = config.get("response_cache", {})
+RESPONSE_CACHE_ENABLED = response_cache_config.get("enabled", True)
+RESPONSE_CACHE_TTL = response_cache_config.get("ttl_seconds", 24 * 3600)
+RESPONSE_CACHE_MAX_ENTRIES = response_cache_config.get("max_entries", 500)  # in-memory tier
+RESPONSE_CACHE_MAX_DISK_MB = response_cache_config.get("max_disk_mb", 50)
+RESPONSE_CACHE_NEAR_DUPLICATE = response_cache_config.get("near_duplicate", True)
+RESPONSE_CACHE_SIMILARITY = response_cache_config.get("similarity", 0.9)  # estimated Jaccard for a near-duplicate hit
+RESPONSE_COALESCE = response_cache_config.get("coalesce", True)  # identical in-flight requests share one provider call
+
+# Outbound Discord messages (optional - per-channel pacing, defaults match Discord's 5 msgs / 5 s)
+send_pipeline_config = config.get("send_pipeline", {})
+SEND_BURST = send_pipeline_config.get("per_channel_burst", 5)
+SEND_WINDOW = send_pipeline_config.get("per_channel_window", 5.0)
+DISCORD_MESSAGE_LIMIT = 2000
+
+# Context budget (optional - max tokens of project context per model)
+context_budget_config = config.get("context_budget", {})
+DEFAULT_CONTEXT_BUDGET = context_budget_config.get("default_tokens", 12000)
+MODEL_CONTEXT_BUDGETS = {"gpt-4": 5000, **context_budget_config.get("models", {})}
+
+# Attachments (optional - what !commands read from uploaded files)
+attachments_config = config.get("attachments", {})
+ATTACHMENT_EXTENSIONS = tuple(attachments_config.get("extensions", [".txt", ".md", ".py", ".csv", ".json", ".log"]))
+ATTACHMENT_MAX_BYTES = attachments_config.get("max_bytes", 2 * 1024 * 1024)  # stop downloading past this
+ATTACHMENT_MAX_TOKENS = attachments_config.get("max_tokens", 8000)  # larger files are sampled down to this
+ATTACHMENT_CACHE_SIZE = attachments_config.get("cache_size", 64)
+
+# Prompt retrieval (optional - send only the prompts/ sections relevant to a query)
+retrieval_config = config.get("retrieval", {})
+RETRIEVAL_ENABLED = retrieval_config.get("enabled", True)
+RETRIEVAL_ABOVE_TOKENS = retrieval_config.get("retrieve_above_tokens", 2000)  # smaller CONTEXT_FILES are sent whole
+RETRIEVAL_TOKENS = retrieval_config.get("max_tokens", 3000)  # budget for retrieved sections
+RETRIEVAL_PINNED = retrieval_config.get("always_include", ["canon.md"])  # always sent whole
+RETRIEVAL_INCLUDE = retrieval_config.get("include", [])  # indexed besides CONTEXT_FILES (files or folders under prompts/)
+RETRIEVAL_EXCLUDE = ["README.md", "research_core.md", "research_hardmode.md", *retrieval_config.get("exclude", [])]
+
+# Channel history cache (optional - messages kept in memory per channel)
+HISTORY_CACHE_SIZE = config.get("history_cache", {}).get("size", 200)
+
+# Memory search (optional - only the memories relevant to a query go into its context)
+memory_search_config = config.get("memory_search", {})
+MEMORY_TOP_K = memory_search_config.get("top_k", 8)
+MEMORY_EMBEDDINGS = memory_search_config.get("embeddings", False)  # needs sentence-transformers
+MEMORY_EMBEDDING_MODEL = memory_search_config.get("embedding_model", "all-MiniLM-L6-v2")
+
+# Router (optional - local pre-classifier in front of the Gemini router)
+router_config = config.get("router", {})
+ROUTER_CONFIDENCE = router_config.get("confidence", 0.85)  # local answer accepted at or above this probability
+ROUTER_CACHE_SIZE = router_config.get("cache_size", 256)
+
+# Failover (optional - fallback chains, timeouts, retries and hedged requests)
+failover_config = config.get("failover", {})
+FAILOVER_ENABLED = failover_config.get("enabled", True)
+FAILOVER_TIMEOUT = failover_config.get("timeout_seconds", 90.0)  # per attempt (first token when streaming)
+FAILOVER_RETRIES = failover_config.get("retries", 1)  # extra attempts on the same provider for transient errors
+FAILOVER_BACKOFF = failover_config.get("backoff_seconds", 1.0)  # base for jittered exponential backoff
+FAILOVER_HEDGE = failover_config.get("hedge", False)  # start the next provider once the first passes its p95
+FAILOVER_HEDGE_MIN_SAMPLES = failover_config.get("hedge_min_samples", 20)
+FAILOVER_CHAINS = {
+    "research": ["claude", "openai", "gemini"],
+    "build": ["claude", "openai", "gemini"],
+    "general": ["openai", "claude", "gemini"],
+    "code": ["gemini", "openai", "claude"],
+    "gemini": ["gemini", "openai", "claude"],
+    **failover_config.get("chains", {}),
+}
+# Model used when a provider answers as a fallback for another one
+FAILOVER_MODELS = {
+    "claude": RESEARCH_MODEL,
+    "openai": GENERAL_MODEL,
+    "gemini": CODE_MODEL,
+    **failover_config.get("models", {}),
+}
+
+# Consensus / crosscheck (optional - per-model deadlines, keyed by provider)
+consensus_config = config.get("consensus", {})
+CONSENSUS_DEADLINE = consensus_config.get("deadline_seconds", 120.0)
+CONSENSUS_DEADLINES = consensus_config.get("deadlines", {})  # e.g. {"gemini": 60}
+CONSENSUS_ANALYSIS = consensus_config.get("analysis", True)  # post a local agreement matrix to #findings
+CONSENSUS_SIMILARITY = consensus_config.get("similarity", 0.3)  # TF-IDF cosine for two sentences to be one claim
+
+# Usage ledger (optional - token spend per user/channel/command/model, with daily budgets)
+usage_config = config.get("usage", {})
+USAGE_PRICING = {  # USD per million tokens
+    "claude-sonnet-4-20250514": {"input": 3.0, "output": 15.0, "cached_input": 0.3},
+    "gpt-4": {"input": 30.0, "output": 60.0, "cached_input": 30.0},
+    "gemini-3-flash-preview": {"input": 0.0, "output": 0.0, "cached_input": 0.0},  # free tier
+    **usage_config.get("pricing", {}),
+}
+USAGE_BUDGETS = {"user": 2.0, "channel": 10.0, "total": 25.0, **usage_config.get("daily_budget_usd", {})}
+USAGE_OVER_BUDGET = usage_config.get("over_budget", "downgrade")  # downgrade | queue | deny
+USAGE_HARD_LIMIT = usage_config.get("hard_limit_factor", 1.5)  # deny outright past budget x this
+USAGE_EXPENSIVE_COMMANDS = set(usage_config.get("expensive_commands",
+                                                ["deep", "research", "hardmode", "build", "crosscheck", "consensus"]))
+USAGE_FLUSH_SECONDS = usage_config.get("flush_seconds", 30)
+
+# Storage (optional - local file/database I/O runs on a small thread pool, writes are group-committed)
+storage_config = config.get("storage", {})
+STORAGE_IO_WORKERS = storage_config.get("io_workers", 4)
+STORAGE_WRITE_DELAY = storage_config.get("write_delay_seconds", 0.05)  # collect a burst of writes into one commit
+STORAGE_MAX_BATCH = storage_config.get("max_batch", 64)
+
+# Startup (optional - warn when local startup takes longer than this)
+STARTUP_BUDGET_SECONDS = config.get("startup", {}).get("budget_seconds", 2.0)
+
 # ============================================================
 # INITIALIZE CLIENTS
 # ============================================================
 
+class ResearchBot(commands.Bot):
+    async def close(self):
+        # Persist anything still buffered in memory before the process exits
+        await flush_local_state()
+        await AttachmentIngester.close()
+        await super().close()
+
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = ResearchBot(command_prefix="!", intents=intents)
+
+# ============================================================
+# METRICS
+# ============================================================
+
+class Histogram:
+    """Cumulative-bucket histogram (for Prometheus) plus a bounded sample window (for percentiles)"""
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.samples: deque = deque(maxlen=2048)
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        self.samples.append(value)
+    
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Metrics:
+    """In-process latency histograms and token/error counters, keyed by name and labels"""
+    
+    HELP = {
+        "command_seconds": "End-to-end command handling time",
+        "context_assembly_seconds": "Time to assemble project context",
+        "queue_wait_seconds": "Time spent waiting for a provider slot",
+        "provider_latency_seconds": "Provider call latency (full response)",
+        "time_to_first_token_seconds": "Provider time to first streamed token",
+        "time_to_first_visible_token_seconds": "Command start to first streamed token visible in Discord",
+        "discord_send_seconds": "Discord send/edit round trip",
+        "router_seconds": "!auto routing decision time",
+        "startup_seconds": "Seconds from process start to each startup phase",
+        "failovers_total": "Requests handed to the next provider in an agent's fallback chain",
+        "hedged_requests_total": "Hedged requests by which attempt answered first",
+        "storage_seconds": "Local file/database I/O on the storage pool, by operation",
+        "coalesced_requests_total": "Requests served by joining an identical in-flight request",
+        "consensus_analysis_seconds": "Local agreement analysis for !consensus",
+        "llm_input_tokens_total": "Input tokens reported by providers",
+        "llm_output_tokens_total": "Output tokens reported by providers",
+        "llm_cached_tokens_total": "Input tokens served from provider prompt caches",
+        "llm_errors_total": "Provider call errors",
+        "command_errors_total": "Command errors",
+    }
+    
+    histograms: dict[str, dict[tuple, Histogram]] = {}
+    counters: dict[str, dict[tuple, float]] = {}
+    
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+    
+    @staticmethod
+    def observe(name: str, value: float, **labels):
+        series = Metrics.histograms.setdefault(name, {})
+        key = Metrics._labels(labels)
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+    
+    @staticmethod
+    def inc(name: str, amount: float = 1, **labels):
+        series = Metrics.counters.setdefault(name, {})
+        key = Metrics._labels(labels)
+        series[key] = series.get(key, 0) + amount
+    
+    @staticmethod
+    @contextlib.contextmanager
+    def timer(name: str, **labels):
+        """Observe the duration of a with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            Metrics.observe(name, time.perf_counter() - started, **labels)
+    
+    @staticmethod
+    def merged(name: str) -> Histogram | None:
+        """All label series of a histogram combined (for summaries)"""
+        series = Metrics.histograms.get(name)
+        if not series:
+            return None
+        combined = Histogram()
+        for histogram in series.values():
+            for value in histogram.samples:
+                combined.samples.append(value)
+            combined.count += histogram.count
+            combined.total += histogram.total
+        return combined
+    
+    @staticmethod
+    def render_prometheus() -> str:
+        """Prometheus text exposition format"""
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+        
+        lines = []
+        for name, series in sorted(Metrics.histograms.items()):
+            lines.append(f"# HELP researchbot_{name} {Metrics.HELP.get(name, name)}")
+            lines.append(f"# TYPE researchbot_{name} histogram")
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(Histogram.BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"researchbot_{name}_bucket{fmt(labels, (('le', str(bound)),))} {cumulative}")
+                lines.append(f"researchbot_{name}_bucket{fmt(labels, (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"researchbot_{name}_sum{fmt(labels)} {histogram.total}")
+                lines.append(f"researchbot_{name}_count{fmt(labels)} {histogram.count}")
+        for name, series in sorted(Metrics.counters.items()):
+            lines.append(f"# HELP researchbot_{name} {Metrics.HELP.get(name, name)}")
+            lines.append(f"# TYPE researchbot_{name} counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"researchbot_{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+    
+    _server = None
+    
+    @staticmethod
+    async def start_server():
+        """Serve /metrics on METRICS_HOST:METRICS_PORT (once)"""
+        if Metrics._server is not None or not METRICS_ENABLED:
+            return
+        
+        async def handle(request):
+            return web.Response(text=Metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+        
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+        except OSError as e:
+            print(f"⚠️ Could not start metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+            await runner.cleanup()
+            return
+        Metrics._server = runner
+        print(f"📈 Metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+# ============================================================
+# REQUEST SCHEDULING
+# ============================================================
+
+# Per-command request info (set in before_invoke, read by the scheduler and providers)
+current_request: contextvars.ContextVar[dict | None] = contextvars.ContextVar("current_request", default=None)
+
+
+class SchedulerBusy(Exception):
+    """Raised instead of queueing when a provider's queue is full or it is being rate limited"""
+    
+    def __init__(self, provider: str, depth: int, retry_after: float = None):
+        self.provider = provider
+        self.depth = depth
+        self.retry_after = retry_after
+        super().__init__(f"{provider} is at capacity ({depth} requests queued)")
+
+
+class TokenBucket:
+    """Continuously refilling bucket for a per-minute budget"""
+    
+    def __init__(self, per_minute: float, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.clock = clock
+        self.updated = clock()
+    
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` can be consumed (0 if available now)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+    
+    def consume(self, amount: float):
+        """Take tokens (negative amounts refund an over-estimate)"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - min(amount, self.capacity))
+    
+    def pause(self, seconds: float):
+        """Empty the bucket so nothing is admitted for roughly `seconds`"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class ProviderQueue:
+    """Priority queue in front of one provider, admitting requests within its limits"""
+    
+    def __init__(self, name: str, max_concurrent: int = 4, requests_per_minute: float = 60,
+                 tokens_per_minute: float = 40000, max_queue: int = 20, clock=time.monotonic):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.requests = TokenBucket(requests_per_minute, clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock)
+        self.active = 0
+        self.waiting: list = []  # heap of (priority, seq, future, tokens)
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+    
+    @property
+    def depth(self) -> int:
+        return sum(1 for _, _, future, _ in self.waiting if not future.done())
+    
+    async def acquire(self, priority: int, tokens: int):
+        """Wait for a slot. Raises SchedulerBusy if the queue is already full."""
+        if self.depth >= self.max_queue:
+            raise SchedulerBusy(self.name, self.depth)
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self._seq), future, tokens))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as the caller gave up - hand the slot back
+                self.release(tokens, 0)
+            raise
+    
+    def release(self, estimated_tokens: int, actual_tokens: int | None):
+        """Free a slot, correcting the token bucket with the real usage if known"""
+        self.active -= 1
+        if actual_tokens is not None:
+            self.tokens.consume(actual_tokens - estimated_tokens)
+        self._dispatch()
+    
+    def position(self, priority: int) -> int:
+        """How many waiting requests would be served before one with this priority"""
+        return sum(1 for p, _, future, _ in self.waiting if p <= priority and not future.done())
+    
+    def _dispatch(self, *_):
+        self._timer = None
+        while self.waiting and self.active < self.max_concurrent:
+            priority, seq, future, tokens = self.waiting[0]
+            if future.done():  # cancelled while waiting
+                heapq.heappop(self.waiting)
+                continue
+            
+            delay = max(self.requests.delay(1), self.tokens.delay(tokens))
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            
+            heapq.heappop(self.waiting)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            self.active += 1
+            future.set_result(None)
+
+
+class RequestScheduler:
+    """Routes every provider call through a bounded, rate-limited, prioritized queue"""
+    
+    def __init__(self, limits: dict[str, dict], clock=time.monotonic):
+        self.limits = limits
+        self.clock = clock
+        self.queues: dict[str, ProviderQueue] = {}
+    
+    def queue(self, provider: str) -> ProviderQueue:
+        if provider not in self.queues:
+            self.queues[provider] = ProviderQueue(provider, clock=self.clock, **self.limits.get(provider, {}))
+        return self.queues[provider]
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, provider: str, estimated_tokens: int):
+        """Hold a provider slot for the duration of a call.
+        
+        Yields a dict; set its "tokens" key to the real usage so the token bucket stays accurate.
+        """
+        queue = self.queue(provider)
+        request = current_request.get() or {}
+        priority = request.get("priority", 2)
+        
+        started = time.perf_counter()
+        acquire = asyncio.ensure_future(queue.acquire(priority, estimated_tokens))
+        try:
+            done, _ = await asyncio.wait({acquire}, timeout=QUEUE_NOTICE_SECONDS)
+            if not done and request.get("notify"):
+                position = queue.position(priority)
+                await request["notify"](f"⏳ **{provider} is busy** - you're #{position} in the queue, hang tight...")
+            await acquire
+        except asyncio.CancelledError:
+            acquire.cancel()
+            raise
+        Metrics.observe("queue_wait_seconds", time.perf_counter() - started, provider=provider)
+        
+        usage = {"tokens": None}
+        try:
+            yield usage
+        finally:
+            queue.release(estimated_tokens, usage["tokens"])
+    
+    def snapshot(self) -> dict[str, dict]:
+        """Queue depth and in-flight count per provider"""
+        return {
+            name: {"active": q.active, "queued": q.depth, "max_concurrent": q.max_concurrent}
+            for name, q in self.queues.items()
+        }
+
+
+scheduler = RequestScheduler(PROVIDER_LIMITS)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """True for HTTP 429s from any of the provider SDKs"""
+    return getattr(error, "status_code", None) == 429 or getattr(error, "code", None) == 429
+
+
+# ============================================================
+# LLM PROVIDERS
+# ============================================================
+
+@dataclass
+class LLMResult:
+    """Text and usage metadata returned by a provider call"""
+    text: str
+    provider: str
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0   # input tokens served from the provider's prompt cache
+    cache_write_tokens: int = 0  # input tokens written to it (Anthropic only)
+
+
+class LLMStream:
+    """Async iterator over the text deltas of a streamed completion.
+    
+    Once exhausted, `result` holds the full text and token usage.
+    """
+    
+    def __init__(self, provider: "LLMProvider", model: str, prompt: str, system: str | None, max_tokens: int | None,
+                 timeout: float | None = None):
+        self.provider = provider
+        self.result = LLMResult(text="", provider=provider.name, model=model)
+        self.timeout = timeout  # for the first token, counted from when the scheduler admits the call
+        self._args = (model, prompt, system, max_tokens)
+    
+    async def __aiter__(self):
+        parts = []
+        labels = {"provider": self.provider.name, "model": self.result.model}
+        async with self.provider._slot(*self._args) as usage:
+            started = time.perf_counter()
+            async with asyncio.timeout(self.timeout) as deadline:
+                async for delta in self.provider._stream(*self._args, self.result):
+                    if delta:
+                        if not parts:
+                            Metrics.observe("time_to_first_token_seconds", time.perf_counter() - started, **labels)
+                            deadline.reschedule(None)
+                        parts.append(delta)
+                        yield delta
+            Metrics.observe("provider_latency_seconds", time.perf_counter() - started, **labels)
+            usage["tokens"] = self.result.input_tokens + self.result.output_tokens
+        self.result.text = "".join(parts)
+        self.provider._record_usage(self.result)
+
+
+class LLMProvider:
+    """Shared async interface over the Anthropic, OpenAI and Gemini SDKs.
+    
+    The SDK client is only constructed on the first call, so startup never touches the network.
+    """
+    
+    name = "provider"
+    label = "Provider"
+    env_var = ""
+    
+    def __init__(self, api_key: str | None = None):
+        self._api_key = api_key
+        self._client = None
+        # Prompt-cache effectiveness across calls
+        self.cache_stats = {"calls": 0, "hits": 0, "input_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0}
+    
+    @property
+    def api_key(self) -> str | None:
+        # Read at call time so .env values loaded by main() are picked up
+        return self._api_key or os.getenv(self.env_var)
+    
+    @property
+    def available(self) -> bool:
+        return bool(self.api_key)
+    
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._create_client()
+        return self._client
+    
+    def not_configured(self) -> str:
+        """User-facing message for a missing API key"""
+        return f"❌ {self.label} API key not configured. Add {self.env_var} to your .env file."
+    
+    async def complete(self, model: str, prompt: str, system: str = None, max_tokens: int = None,
+                       timeout: float = None) -> LLMResult:
+        """Run a single-turn completion. `timeout` starts once the scheduler admits the call, so
+        time spent queued behind other requests never counts against the provider."""
+        async with self._slot(model, prompt, system, max_tokens) as usage:
+            with Metrics.timer("provider_latency_seconds", provider=self.name, model=model):
+                async with asyncio.timeout(timeout):
+                    result = await self._complete(model, prompt, system, max_tokens)
+            usage["tokens"] = result.input_tokens + result.output_tokens
+        self._record_usage(result)
+        return result
+    
+    def stream(self, model: str, prompt: str, system: str = None, max_tokens: int = None,
+               timeout: float = None) -> LLMStream:
+        """Run a single-turn completion, yielding text as it is generated (`timeout` for the first token)"""
+        return LLMStream(self, model, prompt, system, max_tokens, timeout)
+    
+    def _record_usage(self, result: LLMResult):
+        """Record token counters and spend, and log/accumulate prompt-cache hits for one call"""
+        UsageLedger.record(result)
+        labels = {"provider": self.name, "model": result.model}
+        Metrics.inc("llm_input_tokens_total", result.input_tokens, **labels)
+        Metrics.inc("llm_output_tokens_total", result.output_tokens, **labels)
+        Metrics.inc("llm_cached_tokens_total", result.cache_read_tokens, **labels)
+        
+        stats = self.cache_stats
+        stats["calls"] += 1
+        stats["hits"] += 1 if result.cache_read_tokens else 0
+        stats["input_tokens"] += result.input_tokens
+        stats["cache_read_tokens"] += result.cache_read_tokens
+        stats["cache_write_tokens"] += result.cache_write_tokens
+        
+        status = "hit" if result.cache_read_tokens else "miss"
+        print(f"💾 Prompt cache {status}: {self.name}/{result.model} "
+              f"{result.cache_read_tokens:,} of {result.input_tokens:,} input tokens cached"
+              + (f", {result.cache_write_tokens:,} written" if result.cache_write_tokens else ""))
+    
+    @contextlib.asynccontextmanager
+    async def _slot(self, model: str, prompt: str, system: str | None, max_tokens: int | None):
+        """Scheduler slot for one call; turns provider 429s into SchedulerBusy backpressure"""
+        # Rough local estimate (~4 chars per token) until the provider reports real usage
+        estimate = (len(prompt) + len(system or "")) // 4 + (max_tokens or 1000)
+        async with scheduler.slot(self.name, estimate) as usage:
+            try:
+                yield usage
+            except Exception as e:
+                Metrics.inc("llm_errors_total", provider=self.name, model=model, error=type(e).__name__)
+                if is_rate_limit_error(e):
+                    queue = scheduler.queue(self.name)
+                    queue.requests.pause(30)
+                    raise SchedulerBusy(self.name, queue.depth, retry_after=30) from e
+                raise
+    
+    def preload(self):
+        """Import the SDK and build the client ahead of the first call (run off the event loop)"""
+        return self.client
+    
+    def _create_client(self):
+        raise NotImplementedError
+    
+    async def _complete(self, model: str, prompt: str, system: str | None, max_tokens: int | None) -> LLMResult:
+        raise NotImplementedError
+    
+    async def _stream(self, model: str, prompt: str, system: str | None, max_tokens: int | None, result: LLMResult):
+        """Yield text deltas and fill in token usage on `result`"""
+        raise NotImplementedError
+        yield
+
+
+class AnthropicProvider(LLMProvider):
+    name = "claude"
+    label = "Claude (Anthropic)"
+    env_var = "ANTHROPIC_API_KEY"
+    
+    def _create_client(self):
+        import anthropic
+        return anthropic.AsyncAnthropic(api_key=self.api_key)
+    
+    @staticmethod
+    def _request(model, prompt, system, max_tokens) -> dict:
+        kwargs = {
+            "model": model,
+            "max_tokens": max_tokens or 2000,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        if system:
+            # The system prompt is the stable prefix - mark it as a cache breakpoint
+            kwargs["system"] = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+        return kwargs
+    
+    @staticmethod
+    def _usage(result: LLMResult, usage):
+        # Anthropic reports cached input separately from (uncached) input_tokens
+        cache_read = usage.cache_read_input_tokens or 0
+        cache_write = usage.cache_creation_input_tokens or 0
+        result.input_tokens = usage.input_tokens + cache_read + cache_write
+        result.output_tokens = usage.output_tokens
+        result.cache_read_tokens = cache_read
+        result.cache_write_tokens = cache_write
+    
+    async def _complete(self, model, prompt, system, max_tokens):
+        response = await self.client.messages.create(**self._request(model, prompt, system, max_tokens))
+        result = LLMResult(text=response.content[0].text, provider=self.name, model=model)
+        self._usage(result, response.usage)
+        return result
+    
+    async def _stream(self, model, prompt, system, max_tokens, result):
+        async with self.client.messages.stream(**self._request(model, prompt, system, max_tokens)) as stream:
+            async for text in stream.text_stream:
+                yield text
+            final = await stream.get_final_message()
+        self._usage(result, final.usage)
+
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+    label = "OpenAI"
+    env_var = "OPENAI_API_KEY"
+    
+    def _create_client(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=self.api_key)
+    
+    @staticmethod
+    def _request(model, prompt, system, max_tokens) -> dict:
+        messages = []
+        if system:
+            messages.append({"role": "system", "content": system})
+        messages.append({"role": "user", "content": prompt})
+        
+        kwargs = {"model": model, "messages": messages}
+        if max_tokens:
+            kwargs["max_tokens"] = max_tokens
+        return kwargs
+    
+    @staticmethod
+    def _usage(result: LLMResult, usage):
+        # OpenAI caches automatically on a matching prefix; the system message comes first for that reason
+        details = usage.prompt_tokens_details
+        result.input_tokens = usage.prompt_tokens
+        result.output_tokens = usage.completion_tokens
+        result.cache_read_tokens = (details.cached_tokens or 0) if details else 0
+    
+    async def _complete(self, model, prompt, system, max_tokens):
+        response = await self.client.chat.completions.create(**self._request(model, prompt, system, max_tokens))
+        result = LLMResult(text=response.choices[0].message.content, provider=self.name, model=model)
+        if response.usage:
+            self._usage(result, response.usage)
+        return result
+    
+    async def _stream(self, model, prompt, system, max_tokens, result):
+        stream = await self.client.chat.completions.create(
+            **self._request(model, prompt, system, max_tokens),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.usage:
+                self._usage(result, chunk.usage)
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+    label = "Gemini"
+    env_var = "GEMINI_API_KEY"
+    
+    def _create_client(self):
+        from google import genai
+        return genai.Client(api_key=self.api_key)
+    
+    @staticmethod
+    def _config(system, max_tokens):
+        if system or max_tokens:
+            from google.genai import types as genai_types
+            return genai_types.GenerateContentConfig(system_instruction=system, max_output_tokens=max_tokens)
+        return None
+    
+    async def _complete(self, model, prompt, system, max_tokens):
+        response = await self.client.aio.models.generate_content(
+            model=model, contents=prompt, config=self._config(system, max_tokens)
+        )
+        result = LLMResult(text=response.text, provider=self.name, model=model)
+        if response.usage_metadata:
+            self._usage(result, response.usage_metadata)
+        return result
+    
+    @staticmethod
+    def _usage(result: LLMResult, usage):
+        # Gemini caches implicitly on a repeated prefix (system_instruction comes first)
+        result.input_tokens = usage.prompt_token_count or 0
+        result.output_tokens = usage.candidates_token_count or 0
+        result.cache_read_tokens = usage.cached_content_token_count or 0
+    
+    async def _stream(self, model, prompt, system, max_tokens, result):
+        stream = await self.client.aio.models.generate_content_stream(
+            model=model, contents=prompt, config=self._config(system, max_tokens)
+        )
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+            if chunk.usage_metadata:
+                self._usage(result, chunk.usage_metadata)
+
+
+# Provider registry (keys are looked up at call time, so they can be swapped out)
+providers: dict[str, LLMProvider] = {
+    "claude": AnthropicProvider(),
+    "openai": OpenAIProvider(),
+    "gemini": GeminiProvider(),
+}
+
+
+class Failover:
+    """Per-agent fallback chains over the provider registry ("API failure → Fallback to next model").
+    
+    Each provider gets a timeout and jittered retries for transient errors before the next one
+    in the chain is tried. Optionally, a request still running at its provider's p95 latency is
+    hedged by starting the next provider and taking whichever answers first.
+    """
+    
+    @staticmethod
+    def candidates(agent: str, provider: str, model: str) -> list[tuple[LLMProvider, str]]:
+        """Configured (provider, model) pairs to try for an agent, primary first"""
+        request = current_request.get() or {}
+        chain = FAILOVER_CHAINS.get(agent, [provider]) if FAILOVER_ENABLED or request.get("downgrade") else [provider]
+        names = [provider] + [name for name in chain if name != provider]
+        candidates = [
+            (providers[name], model if name == provider else FAILOVER_MODELS.get(name, model))
+            for name in names if name in providers and providers[name].available
+        ]
+        if request.get("downgrade"):
+            # Over budget - cheapest model first (stable, so ties keep chain order)
+            candidates.sort(key=lambda candidate: UsageLedger.unit_price(candidate[1]))
+        return candidates
+    
+    @staticmethod
+    def _transient(error: Exception) -> bool:
+        """Worth retrying on the same provider (timeouts, 5xx, dropped connections)"""
+        if isinstance(error, asyncio.TimeoutError):
+            return True
+        status = getattr(error, "status_code", None) or getattr(error, "code", None)
+        if isinstance(status, int):
+            return status >= 500
+        return any(word in type(error).__name__ for word in ("Timeout", "Connection", "Unavailable"))
+    
+    @staticmethod
+    async def _attempt(provider: LLMProvider, model: str, prompt: str, system: str | None, max_tokens: int | None) -> LLMResult:
+        """One provider with a timeout (from admission, not queueing) and jittered exponential backoff
+        between retries"""
+        for attempt in range(FAILOVER_RETRIES + 1):
+            try:
+                return await provider.complete(model, prompt, system=system, max_tokens=max_tokens,
+                                               timeout=FAILOVER_TIMEOUT)
+            except SchedulerBusy:
+                raise  # saturated or rate limited - go straight to the next provider
+            except Exception as e:
+                if attempt == FAILOVER_RETRIES or not Failover._transient(e):
+                    raise
+                delay = FAILOVER_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"🔁 {provider.name}/{model} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    
+    @staticmethod
+    def _hedge_delay(provider: LLMProvider, model: str) -> float | None:
+        """The provider's observed p95 latency, once there are enough samples to trust it"""
+        series = Metrics.histograms.get("provider_latency_seconds", {})
+        histogram = series.get(Metrics._labels({"provider": provider.name, "model": model}))
+        if histogram is None or histogram.count < FAILOVER_HEDGE_MIN_SAMPLES:
+            return None
+        return histogram.percentile(0.95)
+    
+    @staticmethod
+    async def _hedged(primary: tuple, backup: tuple, prompt: str, system: str | None, max_tokens: int | None) -> LLMResult:
+        """Run primary; if it hasn't answered by its p95, also run backup and take the first success"""
+        first = asyncio.ensure_future(Failover._attempt(*primary, prompt, system, max_tokens))
+        delay = Failover._hedge_delay(*primary)
+        if delay is None:
+            return await first
+        
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        if scheduler.queue(primary[0].name).depth:
+            # Slow because it is queued, not because the provider is - a hedge would only add load
+            return await first
+        
+        print(f"🪁 Hedging {primary[0].name} after {delay:.1f}s with {backup[0].name}")
+        second = asyncio.ensure_future(Failover._attempt(*backup, prompt, system, max_tokens))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = "hedge" if task is second else "primary"
+                        Metrics.inc("hedged_requests_total", provider=primary[0].name, winner=winner)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    @staticmethod
+    async def complete(agent: str, provider: str, model: str, prompt: str, system: str = None,
+                       max_tokens: int = None) -> LLMResult:
+        """Complete with the agent's fallback chain; the result's provider/model say who answered"""
+        chain = Failover.candidates(agent, provider, model)
+        if not chain:
+            raise RuntimeError(providers[provider].not_configured())
+        
+        error = None
+        for i, candidate in enumerate(chain):
+            try:
+                if FAILOVER_HEDGE and i + 1 < len(chain):
+                    return await Failover._hedged(candidate, chain[i + 1], prompt, system, max_tokens)
+                return await Failover._attempt(*candidate, prompt, system, max_tokens)
+            except Exception as e:
+                error = e
+                if i + 1 < len(chain):
+                    following = chain[i + 1][0].name
+                    print(f"⚠️ {agent}: {candidate[0].name} failed ({type(e).__name__}), falling back to {following}")
+                    Metrics.inc("failovers_total", agent=agent, provider=candidate[0].name, fallback=following)
+        raise error
+    
+    @staticmethod
+    async def stream(agent: str, provider: str, model: str, prompt: str, system: str = None, max_tokens: int = None):
+        """Streaming counterpart of complete(); falls back only until the first token has been sent.
+        
+        A fallback answer starts with a note naming the model that actually answered.
+        """
+        chain = Failover.candidates(agent, provider, model)
+        if not chain:
+            yield providers[provider].not_configured()
+            return
+        
+        for i, (candidate, candidate_model) in enumerate(chain):
+            # The first-token timeout runs inside the stream, from admission - queueing is not a failure
+            deltas = candidate.stream(candidate_model, prompt, system=system, max_tokens=max_tokens,
+                                      timeout=FAILOVER_TIMEOUT).__aiter__()
+            try:
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                await deltas.aclose()
+                if i + 1 == len(chain):
+                    raise
+                following = chain[i + 1][0].name
+                print(f"⚠️ {agent}: {candidate.name} failed ({type(e).__name__}), falling back to {following}")
+                Metrics.inc("failovers_total", agent=agent, provider=candidate.name, fallback=following)
+                continue
+            
+            if candidate.name != provider or candidate_model != model:
+                # A fallback, or the cheaper model a downgraded request was sorted onto
+                yield Failover.note(providers[provider], candidate, candidate_model)
+            yield first
+            async for delta in deltas:
+                yield delta
+            return
+    
+    @staticmethod
+    def note(primary: LLMProvider, answered: LLMProvider, model: str) -> "FallbackText":
+        return FallbackText(f"*↪️ Answered by {answered.label} (`{model}`) instead of {primary.label}.*\n\n")
+    
+    @staticmethod
+    def text(result: LLMResult, provider: str, model: str) -> str:
+        """The response text, labelled when it came from a different model than the agent's own"""
+        if result.provider == provider and result.model == model:
+            return result.text
+        return FallbackText(Failover.note(providers[provider], providers[result.provider], result.model) + result.text)
+
+
+class FallbackText(str):
+    """Text answered by a fallback (or budget-downgraded) model - shown, but never cached under the
+    agent's own model"""
+
+
+class QuotaExceeded(commands.CheckFailure):
+    """Raised before an expensive command when the caller is past the hard daily limit"""
+    
+    def __init__(self, scope: str, spent: float, budget: float):
+        self.scope = scope
+        self.spent = spent
+        self.budget = budget
+        super().__init__(f"daily {scope} budget used: ${spent:.2f} of ${budget:.2f}")
+
+
+class UsageLedger:
+    """Token and cost accounting per day, user, channel, command and model.
+    
+    Provider results are added to an in-memory aggregate (which also answers quota checks), and
+    the deltas are flushed to usage.db every USAGE_FLUSH_SECONDS and at shutdown. Today's totals
+    are loaded from disk before the first command (load()), so budgets survive restarts. Disk
+    access runs on the "usage" storage lane.
+    """
+    
+    USAGE_DB = os.path.join(os.path.dirname(__file__), 'usage.db')
+    
+    _conn: sqlite3.Connection | None = None
+    # (day, user, channel, command, model) -> [calls, input, output, cached, cost]
+    _totals: dict[tuple, list] = {}
+    _pending: dict[tuple, list] = {}
+    _loaded_day: str | None = None
+    _loaded = False
+    _loading: asyncio.Future | None = None
+    _flusher: asyncio.Task | None = None
+    
+    @staticmethod
+    def _db() -> sqlite3.Connection:
+        if UsageLedger._conn is None:
+            conn = sqlite3.connect(UsageLedger.USAGE_DB, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage (
+                    day TEXT NOT NULL,
+                    user TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    command TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    calls INTEGER NOT NULL,
+                    input_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    cached_tokens INTEGER NOT NULL,
+                    cost REAL NOT NULL,
+                    PRIMARY KEY (day, user, channel, command, model)
+                )
+            """)
+            UsageLedger._conn = conn
+        return UsageLedger._conn
+    
+    @staticmethod
+    def today() -> str:
+        return discord.utils.utcnow().strftime('%Y-%m-%d')
+    
+    @staticmethod
+    def _current() -> dict[tuple, list]:
+        """Today's aggregate (a new day starts empty)"""
+        day = UsageLedger.today()
+        if UsageLedger._loaded_day != day:
+            UsageLedger._loaded_day = day
+            UsageLedger._totals = {}
+        return UsageLedger._totals
+    
+    @staticmethod
+    def _read_day(day: str) -> list[tuple]:
+        return [tuple(row) for row in UsageLedger._db().execute("SELECT * FROM usage WHERE day = ?", (day,))]
+    
+    @staticmethod
+    async def load():
+        """Add today's totals from earlier runs to the aggregate (once per process).
+        
+        Concurrent callers share one read; a failed read is retried by the next caller.
+        """
+        if UsageLedger._loaded:
+            return
+        if UsageLedger._loading is None:
+            UsageLedger._loading = asyncio.ensure_future(UsageLedger._load())
+        loading = UsageLedger._loading
+        try:
+            await asyncio.shield(loading)
+        except Exception:
+            if UsageLedger._loading is loading:
+                UsageLedger._loading = None
+            raise
+    
+    @staticmethod
+    async def _load():
+        day = UsageLedger.today()
+        rows = await Storage.run(UsageLedger._read_day, day, lane="usage")
+        totals = UsageLedger._current()
+        for row in rows:
+            current = totals.setdefault(tuple(row[:5]), [0, 0, 0, 0, 0.0])
+            for i, value in enumerate(row[5:]):
+                current[i] += value
+        UsageLedger._loaded = True
+    
+    @staticmethod
+    def price(model: str) -> dict:
+        return USAGE_PRICING.get(model, {"input": 0.0, "output": 0.0, "cached_input": 0.0})
+    
+    @staticmethod
+    def unit_price(model: str) -> float:
+        """Input + output price per million tokens, for ranking models by cost"""
+        price = UsageLedger.price(model)
+        return price.get("input", 0.0) + price.get("output", 0.0)
+    
+    @staticmethod
+    def cost(result: LLMResult) -> float:
+        price = UsageLedger.price(result.model)
+        uncached = result.input_tokens - result.cache_read_tokens
+        return (uncached * price.get("input", 0.0)
+                + result.cache_read_tokens * price.get("cached_input", price.get("input", 0.0))
+                + result.output_tokens * price.get("output", 0.0)) / 1_000_000
+    
+    @staticmethod
+    def record(result: LLMResult):
+        """Add one provider call, attributed to the command that made it"""
+        request = current_request.get() or {}
+        key = (UsageLedger.today(), request.get("user", "-"), request.get("channel", "-"),
+               request.get("command", "-"), result.model)
+        delta = [1, result.input_tokens, result.output_tokens, result.cache_read_tokens, UsageLedger.cost(result)]
+        for table in (UsageLedger._current(), UsageLedger._pending):
+            row = table.setdefault(key, [0, 0, 0, 0, 0.0])
+            for i, value in enumerate(delta):
+                row[i] += value
+        
+        if UsageLedger._flusher is None or UsageLedger._flusher.done():
+            UsageLedger._flusher = asyncio.get_running_loop().create_task(UsageLedger._flush_later())
+    
+    @staticmethod
+    async def _flush_later():
+        await asyncio.sleep(USAGE_FLUSH_SECONDS)
+        await UsageLedger.save()
+    
+    @staticmethod
+    async def save():
+        """Write pending deltas to usage.db in one transaction (taken on the event loop, so none are lost)"""
+        pending, UsageLedger._pending = UsageLedger._pending, {}
+        await Storage.run(UsageLedger._write, pending, lane="usage")
+    
+    @staticmethod
+    def _write(pending: dict[tuple, list]):
+        if not pending:
+            return
+        with UsageLedger._db() as conn:
+            # The connection autocommits, so the batch needs an explicit transaction
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("""
+                INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (day, user, channel, command, model) DO UPDATE SET
+                    calls = calls + excluded.calls,
+                    input_tokens = input_tokens + excluded.input_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    cached_tokens = cached_tokens + excluded.cached_tokens,
+                    cost = cost + excluded.cost
+            """, [(*key, *values) for key, values in pending.items()])
+    
+    @staticmethod
+    def spent(user: str = None, channel: str = None) -> float:
+        """Today's spend in USD, optionally for one user or channel"""
+        return sum(
+            values[4] for (_, row_user, row_channel, _, _), values in UsageLedger._current().items()
+            if (user is None or row_user == user) and (channel is None or row_channel == channel)
+        )
+    
+    @staticmethod
+    def breakdown(index: int, user: str = None) -> list[tuple[str, list]]:
+        """Today's totals grouped by one key field (1 user, 2 channel, 3 command, 4 model), most expensive first"""
+        groups: dict[str, list] = {}
+        for key, values in UsageLedger._current().items():
+            if user is not None and key[1] != user:
+                continue
+            row = groups.setdefault(key[index], [0, 0, 0, 0, 0.0])
+            for i, value in enumerate(values):
+                row[i] += value
+        return sorted(groups.items(), key=lambda item: -item[1][4])
+    
+    @staticmethod
+    def _history(days: int) -> list[tuple[str, float, int]]:
+        rows = UsageLedger._db().execute(
+            "SELECT day, SUM(cost), SUM(calls) FROM usage GROUP BY day ORDER BY day DESC LIMIT ?", (days,)
+        ).fetchall()
+        return [tuple(row) for row in rows]
+    
+    @staticmethod
+    async def history(days: int = 7) -> list[tuple[str, float, int]]:
+        """(day, cost, calls) for recent days, from disk plus anything not yet flushed"""
+        await UsageLedger.save()
+        return await Storage.run(UsageLedger._history, days, lane="usage")
+    
+    @staticmethod
+    def check(request: dict):
+        """Apply the over-budget policy to an expensive command (mutates the request context)"""
+        if request.get("command") not in USAGE_EXPENSIVE_COMMANDS:
+            return
+        scopes = (
+            ("user", UsageLedger.spent(user=request.get("user")), USAGE_BUDGETS.get("user")),
+            ("channel", UsageLedger.spent(channel=request.get("channel")), USAGE_BUDGETS.get("channel")),
+            ("total", UsageLedger.spent(), USAGE_BUDGETS.get("total")),
+        )
+        over = [(scope, spent, budget) for scope, spent, budget in scopes if budget and spent >= budget]
+        if not over:
+            return
+        
+        scope, spent, budget = over[0]
+        if USAGE_OVER_BUDGET == "deny" or spent >= budget * USAGE_HARD_LIMIT:
+            raise QuotaExceeded(scope, spent, budget)
+        if USAGE_OVER_BUDGET == "queue":
+            # Served after everything else when providers are saturated
+            request["priority"] = max(COMMAND_PRIORITIES.values()) + 1
+        else:
+            request["downgrade"] = True
+        request["over_budget"] = scope
 
-# Initialize AI clients (with graceful handling for missing keys)
-claude_client = None
-openai_client = None
-gemini_client = None
 
-if ANTHROPIC_API_KEY:
-    claude_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
-if GEMINI_API_KEY:
-    gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+# ============================================================
+# LOCAL STORAGE
+# ============================================================
 
+class Storage:
+    """Keeps disk I/O off the event loop, so a slow disk never stalls the gateway heartbeat.
+    
+    File reads and SQLite queries run on a small dedicated thread pool (separate from the
+    default executor used for CPU work). A store whose connection must not be used by two
+    threads at once gets its own single-thread lane, which also keeps its operations in order.
+    Database writes can be group-committed through a WriteBehind.
+    """
+    
+    _pool: ThreadPoolExecutor | None = None
+    _lanes: dict[str, ThreadPoolExecutor] = {}
+    
+    @staticmethod
+    def pool(lane: str = None) -> ThreadPoolExecutor:
+        if lane is not None:
+            if lane not in Storage._lanes:
+                Storage._lanes[lane] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"storage-{lane}")
+            return Storage._lanes[lane]
+        if Storage._pool is None:
+            Storage._pool = ThreadPoolExecutor(max_workers=STORAGE_IO_WORKERS, thread_name_prefix="storage")
+        return Storage._pool
+    
+    @staticmethod
+    async def run(fn, *args, lane: str = None):
+        """Run a blocking I/O function on the storage pool (or a store's own lane)"""
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(Storage.pool(lane), fn, *args)
+        finally:
+            op = getattr(fn, "__qualname__", "io").replace(".<locals>", "")
+            Metrics.observe("storage_seconds", time.perf_counter() - started, op=op)
+    
+    @staticmethod
+    def append_lines(path: str, lines: list[str]):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.writelines(line + "\n" for line in lines)
+
+
+class WriteBehind:
+    """Debounced group commit for one SQLite database.
+    
+    Each submitted op is a function of a connection. Ops arriving within STORAGE_WRITE_DELAY
+    of each other run in a single transaction on a dedicated writer connection (synchronous=FULL,
+    so a burst costs one fsync instead of one per write). Each op gets its own savepoint, so a
+    failing op only fails its own caller.
+    """
+    
+    def __init__(self, path, prepare=None, lane: str = None):
+        self.path = path  # callable, so tests/benchmarks can redirect the database
+        self.prepare = prepare  # run once before the first write (e.g. create the schema)
+        self.lane = lane  # the store's storage lane, so writes stay in order with its reads
+        self._conn: sqlite3.Connection | None = None
+        self._pending: list[tuple] = []
+        self._flusher: asyncio.Task | None = None
+        self.batches = 0
+        self.writes = 0
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.prepare:
+                self.prepare()
+            conn = sqlite3.connect(self.path(), check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            self._conn = conn
+        return self._conn
+    
+    async def submit(self, op):
+        """Queue op(conn) for the next batch and return its result once committed"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, future))
+        if len(self._pending) >= STORAGE_MAX_BATCH:
+            self._start(0)
+        elif self._flusher is None or self._flusher.done():
+            self._start(STORAGE_WRITE_DELAY)
+        return await future
+    
+    def _start(self, delay: float):
+        previous = self._flusher
+        
+        async def flush():
+            if previous and not previous.done():
+                await previous  # one batch at a time, in submission order
+            await asyncio.sleep(delay)
+            batch, self._pending = self._pending, []
+            if batch:
+                await self._commit(batch)
+        
+        self._flusher = asyncio.create_task(flush())
+    
+    def _run_batch(self, ops: list) -> list[tuple[bool, object]]:
+        conn = self._connect()
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for op in ops:
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((True, op(conn)))
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((False, e))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+    
+    async def _commit(self, batch: list[tuple]):
+        try:
+            results = await Storage.run(self._run_batch, [op for op, _ in batch], lane=self.lane)
+        except Exception as e:
+            results = [(False, e)] * len(batch)
+        self.batches += 1
+        self.writes += len(batch)
+        for (_, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+    
+    async def drain(self):
+        """Wait until everything submitted so far is committed"""
+        while self._flusher and not self._flusher.done():
+            await self._flusher
 
 
 class Memory:
-    """Persistent memory storage for important notes/findings"""
+    """Persistent memory storage for important notes/findings (SQLite, WAL mode).
+    
+    Searchable through an FTS5 index kept in sync by triggers (or a plain scan where SQLite
+    lacks FTS5), optionally fused with local embeddings - see search() and recall().
+    """
+    
+    MEMORY_DB = os.path.join(os.path.dirname(__file__), 'memory.db')
+    LEGACY_FILE = os.path.join(os.path.dirname(__file__), 'memory.json')
+    STOP_WORDS = frozenset(
+        "a an and are as at be by can do does for from how i in is it its me my of on or our should so "
+        "that the this to was we what when where which who why will with you".split()
+    )
+    
+    _conn: sqlite3.Connection | None = None
+    _lock = threading.Lock()
+    _fts = False
+    version = 0  # bumped on every write, so derived indexes know when to refresh
+    _writes = WriteBehind(lambda: Memory.MEMORY_DB, prepare=lambda: Memory._db(), lane="memory")
+    
+    @staticmethod
+    def _db() -> sqlite3.Connection:
+        """Open the database on first use, creating the schema and migrating memory.json.
+        
+        Guarded by a lock, so threads racing on first use open and migrate it only once."""
+        if Memory._conn is not None:
+            return Memory._conn
+        with Memory._lock:
+            if Memory._conn is None:
+                conn = sqlite3.connect(Memory.MEMORY_DB, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS memories (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        content TEXT NOT NULL,
+                        author TEXT NOT NULL,
+                        created TEXT NOT NULL,
+                        updated TEXT
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS memory_vectors (
+                        id INTEGER PRIMARY KEY,
+                        digest TEXT NOT NULL,
+                        vector BLOB NOT NULL
+                    )
+                """)
+                Memory._fts = Memory._create_fts(conn)
+                Memory._migrate_legacy(conn)
+                Memory._conn = conn
+        return Memory._conn
+    
+    @staticmethod
+    def _create_fts(conn: sqlite3.Connection) -> bool:
+        """Full-text index over memories, kept in sync by triggers. False if SQLite lacks FTS5."""
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'memories_fts'").fetchone()
+        try:
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts
+                USING fts5(content, content='memories', content_rowid='id', tokenize='porter unicode61')
+            """)
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ SQLite FTS5 unavailable ({e}) - memory search falls back to a scan")
+            return False
+        
+        conn.executescript("""
+            CREATE TRIGGER IF NOT EXISTS memories_ai AFTER INSERT ON memories BEGIN
+                INSERT INTO memories_fts (rowid, content) VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memories_ad AFTER DELETE ON memories BEGIN
+                INSERT INTO memories_fts (memories_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memories_au AFTER UPDATE ON memories BEGIN
+                INSERT INTO memories_fts (memories_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO memories_fts (rowid, content) VALUES (new.id, new.content);
+            END;
+        """)
+        if not exists:
+            # Index memories saved before the index existed
+            conn.execute("INSERT INTO memories_fts (memories_fts) VALUES ('rebuild')")
+        return True
+    
+    @staticmethod
+    def _migrate_legacy(conn: sqlite3.Connection):
+        """One-time import of the old memory.json file (renamed to memory.json.migrated afterwards)"""
+        if not os.path.exists(Memory.LEGACY_FILE):
+            return
+        
+        try:
+            with open(Memory.LEGACY_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"⚠️ Could not migrate {Memory.LEGACY_FILE}: {e}")
+            return
+        
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0] == 0:
+                conn.executemany(
+                    "INSERT INTO memories (id, content, author, created, updated) VALUES (?, ?, ?, ?, ?)",
+                    [(m["id"], m["content"], m["author"], m["created"], m.get("updated"))
+                     for m in data.get("memories", [])]
+                )
+                # Keep IDs monotonic even if the highest memories had been deleted
+                next_id = data.get("next_id", 1)
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = 'memories'")
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES ('memories', MAX(?, (SELECT IFNULL(MAX(id), 0) FROM memories)))",
+                    (next_id - 1,)
+                )
+        
+        Memory.version += 1
+        os.replace(Memory.LEGACY_FILE, Memory.LEGACY_FILE + '.migrated')
+        print(f"🧠 Migrated {len(data.get('memories', []))} memories from memory.json to memory.db")
+    
+    @staticmethod
+    async def add(content: str, author: str) -> int:
+        """Add a new memory and return its ID"""
+        created = datetime.now().strftime("%Y-%m-%d %H:%M")
+        memory_id = await Memory._writes.submit(lambda conn: conn.execute(
+            "INSERT INTO memories (content, author, created) VALUES (?, ?, ?)", (content, author, created)
+        ).lastrowid)
+        Memory.version += 1
+        return memory_id
+    
+    @staticmethod
+    def _get_all() -> list:
+        rows = Memory._db().execute("SELECT * FROM memories ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+    
+    @staticmethod
+    async def get_all() -> list:
+        """Get all memories"""
+        return await Storage.run(Memory._get_all, lane="memory")
+    
+    @staticmethod
+    def _get(memory_id: int) -> dict | None:
+        row = Memory._db().execute("SELECT * FROM memories WHERE id = ?", (memory_id,)).fetchone()
+        return dict(row) if row else None
+    
+    @staticmethod
+    async def get(memory_id: int) -> dict | None:
+        """Get a specific memory by ID"""
+        return await Storage.run(Memory._get, memory_id, lane="memory")
+    
+    @staticmethod
+    async def update(memory_id: int, new_content: str) -> bool:
+        """Update a memory's content, returns True if found"""
+        updated = datetime.now().strftime("%Y-%m-%d %H:%M")
+        found = await Memory._writes.submit(lambda conn: conn.execute(
+            "UPDATE memories SET content = ?, updated = ? WHERE id = ?", (new_content, updated, memory_id)
+        ).rowcount > 0)
+        Memory.version += 1
+        return found
+    
+    @staticmethod
+    async def delete(memory_id: int) -> bool:
+        """Delete a memory, returns True if found"""
+        def op(conn):
+            found = conn.execute("DELETE FROM memories WHERE id = ?", (memory_id,)).rowcount > 0
+            conn.execute("DELETE FROM memory_vectors WHERE id = ?", (memory_id,))
+            return found
+        found = await Memory._writes.submit(op)
+        Memory.version += 1
+        return found
+    
+    @staticmethod
+    def _count() -> int:
+        return Memory._db().execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+    
+    @staticmethod
+    async def count() -> int:
+        return await Storage.run(Memory._count, lane="memory")
+    
+    @staticmethod
+    def terms(text: str) -> list[str]:
+        """Search terms: lowercase words without stop words"""
+        return [word for word in re.findall(r"\w+", text.lower()) if len(word) > 1 and word not in Memory.STOP_WORDS]
+    
+    @staticmethod
+    def search(query: str, limit: int = 10) -> list[dict]:
+        """Keyword search, best match first (BM25 over FTS5, or term overlap without it)"""
+        terms = Memory.terms(query)
+        if not terms:
+            return []
+        conn = Memory._db()
+        
+        if Memory._fts:
+            match = " OR ".join(f'"{term}"' for term in dict.fromkeys(terms))
+            rows = conn.execute("""
+                SELECT memories.* FROM memories_fts
+                JOIN memories ON memories.id = memories_fts.rowid
+                WHERE memories_fts MATCH ?
+                ORDER BY bm25(memories_fts) LIMIT ?
+            """, (match, limit)).fetchall()
+            return [dict(row) for row in rows]
+        
+        wanted = set(terms)
+        scored = []
+        for row in conn.execute("SELECT * FROM memories"):
+            words = Memory.terms(row["content"])
+            score = sum(1 for word in words if word in wanted) / math.sqrt(len(words) or 1)
+            if score:
+                scored.append((score, row["id"], dict(row)))
+        scored.sort(key=lambda item: (-item[0], -item[1]))
+        return [mem for _, _, mem in scored[:limit]]
+    
+    @staticmethod
+    def _recall(query: str, limit: int) -> list[dict]:
+        keyword = Memory.search(query, limit * 2)
+        semantic = MemoryEmbeddings.search(query, limit * 2)
+        if not semantic:
+            return keyword[:limit]
+        
+        # Reciprocal rank fusion of the keyword and embedding rankings
+        scores: dict[int, float] = {}
+        for ranking in ([mem["id"] for mem in keyword], semantic):
+            for rank, memory_id in enumerate(ranking):
+                scores[memory_id] = scores.get(memory_id, 0.0) + 1 / (60 + rank)
+        best = sorted(scores, key=scores.get, reverse=True)[:limit]
+        found = {mem["id"]: mem for mem in keyword}
+        recalled = [found.get(memory_id) or Memory._get(memory_id) for memory_id in best]
+        return [mem for mem in recalled if mem]
+    
+    @staticmethod
+    async def recall(query: str, limit: int = MEMORY_TOP_K) -> list[dict]:
+        """Memories most relevant to a query, best first (keyword + optional semantic search)"""
+        # On the memory lane even with embeddings: the query encoding holds up only other memory
+        # operations, and the shared connection is never used from two threads
+        return await Storage.run(Memory._recall, query, limit, lane="memory")
+    
+    @staticmethod
+    async def get_context() -> str:
+        """Get all memories formatted for AI context"""
+        memories = await Memory.get_all()
+        if not memories:
+            return ""
+        
+        lines = [Memory.CONTEXT_HEADER]
+        for mem in memories:
+            lines.append(Memory.format_line(mem))
+        
+        return "\n".join(lines)
+    
+    CONTEXT_HEADER = "## Important Memories (marked with !imp):"
+    
+    @staticmethod
+    def format_line(mem: dict) -> str:
+        """One memory as it appears in AI context"""
+        return f"- [{mem['id']}] {mem['content']} (by {mem['author']}, {mem['created']})"
+
+
+
+class MemoryEmbeddings:
+    """Optional local embedding vectors for semantic memory recall (sentence-transformers).
+    
+    Vectors are stored in memory.db next to a digest of the text they were computed from, so
+    only new or edited memories are encoded; the in-memory matrix is rebuilt when Memory.version moves.
+    """
+    
+    _model = None
+    _loaded = False
+    _index: tuple | None = None  # (version, ids, matrix)
+    
+    @staticmethod
+    def model():
+        if not MemoryEmbeddings._loaded:
+            MemoryEmbeddings._loaded = True
+            if MEMORY_EMBEDDINGS:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    MemoryEmbeddings._model = SentenceTransformer(MEMORY_EMBEDDING_MODEL)
+                except ImportError:
+                    print("⚠️ memory_search.embeddings is on but sentence-transformers isn't installed - keyword search only")
+        return MemoryEmbeddings._model
+    
+    @staticmethod
+    def _refresh(model):
+        import numpy as np
+        
+        conn = Memory._db()
+        rows = conn.execute("""
+            SELECT memories.id, memories.content, memory_vectors.digest, memory_vectors.vector
+            FROM memories LEFT JOIN memory_vectors ON memory_vectors.id = memories.id
+            ORDER BY memories.id
+        """).fetchall()
+        
+        vectors = {}
+        stale = []
+        for row in rows:
+            digest = hashlib.sha1(row["content"].encode("utf-8")).hexdigest()
+            if row["digest"] == digest:
+                vectors[row["id"]] = np.frombuffer(row["vector"], dtype=np.float32)
+            else:
+                stale.append((row["id"], row["content"], digest))
+        
+        if stale:
+            encoded = model.encode([content for _, content, _ in stale], normalize_embeddings=True)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    "INSERT OR REPLACE INTO memory_vectors (id, digest, vector) VALUES (?, ?, ?)",
+                    [(memory_id, digest, np.asarray(vector, dtype=np.float32).tobytes())
+                     for (memory_id, _, digest), vector in zip(stale, encoded)]
+                )
+            for (memory_id, _, _), vector in zip(stale, encoded):
+                vectors[memory_id] = np.asarray(vector, dtype=np.float32)
+        
+        ids = list(vectors)
+        matrix = np.stack([vectors[memory_id] for memory_id in ids]) if ids else None
+        MemoryEmbeddings._index = (Memory.version, ids, matrix)
+    
+    @staticmethod
+    def search(query: str, limit: int = 10) -> list[int]:
+        """Memory IDs by cosine similarity to the query, best first ([] when embeddings are off)"""
+        model = MemoryEmbeddings.model()
+        if model is None:
+            return []
+        if MemoryEmbeddings._index is None or MemoryEmbeddings._index[0] != Memory.version:
+            MemoryEmbeddings._refresh(model)
+        
+        _, ids, matrix = MemoryEmbeddings._index
+        if matrix is None:
+            return []
+        scores = matrix @ model.encode([query], normalize_embeddings=True)[0]
+        best = scores.argsort()[::-1][:limit]
+        return [ids[i] for i in best]
+
+
+class TaskStore:
+    """Local record of !task tasks (SQLite, WAL mode) - the #task posts are only the view.
+    
+    A task's ID is the ID of its Discord message. reconcile() re-syncs with the channel after
+    downtime: task posts the store has never seen are imported, and active tasks whose post has
+    disappeared are marked removed. Database access runs on the "tasks" storage lane.
+    """
+    
+    TASK_DB = os.path.join(os.path.dirname(__file__), 'tasks.db')
+    TASK_HEADER = "📋 **New Task**"
+    STATUSES = ("active", "completed", "removed")
+    
+    _conn: sqlite3.Connection | None = None
+    
+    @staticmethod
+    def _db() -> sqlite3.Connection:
+        if TaskStore._conn is None:
+            conn = sqlite3.connect(TaskStore.TASK_DB, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    author TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'active',
+                    created TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    completed TEXT,
+                    completed_by TEXT,
+                    result TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_author ON tasks (author, status, created)")
+            TaskStore._conn = conn
+        return TaskStore._conn
+    
+    @staticmethod
+    async def _run(fn, *args):
+        return await Storage.run(fn, *args, lane="tasks")
+    
+    @staticmethod
+    def _add(rows: list[tuple]) -> int:
+        """Insert (id, description, author, content, created) rows not stored yet; returns how many were new"""
+        with TaskStore._db() as conn:
+            cursor = conn.executemany(
+                "INSERT OR IGNORE INTO tasks (id, description, author, created, content) VALUES (?, ?, ?, ?, ?)",
+                [(task_id, description, author, (created or discord.utils.utcnow()).strftime('%Y-%m-%d %H:%M'), content)
+                 for task_id, description, author, content, created in rows]
+            )
+        return cursor.rowcount
+    
+    @staticmethod
+    async def add(task_id: int, description: str, author: str, content: str, created: datetime = None):
+        await TaskStore._run(TaskStore._add, [(task_id, description, author, content, created)])
+    
+    @staticmethod
+    def _get(task_id: int) -> dict | None:
+        row = TaskStore._db().execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return dict(row) if row else None
+    
+    @staticmethod
+    async def get(task_id: int) -> dict | None:
+        return await TaskStore._run(TaskStore._get, task_id)
+    
+    @staticmethod
+    def _known(task_ids: list[int]) -> set[int]:
+        found = set()
+        for start in range(0, len(task_ids), 500):  # stay under SQLite's host-parameter limit
+            batch = task_ids[start:start + 500]
+            rows = TaskStore._db().execute(
+                f"SELECT id FROM tasks WHERE id IN ({','.join('?' * len(batch))})", tuple(batch)
+            ).fetchall()
+            found.update(row["id"] for row in rows)
+        return found
+    
+    @staticmethod
+    async def known(task_ids: list[int]) -> set[int]:
+        """The IDs among task_ids that are stored tasks"""
+        return await TaskStore._run(TaskStore._known, list(dict.fromkeys(task_ids)))
+    
+    @staticmethod
+    def _list(status: str | None, author: str | None, limit: int) -> list[dict]:
+        clauses, params = [], []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if author:
+            clauses.append("author = ? COLLATE NOCASE")
+            params.append(author)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = TaskStore._db().execute(
+            f"SELECT * FROM tasks {where} ORDER BY created DESC, id DESC LIMIT ?", (*params, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+    
+    @staticmethod
+    async def list(status: str | None = "active", author: str | None = None, limit: int = 25) -> list[dict]:
+        """Newest first; status None means any status"""
+        return await TaskStore._run(TaskStore._list, status, author, limit)
+    
+    @staticmethod
+    def _counts() -> dict[str, int]:
+        rows = TaskStore._db().execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+    
+    @staticmethod
+    async def counts() -> dict[str, int]:
+        return await TaskStore._run(TaskStore._counts)
+    
+    @staticmethod
+    async def complete(task_id: int, completed_by: str, result: str) -> bool:
+        """Mark an active task complete; False if it isn't active"""
+        return await TaskStore._run(TaskStore._complete, task_id, completed_by, result)
+    
+    @staticmethod
+    def _complete(task_id: int, completed_by: str, result: str) -> bool:
+        with TaskStore._db() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'completed', completed = ?, completed_by = ?, result = ? "
+                "WHERE id = ? AND status = 'active'",
+                (discord.utils.utcnow().strftime('%Y-%m-%d %H:%M'), completed_by, result, task_id)
+            )
+        return cursor.rowcount > 0
+    
+    @staticmethod
+    async def mark_removed(task_ids: set[int]) -> int:
+        """Active tasks whose post was deleted by hand"""
+        return await TaskStore._run(TaskStore._mark_removed, task_ids)
+    
+    @staticmethod
+    def _mark_removed(task_ids: set[int]) -> int:
+        if not task_ids:
+            return 0
+        with TaskStore._db() as conn:
+            cursor = conn.execute(
+                f"UPDATE tasks SET status = 'removed' WHERE status = 'active' AND id IN ({','.join('?' * len(task_ids))})",
+                tuple(task_ids)
+            )
+        return cursor.rowcount
+    
+    @staticmethod
+    def parse_post(content: str) -> tuple[str, str]:
+        """(author, description) from a task post's text"""
+        author, description = "unknown", content
+        lines = content.split("\n")
+        for i, line in enumerate(lines):
+            if line.startswith("Created by: "):
+                author = line[len("Created by: "):].strip()
+                description = "\n".join(lines[i + 1:])
+                break
+        description = description.rsplit("\n\nStatus:", 1)[0].strip()
+        return author, description
+    
+    @staticmethod
+    async def reconcile(channel, bot_user, limit: int = 1000) -> tuple[int, int]:
+        """Sync with the #task channel; returns (imported, marked removed)"""
+        posts = []
+        scanned = 0
+        async for message in channel.history(limit=limit):
+            scanned += 1
+            if message.author != bot_user or not message.content.startswith(TaskStore.TASK_HEADER):
+                continue
+            author, description = TaskStore.parse_post(message.content)
+            posts.append((message.id, description, author, message.content, message.created_at))
+        
+        # One trip to the database for the whole scan
+        return await TaskStore._run(TaskStore._reconcile, posts, scanned < limit)
+    
+    @staticmethod
+    def _reconcile(posts: "list[tuple]", complete_scan: bool) -> tuple[int, int]:
+        imported = TaskStore._add(posts)
+        removed = 0
+        if complete_scan:
+            # The whole channel was scanned, so an active task without a post really is gone
+            active = {row["id"] for row in TaskStore._db().execute("SELECT id FROM tasks WHERE status = 'active'")}
+            removed = TaskStore._mark_removed(active - {post[0] for post in posts})
+        return imported, removed
+
+
+class PromptCache:
+    """In-memory cache of prompt files, invalidated by a stat (mtime/size) check"""
+    
+    # path -> (mtime_ns, size, content)
+    _entries: dict[str, tuple[int, int, str]] = {}
+    
+    @staticmethod
+    def read(filepath: str) -> str | None:
+        """Return file contents, re-reading only if the file changed on disk. None if missing."""
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            PromptCache._entries.pop(filepath, None)
+            return None
+        
+        cached = PromptCache._entries.get(filepath)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except FileNotFoundError:
+            PromptCache._entries.pop(filepath, None)
+            return None
+        
+        PromptCache._entries[filepath] = (stat.st_mtime_ns, stat.st_size, content)
+        return content
+    
+    @staticmethod
+    def clear():
+        """Drop all cached files"""
+        PromptCache._entries.clear()
+
+
+class TokenCounter:
+    """Local token counting (tiktoken if installed, otherwise ~4 chars per token), memoized per text"""
+    
+    _encoding = None
+    _encoding_loaded = False
+    _counts: "OrderedDict[str, int]" = OrderedDict()
+    MAX_MEMOIZED = 4096
+    
+    @staticmethod
+    def _get_encoding():
+        """tiktoken's encoding, imported on first use (None if tiktoken isn't installed)"""
+        if not TokenCounter._encoding_loaded:
+            TokenCounter._encoding_loaded = True
+            try:
+                import tiktoken  # optional - exact token counts for context budgeting
+                TokenCounter._encoding = tiktoken.get_encoding("cl100k_base")
+            except ImportError:
+                TokenCounter._encoding = None
+        return TokenCounter._encoding
+    
+    @staticmethod
+    def count(text: str) -> int:
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+        cached = TokenCounter._counts.get(key)
+        if cached is not None:
+            TokenCounter._counts.move_to_end(key)
+            return cached
+        
+        encoding = TokenCounter._get_encoding()
+        if encoding is not None:
+            tokens = len(encoding.encode(text, disallowed_special=()))
+        else:
+            tokens = (len(text) + 3) // 4
+        
+        TokenCounter._counts[key] = tokens
+        if len(TokenCounter._counts) > TokenCounter.MAX_MEMOIZED:
+            TokenCounter._counts.popitem(last=False)
+        return tokens
+    
+    @staticmethod
+    def truncate(text: str, max_tokens: int) -> str:
+        """Cut text (at a line boundary where possible) so it fits in max_tokens"""
+        if TokenCounter.count(text) <= max_tokens:
+            return text
+        marker = "\n[... truncated to fit context budget ...]"
+        budget = max_tokens - TokenCounter.count(marker)
+        if budget <= 0:
+            return ""
+        
+        cut = len(text)
+        while cut > 0:
+            cut = int(cut * budget / max(TokenCounter.count(text[:cut]), 1) * 0.95)
+            newline = text.rfind("\n", 0, cut)
+            if newline > cut // 2:
+                cut = newline
+            if TokenCounter.count(text[:cut]) <= budget:
+                return text[:cut] + marker
+        return ""
+
+
+def context_budget(*models: str) -> int:
+    """Project-context token budget for a call; the smallest budget wins when several models share one context"""
+    budgets = [MODEL_CONTEXT_BUDGETS.get(model, DEFAULT_CONTEXT_BUDGET) for model in models]
+    return min(budgets) if budgets else DEFAULT_CONTEXT_BUDGET
+
+
+@dataclass
+class CachedMessage:
+    """The parts of a Discord message the bot reads back as history"""
+    id: int
+    author: str
+    bot: bool
+    content: str
+    created_at: datetime
+    
+    @staticmethod
+    def from_message(message) -> "CachedMessage":
+        return CachedMessage(message.id, message.author.name, message.author.bot, message.content, message.created_at)
+
+
+class ChannelHistory:
+    """Per-channel ring buffers of recent messages, kept current by gateway events.
+    
+    Warmed once at on_ready; reading a channel that was never warmed falls back to a REST
+    fetch (which then warms it), so context assembly is normally a memory read.
+    """
     
-    MEMORY_FILE = os.path.join(os.path.dirname(__file__), 'memory.json')
+    _buffers: dict[int, deque] = {}
+    _warm: set[int] = set()
     
     @staticmethod
-    def _load() -> dict:
-        """Load memories from JSON file"""
-        try:
-            with open(Memory.MEMORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {"memories": [], "next_id": 1}
+    def _buffer(channel_id: int) -> deque:
+        if channel_id not in ChannelHistory._buffers:
+            ChannelHistory._buffers[channel_id] = deque(maxlen=HISTORY_CACHE_SIZE)
+        return ChannelHistory._buffers[channel_id]
     
     @staticmethod
-    def _save(data: dict):
-        """Save memories to JSON file"""
-        with open(Memory.MEMORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+    def record(message):
+        """New message seen on the gateway"""
+        ChannelHistory._buffer(message.channel.id).append(CachedMessage.from_message(message))
     
     @staticmethod
-    def add(content: str, author: str) -> int:
-        """Add a new memory and return its ID"""
-        data = Memory._load()
-        memory_id = data["next_id"]
-        data["memories"].append({
-            "id": memory_id,
-            "content": content,
-            "author": author,
-            "created": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "updated": None
-        })
-        data["next_id"] = memory_id + 1
-        Memory._save(data)
-        return memory_id
+    def edit(channel_id: int, message_id: int, content: str):
+        for cached in reversed(ChannelHistory._buffers.get(channel_id, ())):
+            if cached.id == message_id:
+                cached.content = content
+                return
     
     @staticmethod
-    def get_all() -> list:
-        """Get all memories"""
-        return Memory._load()["memories"]
+    def remove(channel_id: int, message_ids: set[int]):
+        buffer = ChannelHistory._buffers.get(channel_id)
+        if buffer and any(cached.id in message_ids for cached in buffer):
+            kept = [cached for cached in buffer if cached.id not in message_ids]
+            buffer.clear()
+            buffer.extend(kept)
     
     @staticmethod
-    def get(memory_id: int) -> dict | None:
-        """Get a specific memory by ID"""
-        data = Memory._load()
-        for mem in data["memories"]:
-            if mem["id"] == memory_id:
-                return mem
-        return None
+    async def warm(channel):
+        """Fill a channel's buffer from the REST API, merging with anything recorded meanwhile"""
+        fetched = [CachedMessage.from_message(msg) async for msg in channel.history(limit=HISTORY_CACHE_SIZE)]
+        buffer = ChannelHistory._buffer(channel.id)
+        merged = {cached.id: cached for cached in fetched}
+        merged.update((cached.id, cached) for cached in buffer)
+        buffer.clear()
+        buffer.extend(sorted(merged.values(), key=lambda cached: cached.id))  # snowflakes sort by time
+        ChannelHistory._warm.add(channel.id)
     
     @staticmethod
-    def update(memory_id: int, new_content: str) -> bool:
-        """Update a memory's content, returns True if found"""
-        data = Memory._load()
-        for mem in data["memories"]:
-            if mem["id"] == memory_id:
-                mem["content"] = new_content
-                mem["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-                Memory._save(data)
-                return True
-        return False
+    async def recent(channel, limit: int) -> list[CachedMessage]:
+        """Most recent `limit` messages, newest first (like channel.history)"""
+        if channel.id not in ChannelHistory._warm or limit > HISTORY_CACHE_SIZE:
+            if limit > HISTORY_CACHE_SIZE:
+                return [CachedMessage.from_message(msg) async for msg in channel.history(limit=limit)]
+            await ChannelHistory.warm(channel)
+        
+        buffer = ChannelHistory._buffers[channel.id]
+        return list(itertools.islice(reversed(buffer), limit))
+
+
+class PromptIndex:
+    """Heading-level chunks of the prompts/ tree in a persisted FTS5 index (prompt_index.db).
+    
+    Files are re-chunked only when their mtime/size change, so the index stays current without
+    rebuilding. retrieve() returns the best-matching sections under a token budget, grouped by
+    file in CONTEXT_FILES order.
+    """
+    
+    INDEX_DB = os.path.join(os.path.dirname(__file__), 'prompt_index.db')
+    HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+    
+    _conn: sqlite3.Connection | None = None
+    _fts = False
+    _lock = threading.Lock()  # retrieve() runs on the storage pool; one refresh at a time
     
     @staticmethod
-    def delete(memory_id: int) -> bool:
-        """Delete a memory, returns True if found"""
-        data = Memory._load()
-        for i, mem in enumerate(data["memories"]):
-            if mem["id"] == memory_id:
-                data["memories"].pop(i)
-                Memory._save(data)
-                return True
-        return False
+    def _db() -> sqlite3.Connection:
+        if PromptIndex._conn is None:
+            conn = sqlite3.connect(PromptIndex.INDEX_DB, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    path TEXT NOT NULL,
+                    ordinal INTEGER NOT NULL,
+                    heading TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    tokens INTEGER NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path, ordinal)")
+            try:
+                conn.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts
+                    USING fts5(heading, text, content='chunks', content_rowid='id', tokenize='porter unicode61')
+                """)
+                conn.executescript("""
+                    CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+                        INSERT INTO chunks_fts (rowid, heading, text) VALUES (new.id, new.heading, new.text);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+                        INSERT INTO chunks_fts (chunks_fts, rowid, heading, text) VALUES ('delete', old.id, old.heading, old.text);
+                    END;
+                """)
+                PromptIndex._fts = True
+            except sqlite3.OperationalError as e:
+                print(f"⚠️ SQLite FTS5 unavailable ({e}) - prompt retrieval falls back to a scan")
+            PromptIndex._conn = conn
+        return PromptIndex._conn
     
     @staticmethod
-    def get_context() -> str:
-        """Get all memories formatted for AI context"""
-        memories = Memory.get_all()
-        if not memories:
-            return ""
+    def chunk(text: str) -> list[tuple[str, str]]:
+        """Split markdown into (heading path, section text) at every heading"""
+        sections = []
+        trail: list[tuple[int, str]] = []
+        heading, lines = "", []
+        in_fence = False
+        for line in text.split("\n"):
+            if line.lstrip().startswith("```"):
+                in_fence = not in_fence
+            match = None if in_fence else PromptIndex.HEADING.match(line)
+            if match:
+                if "\n".join(lines).strip():
+                    sections.append((heading, "\n".join(lines).strip()))
+                level = len(match.group(1))
+                trail = [(lvl, title) for lvl, title in trail if lvl < level] + [(level, match.group(2).strip())]
+                heading = " › ".join(title for _, title in trail)
+                lines = [line]
+            else:
+                lines.append(line)
+        if "\n".join(lines).strip():
+            sections.append((heading, "\n".join(lines).strip()))
+        return sections
+    
+    @staticmethod
+    def _sources() -> dict[str, os.stat_result]:
+        """Indexable .md files - CONTEXT_FILES plus RETRIEVAL_INCLUDE - keyed by path relative to prompts/.
         
-        lines = ["## Important Memories (marked with !imp):"]
-        for mem in memories:
-            lines.append(f"- [{mem['id']}] {mem['content']} (by {mem['author']}, {mem['created']})")
+        Everything else under prompts/ (templates/, architecture.md, ...) was never project context
+        and stays out of the index.
+        """
+        root = ProjectContext.PROMPTS_DIR
+        candidates = []
+        for entry in [*ProjectContext.CONTEXT_FILES, *RETRIEVAL_INCLUDE]:
+            full = os.path.join(root, entry)
+            if os.path.isdir(full):
+                for directory, _, filenames in os.walk(full):
+                    candidates.extend(os.path.join(directory, name) for name in sorted(filenames) if name.endswith(".md"))
+            else:
+                candidates.append(full)
         
-        return "\n".join(lines)
+        found = {}
+        for full in candidates:
+            path = os.path.relpath(full, root).replace(os.sep, "/")
+            if path in RETRIEVAL_EXCLUDE or path in found:
+                continue
+            try:
+                found[path] = os.stat(full)
+            except OSError:
+                continue
+        return found
+    
+    @staticmethod
+    def refresh() -> int:
+        """Re-chunk new or changed files and drop deleted ones; returns the number of files re-indexed"""
+        conn = PromptIndex._db()
+        indexed = {row["path"]: (row["mtime_ns"], row["size"]) for row in conn.execute("SELECT * FROM sources")}
+        current = PromptIndex._sources()
+        
+        changed = [path for path, st in current.items() if indexed.get(path) != (st.st_mtime_ns, st.st_size)]
+        removed = [path for path in indexed if path not in current]
+        if not changed and not removed:
+            return 0
+        
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for path in removed + changed:
+                conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+                conn.execute("DELETE FROM sources WHERE path = ?", (path,))
+            for path in changed:
+                content = ProjectContext.load_prompt_file(path)
+                conn.executemany(
+                    "INSERT INTO chunks (path, ordinal, heading, text, tokens) VALUES (?, ?, ?, ?, ?)",
+                    [(path, i, heading, text, TokenCounter.count(text))
+                     for i, (heading, text) in enumerate(PromptIndex.chunk(content))]
+                )
+                st = current[path]
+                conn.execute("INSERT INTO sources (path, mtime_ns, size) VALUES (?, ?, ?)",
+                             (path, st.st_mtime_ns, st.st_size))
+        return len(changed) + len(removed)
+    
+    @staticmethod
+    def _ranked(query: str, limit: int) -> list[sqlite3.Row]:
+        terms = Memory.terms(query)
+        if not terms:
+            return []
+        conn = PromptIndex._db()
+        if PromptIndex._fts:
+            match = " OR ".join(f'"{term}"' for term in dict.fromkeys(terms))
+            return conn.execute("""
+                SELECT chunks.* FROM chunks_fts JOIN chunks ON chunks.id = chunks_fts.rowid
+                WHERE chunks_fts MATCH ? ORDER BY bm25(chunks_fts, 2.0, 1.0) LIMIT ?
+            """, (match, limit)).fetchall()
+        
+        wanted = set(terms)
+        scored = []
+        for row in conn.execute("SELECT * FROM chunks"):
+            words = Memory.terms(row["heading"] + " " + row["text"])
+            score = sum(1 for word in words if word in wanted) / math.sqrt(len(words) or 1)
+            if score:
+                scored.append((score, row["id"], row))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [row for _, _, row in scored[:limit]]
+    
+    @staticmethod
+    def retrieve(query: str, max_tokens: int) -> list[str]:
+        """Pinned files whole, then the best-matching sections that fit, as one text per file"""
+        with PromptIndex._lock:
+            PromptIndex.refresh()
+        remaining = max_tokens
+        selected: dict[str, list[tuple[int, str]]] = {}
+        
+        for path in RETRIEVAL_PINNED:
+            content = ProjectContext.load_prompt_file(path)
+            cost = TokenCounter.count(content)
+            if content and cost <= remaining:
+                selected[path] = [(-1, content)]
+                remaining -= cost
+        
+        for row in PromptIndex._ranked(query, 50):
+            if row["path"] in RETRIEVAL_PINNED or row["tokens"] > remaining:
+                continue
+            selected.setdefault(row["path"], []).append((row["ordinal"], row["text"]))
+            remaining -= row["tokens"]
+        
+        # Stable order (CONTEXT_FILES priority, then path, then position) so equal selections share a cache prefix
+        priority = {filename: i for i, filename in enumerate(ProjectContext.CONTEXT_FILES)}
+        files = []
+        for path in sorted(selected, key=lambda p: (priority.get(p, len(priority)), p)):
+            sections = [text for _, text in sorted(selected[path])]
+            files.append(f"[{path}]\n" + "\n\n".join(sections))
+        return files
 
 
 class ProjectContext:
@@ -209,77 +2274,655 @@ class ProjectContext:
     
     @staticmethod
     def load_prompt_file(filename: str) -> str:
-        """Load a single prompt file"""
+        """Load a single prompt file (blocking - use load_prompt_files() from coroutines)"""
         filepath = os.path.join(ProjectContext.PROMPTS_DIR, filename)
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
-            return ""
+        content = PromptCache.read(filepath)
+        return content if content is not None else ""
     
     @staticmethod
-    async def get_channel_history(channel, limit: int = 10) -> str:
-        """Fetch recent messages from a Discord channel for conversation context"""
+    async def load_prompt_files(filenames: list[str]) -> list[str]:
+        """Load several prompt files in one trip to the storage pool"""
+        def load():
+            return [ProjectContext.load_prompt_file(filename) for filename in filenames]
+        return await Storage.run(load)
+    
+    HISTORY_HEADER = "## Recent Conversation:"
+    
+    @staticmethod
+    async def get_channel_messages(channel, limit: int = 10) -> list[str]:
+        """Recent messages from a Discord channel formatted for context, oldest first"""
         if not channel:
-            return ""
+            return []
         
         messages = []
+        # The command being answered is already the query - don't repeat it as history
+        answering = (current_request.get() or {}).get("message_id")
         try:
-            async for msg in channel.history(limit=limit):
+            for msg in await ChannelHistory.recent(channel, limit):
                 # Skip empty messages and bot's own status messages
-                if msg.content and not msg.content.startswith(('🧠', '💬', '⚡', '🔀', '🏗️', '📚', '🔄', '📎', '✅', '❌')):
+                if msg.content and msg.id != answering and not msg.content.startswith(('🧠', '💬', '⚡', '🔀', '🏗️', '📚', '🔄', '📎', '✅', '❌')):
                     # Truncate long messages to save tokens
                     content = msg.content[:500] + "..." if len(msg.content) > 500 else msg.content
-                    author = "Bot" if msg.author.bot else msg.author.name
+                    author = "Bot" if msg.bot else msg.author
                     messages.append(f"[{author}]: {content}")
             
             # Reverse to get chronological order
             messages.reverse()
-            
-            if messages:
-                return "## Recent Conversation:\n" + "\n\n".join(messages)
         except Exception as e:
             print(f"Could not fetch channel history: {e}")
         
+        return messages
+    
+    @staticmethod
+    async def get_channel_history(channel, limit: int = 10) -> str:
+        """Fetch recent messages from a Discord channel for conversation context"""
+        messages = await ProjectContext.get_channel_messages(channel, limit)
+        if messages:
+            return ProjectContext.HISTORY_HEADER + "\n" + "\n\n".join(messages)
         return ""
+    
+    @staticmethod
+    async def get_full_context(bot, channel=None, budget: int = None, query: str = None,
+                               full_canon: bool = False) -> "ContextBundle":
+        """Load context from local prompt files, memories, and optionally channel history,
+        fitted to a token budget (see context_budget). With a query, only the MEMORY_TOP_K
+        memories and (once CONTEXT_FILES outgrow RETRIEVAL_ABOVE_TOKENS) the prompts/ sections
+        most relevant to it are included; full_canon always sends CONTEXT_FILES whole."""
+        started = time.perf_counter()
+        files = await ProjectContext.load_prompt_files(ProjectContext.CONTEXT_FILES)
+        if query and not full_canon and RETRIEVAL_ENABLED:
+            if sum(TokenCounter.count(content) for content in files) > RETRIEVAL_ABOVE_TOKENS:
+                files = await Storage.run(PromptIndex.retrieve, query, min(RETRIEVAL_TOKENS, budget or context_budget()))
+        if query and await Memory.count() > MEMORY_TOP_K:
+            # Least relevant first - the assembler drops from the front when over budget
+            memories = [Memory.format_line(mem) for mem in reversed(await Memory.recall(query))]
+        else:
+            memories = [Memory.format_line(mem) for mem in await Memory.get_all()]
+        history = await ProjectContext.get_channel_messages(channel) if channel else []
+        
+        bundle = ContextAssembler.assemble(files, memories, history, budget or context_budget())
+        Metrics.observe("context_assembly_seconds", time.perf_counter() - started)
+        return bundle
+
 
+class ContextBundle(str):
+    """Project context text that also remembers its stable and volatile parts.
+    
+    `static` (prompt files) is identical across calls and goes into the cacheable system
+    prefix; `volatile` (memories, channel history) goes after it with the query. `memories` and
+    `history` are the memory and history sections of `volatile` on their own.
+    """
+    
+    def __new__(cls, static: str, volatile: str, memories: str = "", history: str = ""):
+        text = ContextAssembler.SEPARATOR.join(part for part in (static, volatile) if part)
+        bundle = super().__new__(cls, text or "No project context available.")
+        bundle.static = static
+        bundle.volatile = volatile
+        bundle.memories = memories
+        bundle.history = history
+        return bundle
+
+
+def split_context(project_context: str | None) -> tuple[str, str]:
+    """(static, volatile) parts of a project context; plain strings are treated as all static"""
+    if isinstance(project_context, ContextBundle):
+        return project_context.static, project_context.volatile
+    return project_context or "", ""
+
+
+def response_context(project_context: str | None) -> str:
+    """The parts of a project context that decide a response - prompt files, memories and a digest
+    of the channel history that was sent, so a follow-up like "why?" only matches the same
+    conversation"""
+    if isinstance(project_context, ContextBundle):
+        history = hashlib.sha256(project_context.history.encode()).hexdigest() if project_context.history else ""
+        return "\0".join((project_context.static, project_context.memories, history))
+    return str(project_context or "")
+
+
+class ContextAssembler:
+    """Fits project context into a token budget.
+    
+    Sections are filled in priority order - prompt files (CONTEXT_FILES order), then memories,
+    then channel history. Memories and history keep their newest items; the oldest are dropped
+    first. Results are cached, so unchanged inputs are not re-tokenized.
+    """
+    
+    SEPARATOR = "\n\n---\n\n"
+    _results: "OrderedDict[tuple, ContextBundle]" = OrderedDict()
+    MAX_CACHED = 32
+    
+    @staticmethod
+    def assemble(files: list[str], memories: list[str], history: list[str], budget: int) -> "ContextBundle":
+        key = (
+            tuple(hash(item) for item in files),
+            tuple(hash(item) for item in memories),
+            tuple(hash(item) for item in history),
+            budget,
+        )
+        cached = ContextAssembler._results.get(key)
+        if cached is not None:
+            ContextAssembler._results.move_to_end(key)
+            return cached
+        
+        result = ContextAssembler._assemble(files, memories, history, budget)
+        ContextAssembler._results[key] = result
+        if len(ContextAssembler._results) > ContextAssembler.MAX_CACHED:
+            ContextAssembler._results.popitem(last=False)
+        return result
     
     @staticmethod
-    async def get_full_context(bot, channel=None) -> str:
-        """Load all context from local prompt files, memories, and optionally include channel history"""
+    def _assemble(files: list[str], memories: list[str], history: list[str], budget: int) -> "ContextBundle":
+        count = TokenCounter.count
+        separator_cost = count(ContextAssembler.SEPARATOR)
+        remaining = budget
         context_parts = []
+        volatile_parts = []
+        
+        # 1. Prompt files, in priority order (the first one that doesn't fit is truncated)
+        for content in files:
+            if not content:
+                continue
+            cost = count(content) + separator_cost
+            if cost > remaining:
+                content = TokenCounter.truncate(content, remaining - separator_cost)
+                if content:
+                    context_parts.append(content)
+                remaining = 0
+                break
+            context_parts.append(content)
+            remaining -= cost
+        
+        # 2. Memories, then 3. history: newest first while they fit, shown in original order
+        for header, items, joiner in ((Memory.CONTEXT_HEADER, memories, "\n"),
+                                      (ProjectContext.HISTORY_HEADER, history, "\n\n")):
+            if not items:
+                continue
+            section_cost = count(header) + separator_cost
+            if section_cost >= remaining:
+                break
+            remaining -= section_cost
+            
+            kept = []
+            for item in reversed(items):
+                cost = count(item) + 1
+                if cost > remaining:
+                    break
+                kept.append(item)
+                remaining -= cost
+            if kept:
+                kept.reverse()
+                volatile_parts.append(header + "\n" + joiner.join(kept))
+        
+        memory_parts = [part for part in volatile_parts if part.startswith(Memory.CONTEXT_HEADER)]
+        history_parts = [part for part in volatile_parts if part.startswith(ProjectContext.HISTORY_HEADER)]
+        return ContextBundle(
+            ContextAssembler.SEPARATOR.join(context_parts),
+            ContextAssembler.SEPARATOR.join(volatile_parts),
+            memory_parts[0] if memory_parts else "",
+            history_parts[0] if history_parts else "",
+        )
+
+
+class ResponseCache:
+    """Two-tier (memory LRU + SQLite) cache of agent responses.
+    
+    Keyed on (agent, model, mode, normalized query, hash of the prompt files, memories and channel
+    history in the project context - see response_context()). Queries that
+    differ only slightly can also hit via a MinHash near-duplicate lookup within the same
+    (agent, model, mode, context) bucket.
+    """
+    
+    CACHE_DB = os.path.join(os.path.dirname(__file__), 'response_cache.db')
+    NUM_PERM = 64
+    _PRIME = (1 << 61) - 1
+    _PERMS = [(random.Random(i).randrange(1, (1 << 61) - 1), random.Random(-i - 1).randrange(0, (1 << 61) - 1))
+              for i in range(NUM_PERM)]
+    
+    # key -> (expires_at, text, bucket, signature)
+    _memory: "OrderedDict[str, tuple[float, str, str, tuple | None]]" = OrderedDict()
+    _conn: sqlite3.Connection | None = None
+    hits = 0
+    near_hits = 0
+    misses = 0
+    
+    @staticmethod
+    def _db() -> sqlite3.Connection:
+        if ResponseCache._conn is None:
+            conn = sqlite3.connect(ResponseCache.CACHE_DB, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    bucket TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    signature BLOB,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_bucket ON responses (bucket)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)")
+            ResponseCache._conn = conn
+        return ResponseCache._conn
+    
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Case/whitespace-insensitive form of a query"""
+        return " ".join(query.lower().split()).rstrip("?.! ")
+    
+    @staticmethod
+    def keys(agent: str, model: str, mode: str, query: str, project_context: str) -> tuple[str, str]:
+        """Return (exact key, near-duplicate bucket)"""
+        context_hash = hashlib.sha256(response_context(project_context).encode()).hexdigest()
+        bucket = hashlib.sha256(f"{agent}\0{model}\0{mode}\0{context_hash}".encode()).hexdigest()
+        key = hashlib.sha256(f"{bucket}\0{ResponseCache.normalize(query)}".encode()).hexdigest()
+        return key, bucket
+    
+    @staticmethod
+    def signature(query: str) -> tuple | None:
+        """MinHash signature over word 3-shingles (None for queries too long to be worth it)"""
+        words = re.findall(r"\w+", query.lower())
+        if not words or len(words) > 2000:
+            return None
+        shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+        hashes = [int.from_bytes(hashlib.blake2b(sh.encode(), digest_size=8).digest(), "big") for sh in shingles]
+        prime = ResponseCache._PRIME
+        return tuple(min((a * h + b) % prime for h in hashes) for a, b in ResponseCache._PERMS)
+    
+    @staticmethod
+    def similarity(sig_a: tuple, sig_b: tuple) -> float:
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+    
+    @staticmethod
+    async def get(agent: str, model: str, mode: str, query: str, project_context: str) -> str | None:
+        key, bucket = ResponseCache.keys(agent, model, mode, query, project_context)
+        now = time.time()
+        
+        # 1. In-memory exact hit
+        entry = ResponseCache._memory.get(key)
+        if entry and entry[0] > now:
+            ResponseCache._memory.move_to_end(key)
+            ResponseCache.hits += 1
+            return entry[1]
+        
+        # 2./3. On disk, off the event loop
+        found = await Storage.run(ResponseCache._get_disk, key, bucket, query, now, lane="response_cache")
+        if found is None:
+            ResponseCache.misses += 1
+            return None
+        text, exact, expires, signature = found
+        if exact:
+            ResponseCache._remember(key, expires, text, bucket, signature)  # promoted to memory
+            ResponseCache.hits += 1
+        else:
+            ResponseCache.near_hits += 1
+        return text
+    
+    @staticmethod
+    def _get_disk(key: str, bucket: str, query: str, now: float) -> tuple | None:
+        """(text, exact, expires, signature) for an exact or near-duplicate row on disk"""
+        conn = ResponseCache._db()
+        row = conn.execute("SELECT text, signature, expires FROM responses WHERE key = ? AND expires > ?", (key, now)).fetchone()
+        if row:
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return row[0], True, row[2], tuple(json.loads(row[1])) if row[1] else None
+        
+        # Near-duplicate query in the same bucket
+        if RESPONSE_CACHE_NEAR_DUPLICATE:
+            signature = ResponseCache.signature(query)
+            if signature:
+                rows = conn.execute(
+                    "SELECT key, text, signature FROM responses WHERE bucket = ? AND expires > ? AND signature IS NOT NULL",
+                    (bucket, now)
+                ).fetchall()
+                best = max(rows, key=lambda r: ResponseCache.similarity(signature, json.loads(r[2])), default=None)
+                if best and ResponseCache.similarity(signature, json.loads(best[2])) >= RESPONSE_CACHE_SIMILARITY:
+                    conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, best[0]))
+                    return best[1], False, None, None
+        return None
+    
+    @staticmethod
+    async def put(agent: str, model: str, mode: str, query: str, project_context: str, text: str):
+        key, bucket = ResponseCache.keys(agent, model, mode, query, project_context)
+        now = time.time()
+        expires = now + RESPONSE_CACHE_TTL
+        signature = ResponseCache.signature(query) if RESPONSE_CACHE_NEAR_DUPLICATE else None
+        
+        ResponseCache._remember(key, expires, text, bucket, signature)
+        await Storage.run(ResponseCache._put_disk, key, bucket, text, signature, expires, now, lane="response_cache")
+    
+    @staticmethod
+    def _put_disk(key: str, bucket: str, text: str, signature: tuple | None, expires: float, now: float):
+        conn = ResponseCache._db()
+        size = len(text.encode("utf-8"))
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, bucket, text, signature, expires, accessed, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, bucket, text, json.dumps(signature) if signature else None, expires, now, size)
+            )
+            conn.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+            # Evict least recently used rows beyond the disk budget
+            total = conn.execute("SELECT IFNULL(SUM(size), 0) FROM responses").fetchone()[0]
+            budget = RESPONSE_CACHE_MAX_DISK_MB * 1024 * 1024
+            if total > budget:
+                for old_key, old_size in conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                    if total <= budget:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= old_size
+    
+    @staticmethod
+    def _remember(key: str, expires: float, text: str, bucket: str, signature: tuple | None):
+        ResponseCache._memory[key] = (expires, text, bucket, signature)
+        ResponseCache._memory.move_to_end(key)
+        while len(ResponseCache._memory) > RESPONSE_CACHE_MAX_ENTRIES:
+            ResponseCache._memory.popitem(last=False)
+    
+    @staticmethod
+    def enabled() -> bool:
+        """False when caching is off or the current command was run through !nocache"""
+        request = current_request.get() or {}
+        return RESPONSE_CACHE_ENABLED and not request.get("no_cache")
+
+
+class SingleFlight:
+    """Shares one provider call between concurrent requests with the same cache key.
+    
+    The key is ResponseCache's exact key, so it covers the prompt files, memories and a digest of
+    the channel history that was sent - requests only share a call when their prompts match.
+    
+    The first request starts the call in its own task, so a requester giving up does not cancel
+    it for the others. Deltas are kept as they arrive: later requests replay them and then
+    follow along live, so streamed replies still stream for everyone.
+    """
+    
+    _flights: dict[str, "SingleFlight"] = {}
+    
+    def __init__(self, key: str):
+        self.key = key
+        self.parts: list[str] = []
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+    
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    def _finished(self, task: asyncio.Task):
+        if SingleFlight._flights.get(self.key) is self:
+            del SingleFlight._flights[self.key]
+        self._notify()
+    
+    @staticmethod
+    def start(key: str, deltas, on_done, shared: bool = True) -> "SingleFlight":
+        """Run the deltas generator once; on_done(text) is awaited with the full text on success
+        (unless a fallback model answered). Only shared flights can be joined by other requests."""
+        flight = SingleFlight(key)
+        
+        async def pump():
+            async for delta in deltas:
+                flight.parts.append(delta)
+                flight._notify()
+            if not (flight.parts and isinstance(flight.parts[0], FallbackText)):
+                await on_done("".join(flight.parts))
+        
+        flight.task = asyncio.create_task(pump())
+        flight.task.add_done_callback(flight._finished)
+        if RESPONSE_COALESCE and shared:
+            SingleFlight._flights[key] = flight
+        return flight
+    
+    @staticmethod
+    def join(key: str, agent: str, mode: str) -> "SingleFlight | None":
+        flight = SingleFlight._flights.get(key)
+        if flight:
+            Metrics.inc("coalesced_requests_total", agent=agent)
+            print(f"🔗 Joined identical in-flight request ({agent}/{mode})")
+        return flight
+    
+    async def follow(self):
+        """Yield every delta so far, then new ones as they arrive"""
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.parts):
+                index += 1
+                yield self.parts[index - 1]
+            if self.task.done():
+                break
+            await changed.wait()
+        if not self.task.cancelled() and self.task.exception():
+            raise self.task.exception()
+    
+    async def result(self) -> str:
+        await asyncio.shield(self.task)
+        return "".join(self.parts)
+
+
+def _response_flight(agent: str, model: str, mode: str, query: str, project_context: str, deltas) -> SingleFlight:
+    """Join the in-flight request for this key, or start one that caches its result"""
+    # Same key as the response cache (history digest included), so a flight only ever hands its
+    # answer to requests the cache would have answered with it
+    key, _ = ResponseCache.keys(agent, model, mode, query, project_context)
+    flight = SingleFlight.join(key, agent, mode)
+    if flight:
+        return flight  # deltas was never started, so there is nothing to close
+    
+    async def store(text: str):
+        if RESPONSE_CACHE_ENABLED and text:
+            await ResponseCache.put(agent, model, mode, query, project_context, text)
+    
+    # A downgraded request may join a full-price flight, but its own cheaper answer is not
+    # handed to anyone else under this model's key
+    downgraded = (current_request.get() or {}).get("downgrade", False)
+    return SingleFlight.start(key, deltas, store, shared=not downgraded)
+
+
+async def cached_response(agent: str, model: str, mode: str, query: str, project_context: str, call) -> str:
+    """Return a cached response if there is one, otherwise await call() and cache its result.
+    
+    Concurrent identical requests share a single call().
+    """
+    if ResponseCache.enabled():
+        cached = await ResponseCache.get(agent, model, mode, query, project_context)
+        if cached is not None:
+            print(f"♻️ Response cache hit ({agent}/{mode})")
+            return cached
+    
+    async def once():
+        yield await call()
+    
+    return await _response_flight(agent, model, mode, query, project_context, once()).result()
+
+
+async def cached_stream(agent: str, model: str, mode: str, query: str, project_context: str, deltas):
+    """Streaming counterpart of cached_response(): yields a cached response whole, or streams and caches"""
+    if ResponseCache.enabled():
+        cached = await ResponseCache.get(agent, model, mode, query, project_context)
+        if cached is not None:
+            print(f"♻️ Response cache hit ({agent}/{mode})")
+            yield cached
+            return
+    
+    flight = _response_flight(agent, model, mode, query, project_context, deltas)
+    async for delta in flight.follow():
+        yield delta
+
+
+class RouteClassifier:
+    """Local multinomial Naive Bayes over word uni/bigrams, trained from past Gemini routing decisions.
+    
+    Seeded with a few keyword examples so it can answer clear-cut queries from a cold start.
+    """
+    
+    LOG_FILE = os.path.join(os.path.dirname(__file__), 'routing_log.jsonl')
+    LABELS = ("research", "build")
+    SEED_EXAMPLES = {
+        "research": [
+            "why does this happen explain the reasoning",
+            "analyze the hypothesis and evidence",
+            "what is the theory concept behind this",
+            "interpret the results significance bias",
+            "compare these approaches assumptions tradeoffs",
+            "is this claim valid what does the literature say",
+        ],
+        "build": [
+            "implement a python script function class",
+            "debug this error traceback exception bug",
+            "write code to load the dataframe csv",
+            "set up install configure deploy the pipeline",
+            "refactor the architecture module api database",
+            "fix the failing test and compile the build",
+        ],
+    }
+    
+    _word_counts: dict[str, dict[str, int]] = {}
+    _totals: dict[str, int] = {}
+    _docs: dict[str, int] = {}
+    _vocab: set[str] = set()
+    _trained = False
+    _loading: asyncio.Future | None = None
+    
+    @staticmethod
+    def features(text: str) -> list[str]:
+        words = re.findall(r"[a-z_]+", text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    
+    @staticmethod
+    def learn(text: str, label: str):
+        """Add one labelled example"""
+        counts = RouteClassifier._word_counts.setdefault(label, {})
+        for feature in RouteClassifier.features(text):
+            counts[feature] = counts.get(feature, 0) + 1
+            RouteClassifier._totals[label] = RouteClassifier._totals.get(label, 0) + 1
+            RouteClassifier._vocab.add(feature)
+        RouteClassifier._docs[label] = RouteClassifier._docs.get(label, 0) + 1
+    
+    @staticmethod
+    def _train():
+        """Build the model from the seed examples and the routing log (once)"""
+        RouteClassifier._trained = True
+        for label, examples in RouteClassifier.SEED_EXAMPLES.items():
+            for example in examples:
+                RouteClassifier.learn(example, label)
         
-        # Load local prompt files
-        for filename in ProjectContext.CONTEXT_FILES:
-            content = ProjectContext.load_prompt_file(filename)
-            if content:
-                context_parts.append(content)
+        try:
+            with open(RouteClassifier.LOG_FILE, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry.get("decision") in RouteClassifier.LABELS:
+                        RouteClassifier.learn(entry["query"], entry["decision"])
+        except FileNotFoundError:
+            pass
+    
+    @staticmethod
+    def predict(query: str) -> tuple[str, float]:
+        """Return (label, posterior probability). Probability is 0.5 when nothing is known about the query."""
+        if not RouteClassifier._trained:
+            RouteClassifier._train()
         
-        # Add important memories
-        memory_context = Memory.get_context()
-        if memory_context:
-            context_parts.append(memory_context)
+        features = [f for f in RouteClassifier.features(query) if f in RouteClassifier._vocab]
+        if not features:
+            return "research", 0.5
         
-        # Add channel conversation history if provided
-        if channel:
-            channel_history = await ProjectContext.get_channel_history(channel)
-            if channel_history:
-                context_parts.append(channel_history)
+        vocab_size = len(RouteClassifier._vocab)
+        total_docs = sum(RouteClassifier._docs.values())
+        scores = {}
+        for label in RouteClassifier.LABELS:
+            counts = RouteClassifier._word_counts.get(label, {})
+            denominator = RouteClassifier._totals.get(label, 0) + vocab_size
+            score = math.log((RouteClassifier._docs.get(label, 0) + 1) / (total_docs + len(RouteClassifier.LABELS)))
+            for feature in features:
+                score += math.log((counts.get(feature, 0) + 1) / denominator)
+            scores[label] = score
         
-        if context_parts:
-            return "\n\n---\n\n".join(context_parts)
-        return "No project context available."
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        probability = 1.0 / sum(math.exp(score - top) for score in scores.values())
+        return best, probability
+    
+    @staticmethod
+    async def ready():
+        """Train from the routing log on the storage pool (once), instead of on first predict()"""
+        if RouteClassifier._loading is None:
+            RouteClassifier._loading = asyncio.ensure_future(Storage.run(RouteClassifier._train))
+        loading = RouteClassifier._loading
+        try:
+            await loading
+        except Exception as e:
+            if RouteClassifier._loading is loading:
+                # Route with what was learned (at least the seed examples) instead of failing every
+                # later !auto; training again would count the seeds twice
+                print(f"⚠️ Could not train the route classifier ({type(e).__name__}: {e}) - using the seed examples")
+                RouteClassifier._trained = True
+                RouteClassifier._loading = asyncio.get_running_loop().create_future()
+                RouteClassifier._loading.set_result(None)
+    
+    @staticmethod
+    async def record(query: str, decision: str):
+        """Log a Gemini decision and learn from it immediately"""
+        RouteClassifier.learn(query, decision)
+        line = json.dumps({"query": query[:2000], "decision": decision, "time": datetime.now().isoformat()})
+        try:
+            await Storage.run(Storage.append_lines, RouteClassifier.LOG_FILE, [line])
+        except OSError as e:
+            print(f"Could not write routing log: {e}")
 
 
 class CenterAI:
-    """Routes queries to appropriate specialist agents using Gemini (free tier)"""
+    """Routes queries to appropriate specialist agents.
+    
+    Two stages behind an LRU of recent decisions: a local classifier answers confident cases
+    instantly, and only ambiguous queries go to Gemini (free tier).
+    """
+    
+    _decisions: "OrderedDict[str, str]" = OrderedDict()
+    stage_counts: dict[str, int] = {"cache": 0, "local": 0, "gemini": 0, "default": 0}
+    stage_latency: dict[str, deque] = {stage: deque(maxlen=500) for stage in stage_counts}
+    
+    @staticmethod
+    def _channel(agent_type: str) -> tuple[str, int]:
+        return agent_type, RESEARCH_CHANNEL_ID if agent_type == "research" else BUILD_CHANNEL_ID
+    
+    @staticmethod
+    def _decided(stage: str, key: str, agent_type: str, started: float) -> tuple[str, int]:
+        elapsed = time.perf_counter() - started
+        CenterAI.stage_counts[stage] += 1
+        CenterAI.stage_latency[stage].append(elapsed)
+        Metrics.observe("router_seconds", elapsed, stage=stage)
+        CenterAI._decisions[key] = agent_type
+        CenterAI._decisions.move_to_end(key)
+        while len(CenterAI._decisions) > ROUTER_CACHE_SIZE:
+            CenterAI._decisions.popitem(last=False)
+        return CenterAI._channel(agent_type)
     
     @staticmethod
     async def route_query(query: str) -> tuple[str, int]:
-        """Determine which agent should handle the query using Gemini (free = $0 routing cost)"""
+        """Determine which agent should handle the query (cache -> local classifier -> Gemini)"""
+        started = time.perf_counter()
+        key = " ".join(query.lower().split())
+        
+        # Stage 0: recently routed
+        if key in CenterAI._decisions:
+            return CenterAI._decided("cache", key, CenterAI._decisions[key], started)
+        
+        # Stage 1: local classifier
+        await RouteClassifier.ready()
+        label, confidence = RouteClassifier.predict(query)
+        if confidence >= ROUTER_CONFIDENCE:
+            return CenterAI._decided("local", key, label, started)
         
-        if not gemini_client:
-            return "research", RESEARCH_CHANNEL_ID
+        # Stage 2: Gemini (free = $0 routing cost) for ambiguous queries
+        gemini = providers["gemini"]
+        if not gemini.available:
+            stage = "local" if confidence > 0.5 else "default"
+            return CenterAI._decided(stage, key, label, started)
         
         prompt = f"""You are a routing AI. Classify this query as either:
 - RESEARCH: questions about concepts, analysis, hypothesis testing, theory, reasoning
@@ -289,22 +2932,25 @@ Query: {query}
 
 Respond with just one word: RESEARCH or BUILD"""
         
-        # Run Gemini in executor to avoid blocking
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: gemini_client.models.generate_content(
-                model=ROUTER_MODEL,
-                contents=prompt
-            )
-        )
+        response = await gemini.complete(ROUTER_MODEL, prompt)
         
         decision = response.text.strip().upper()
-        
-        if "RESEARCH" in decision:
-            return "research", RESEARCH_CHANNEL_ID
-        else:
-            return "build", BUILD_CHANNEL_ID
+        agent_type = "research" if "RESEARCH" in decision else "build"
+        await RouteClassifier.record(query, agent_type)
+        return CenterAI._decided("gemini", key, agent_type, started)
+    
+    @staticmethod
+    def stats() -> dict[str, dict]:
+        """Decision count and p50/p95 latency (ms) per stage"""
+        result = {}
+        for stage, count in CenterAI.stage_counts.items():
+            samples = sorted(CenterAI.stage_latency[stage])
+            result[stage] = {
+                "count": count,
+                "p50_ms": samples[len(samples) // 2] * 1000 if samples else 0.0,
+                "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000 if samples else 0.0,
+            }
+        return result
 
 
 class ResearchAgent:
@@ -318,43 +2964,50 @@ class ResearchAgent:
         """Load research prompt from file"""
         filename = 'research_hardmode.md' if mode == 'hardmode' else 'research_core.md'
         filepath = os.path.join(ResearchAgent.PROMPTS_DIR, filename)
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
+        content = PromptCache.read(filepath)
+        if content is None:
             return "You are a research agent. Analyze the query carefully and provide thorough reasoning."
+        return content
     
     @staticmethod
-    async def process(query: str, context: list = None, project_context: str = None, mode: str = 'core') -> str:
-        if not claude_client:
-            return "❌ Claude (Anthropic) API key not configured. Add ANTHROPIC_API_KEY to your .env file."
+    def build_prompt(query: str, context: list = None, project_context: str = None, mode: str = 'core') -> tuple[str, str]:
+        """Return (system, prompt): the stable, cacheable prefix and the per-call suffix"""
+        static_context, volatile_context = split_context(project_context)
         
         # Load the appropriate research prompt
         system_prompt = ResearchAgent.load_prompt(mode)
+        if static_context:
+            system_prompt += f"\n\n{static_context}"
         
-        messages = [{
-            "role": "user",
-            "content": f"""{system_prompt}
-
-{project_context if project_context else ''}
+        return system_prompt, f"""{volatile_context}
 
 Conversation context: {context if context else 'None'}
 
-Query: {query}"""
-        }]
-        
-        # Run Claude in executor to avoid blocking
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: claude_client.messages.create(
-                model=RESEARCH_MODEL,
-                max_tokens=2000,
-                messages=messages
-            )
-        )
+Query: {query}""".lstrip()
+    
+    @staticmethod
+    async def process(query: str, context: list = None, project_context: str = None, mode: str = 'core') -> str:
+        if not Failover.candidates("research", "claude", RESEARCH_MODEL):
+            return providers["claude"].not_configured()
         
-        return response.content[0].text
+        async def call():
+            system, prompt = await Storage.run(ResearchAgent.build_prompt, query, context, project_context, mode)
+            response = await Failover.complete("research", "claude", RESEARCH_MODEL, prompt, system=system, max_tokens=2000)
+            return Failover.text(response, "claude", RESEARCH_MODEL)
+        
+        return await cached_response("research", RESEARCH_MODEL, mode, query, project_context, call)
+    
+    @staticmethod
+    async def stream(query: str, context: list = None, project_context: str = None, mode: str = 'core'):
+        """Same as process(), but yields the response as it is generated"""
+        if not Failover.candidates("research", "claude", RESEARCH_MODEL):
+            yield providers["claude"].not_configured()
+            return
+        
+        system, prompt = await Storage.run(ResearchAgent.build_prompt, query, context, project_context, mode)
+        deltas = Failover.stream("research", "claude", RESEARCH_MODEL, prompt, system=system, max_tokens=2000)
+        async for delta in cached_stream("research", RESEARCH_MODEL, mode, query, project_context, deltas):
+            yield delta
 
 
 class BuildAgent:
@@ -401,37 +3054,45 @@ If the request requires inventing new features or redefining the experiment, res
 """
     
     @staticmethod
-    async def process(query: str, context: list = None, project_context: str = None) -> str:
-        if not claude_client:
-            return "❌ Claude (Anthropic) API key not configured. Add ANTHROPIC_API_KEY to your .env file."
+    def build_prompt(query: str, context: list = None, project_context: str = None) -> tuple[str, str]:
+        """Return (system, prompt): the stable, cacheable prefix and the per-call suffix"""
+        static_context, volatile_context = split_context(project_context)
         
         system_prompt = BuildAgent.SYSTEM_PROMPT
-        if project_context:
-            system_prompt += f"\n\n{project_context}"
+        if static_context:
+            system_prompt += f"\n\n{static_context}"
         
-        messages = [{
-            "role": "user",
-            "content": f"""{system_prompt}
+        return system_prompt, f"""{volatile_context}
 
 Conversation context: {context if context else 'None'}
 
 Query: {query}
 
-Implement exactly what is requested. Do not add features or interpret results."""
-        }]
-        
-        # Run Claude in executor for complex builds
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: claude_client.messages.create(
-                model=BUILD_MODEL,
-                max_tokens=2000,
-                messages=messages
-            )
-        )
+Implement exactly what is requested. Do not add features or interpret results.""".lstrip()
+    
+    @staticmethod
+    async def process(query: str, context: list = None, project_context: str = None) -> str:
+        if not Failover.candidates("build", "claude", BUILD_MODEL):
+            return providers["claude"].not_configured()
+        
+        async def call():
+            system, prompt = BuildAgent.build_prompt(query, context, project_context)
+            response = await Failover.complete("build", "claude", BUILD_MODEL, prompt, system=system, max_tokens=2000)
+            return Failover.text(response, "claude", BUILD_MODEL)
+        
+        return await cached_response("build", BUILD_MODEL, "default", query, project_context, call)
+    
+    @staticmethod
+    async def stream(query: str, context: list = None, project_context: str = None):
+        """Same as process(), but yields the response as it is generated"""
+        if not Failover.candidates("build", "claude", BUILD_MODEL):
+            yield providers["claude"].not_configured()
+            return
         
-        return response.content[0].text
+        system, prompt = BuildAgent.build_prompt(query, context, project_context)
+        deltas = Failover.stream("build", "claude", BUILD_MODEL, prompt, system=system, max_tokens=2000)
+        async for delta in cached_stream("build", BUILD_MODEL, "default", query, project_context, deltas):
+            yield delta
 
 
 class GeminiAgent:
@@ -439,123 +3100,381 @@ class GeminiAgent:
     
     @staticmethod
     async def process(query: str, context: list = None, project_context: str = None) -> str:
-        if not gemini_client:
-            return "❌ Gemini API key not configured. Add GEMINI_API_KEY to your .env file."
+        if not Failover.candidates("gemini", "gemini", CODE_MODEL):
+            return providers["gemini"].not_configured()
         
-        prompt = f"""You are an AI research assistant.
+        static_context, volatile_context = split_context(project_context)
+        
+        system = f"""You are an AI research assistant.
 
-{project_context if project_context else ''}
+{static_context}"""
+        
+        prompt = f"""{volatile_context}
 
 Conversation context: {context if context else 'None'}
 
 Query: {query}
 
-Provide a helpful, balanced response. Reference the project context when relevant. Consider multiple perspectives."""
+Provide a helpful, balanced response. Reference the project context when relevant. Consider multiple perspectives.""".lstrip()
+        
+        async def call():
+            response = await Failover.complete("gemini", "gemini", CODE_MODEL, prompt, system=system)
+            return Failover.text(response, "gemini", CODE_MODEL)
+        
+        return await cached_response("gemini", CODE_MODEL, "default", query, project_context, call)
+
+
+class GeneralAgent:
+    """Handles general questions using GPT-4 (cheaper than Claude for simple queries)"""
+    
+    @staticmethod
+    async def process(query: str, context: list = None, project_context: str = None) -> str:
+        if not Failover.candidates("general", "openai", GENERAL_MODEL):
+            return providers["openai"].not_configured()
+        
+        system_prompt = """You are a helpful research assistant.
+        
+Be concise and practical. Reference project context when relevant.
+For complex reasoning or deep analysis, suggest using !deep instead."""
+        
+        # Stable context first so OpenAI's automatic prefix caching applies
+        static_context, volatile_context = split_context(project_context)
+        if static_context:
+            system_prompt += f"\n\n{static_context}"
+        
+        prompt = f"""{volatile_context}
+
+Query: {query}""".lstrip()
+        
+        async def call():
+            response = await Failover.complete("general", "openai", GENERAL_MODEL, prompt, system=system_prompt, max_tokens=1500)
+            return Failover.text(response, "openai", GENERAL_MODEL)
+        
+        return await cached_response("general", GENERAL_MODEL, "default", query, project_context, call)
+
+
+class SimpleCodeAgent:
+    """Handles simple code tasks using Gemini (free tier)"""
+    
+    @staticmethod
+    async def process(query: str, context: list = None, project_context: str = None) -> str:
+        if not Failover.candidates("code", "gemini", CODE_MODEL):
+            return providers["gemini"].not_configured()
+        
+        static_context, volatile_context = split_context(project_context)
+        
+        system = f"""You are a code assistant for Python data science projects.
+
+Write simple, clean code. For complex implementations or architecture decisions, suggest using !build instead.
+
+{static_context}"""
+        
+        prompt = f"""{volatile_context}
+
+Query: {query}
+
+Provide working code with brief explanations.""".lstrip()
+        
+        async def call():
+            response = await Failover.complete("code", "gemini", CODE_MODEL, prompt, system=system)
+            return Failover.text(response, "gemini", CODE_MODEL)
+        
+        return await cached_response("code", CODE_MODEL, "default", query, project_context, call)
+
+
+class ConsensusAnalyzer:
+    """Local, CPU-only comparison of model answers (no extra LLM call).
+    
+    Answers are split into sentences, sentences from different models are clustered into claims
+    by TF-IDF cosine similarity, and each claim is scored by how many models make it. A claim
+    where one side negates and the other doesn't is flagged as disputed.
+    """
+    
+    SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+    NEGATIONS = frozenset("not no never none cannot without neither nor isn't aren't doesn't don't won't can't".split())
+    MIN_TERMS = 4
+    
+    @staticmethod
+    def sentences(text: str) -> list[str]:
+        """Prose sentences, without code blocks, headings and markdown decoration"""
+        text = re.sub(r"```.*?(```|$)", " ", text, flags=re.DOTALL)
+        found = []
+        for sentence in ConsensusAnalyzer.SENTENCE_SPLIT.split(text):
+            sentence = re.sub(r"^[\s#>*\-\d.|]+", "", sentence).replace("**", "").strip()
+            if len(Memory.terms(sentence)) >= ConsensusAnalyzer.MIN_TERMS:
+                found.append(sentence)
+        return found
+    
+    @staticmethod
+    def _vectors(sentences: list[str]) -> list[dict[str, float]]:
+        """Unit-length TF-IDF vectors (IDF over all sentences)"""
+        term_lists = [[term.rstrip("s") if len(term) > 3 else term for term in Memory.terms(sentence)] for sentence in sentences]
+        document_frequency: dict[str, int] = {}
+        for terms in term_lists:
+            for term in set(terms):
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        
+        total = len(sentences)
+        vectors = []
+        for terms in term_lists:
+            weights: dict[str, float] = {}
+            for term in terms:
+                weights[term] = weights.get(term, 0.0) + 1.0
+            for term in weights:
+                weights[term] *= math.log(1 + total / document_frequency[term])
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            vectors.append({term: w / norm for term, w in weights.items()})
+        return vectors
+    
+    @staticmethod
+    def analyze(responses: dict[str, str]) -> dict:
+        """Claims (clusters of similar sentences across models) and pairwise agreement"""
+        models = [name for name, text in responses.items() if text]
+        owners, sentences = [], []
+        for name in models:
+            for sentence in ConsensusAnalyzer.sentences(responses[name]):
+                owners.append(name)
+                sentences.append(sentence)
+        vectors = ConsensusAnalyzer._vectors(sentences)
+        
+        # Candidate pairs share at least one term (inverted index), then union-find on similar pairs
+        parent = list(range(len(sentences)))
+        
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        
+        postings: dict[str, list[int]] = {}
+        for i, vector in enumerate(vectors):
+            for term in vector:
+                postings.setdefault(term, []).append(i)
+        compared = set()
+        for members in postings.values():
+            for a_index, a in enumerate(members):
+                for b in members[a_index + 1:]:
+                    if owners[a] == owners[b] or (a, b) in compared:
+                        continue
+                    compared.add((a, b))
+                    small, large = sorted((vectors[a], vectors[b]), key=len)
+                    if sum(w * large.get(term, 0.0) for term, w in small.items()) >= CONSENSUS_SIMILARITY:
+                        parent[find(a)] = find(b)
+        
+        clusters: dict[int, list[int]] = {}
+        for i in range(len(sentences)):
+            clusters.setdefault(find(i), []).append(i)
+        
+        claims = []
+        for members in clusters.values():
+            supporters = sorted({owners[i] for i in members}, key=models.index)
+            negated = {any(word in ConsensusAnalyzer.NEGATIONS for word in sentences[i].lower().split()) for i in members}
+            claims.append({
+                "text": sentences[members[0]],
+                "models": supporters,
+                "disputed": len(supporters) > 1 and len(negated) > 1,
+            })
         
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: gemini_client.models.generate_content(
-                model=CODE_MODEL,
-                contents=prompt
-            )
-        )
+        # Jaccard overlap of the claims each pair of models makes
+        agreement = {}
+        for a in models:
+            for b in models:
+                if a < b:
+                    either = [c for c in claims if a in c["models"] or b in c["models"]]
+                    both = [c for c in either if a in c["models"] and b in c["models"]]
+                    agreement[(a, b)] = agreement[(b, a)] = len(both) / len(either) if either else 0.0
+        return {"models": models, "claims": claims, "agreement": agreement}
+    
+    @staticmethod
+    def report(responses: dict[str, str | None], labels: dict[str, str]) -> str | None:
+        """Compact agreement matrix and claim summary for #findings (None with fewer than two answers)"""
+        if sum(1 for text in responses.values() if text) < 2:
+            return None
+        started = time.perf_counter()
+        result = ConsensusAnalyzer.analyze(responses)
+        elapsed = time.perf_counter() - started
+        Metrics.observe("consensus_analysis_seconds", elapsed)
         
-        return response.text
+        models, claims = result["models"], result["claims"]
+        names = [labels.get(name, name) for name in models]
+        width = max(len(name) for name in names) + 2
+        rows = [" " * width + "".join(f"{name:>{width}}" for name in names)]
+        agreement = result["agreement"]
+        for a, name in zip(models, names):
+            cells = "".join(f"{'—' if a == b else format(agreement[(a, b)], '.0%'):>{width}}" for b in models)
+            rows.append(f"{name:<{width}}{cells}")
+        
+        def shorten(text: str) -> str:
+            return text if len(text) <= 140 else text[:137] + "..."
+        
+        shared = [c for c in claims if len(c["models"]) == len(models) and not c["disputed"]]
+        disputed = [c for c in claims if c["disputed"]]
+        lines = [f"**📊 Agreement** *(local analysis, {elapsed * 1000:.0f} ms, {len(claims)} claims)*",
+                 "```\n" + "\n".join(rows) + "\n```"]
+        if shared:
+            lines.append(f"**✅ All agree ({len(shared)}):**")
+            lines.extend(f"• {shorten(c['text'])}" for c in shared[:3])
+        if disputed:
+            lines.append(f"**⚠️ Possibly disputed ({len(disputed)}):**")
+            lines.extend(f"• {shorten(c['text'])} *({', '.join(labels.get(m, m) for m in c['models'])})*" for c in disputed[:3])
+        unique = [f"{labels.get(name, name)} {sum(1 for c in claims if c['models'] == [name])}" for name in models]
+        lines.append(f"**Only one model:** {' · '.join(unique)}")
+        return "\n".join(lines)
 
 
-class GeneralAgent:
-    """Handles general questions using GPT-4 (cheaper than Claude for simple queries)"""
+class AttachmentIngester:
+    """Reads text attachments in bounded chunks, with a byte ceiling and a token budget.
+    
+    Downloads stream through aiohttp and stop at ATTACHMENT_MAX_BYTES. Files are keyed by a hash
+    of their content, so a re-upload reuses the processed text (and then hits the response cache).
+    Files over ATTACHMENT_MAX_TOKENS are sampled: CSVs keep the header and spread-out rows, logs
+    keep error lines and the tail, anything else keeps its head and tail.
+    """
+    
+    CHUNK_SIZE = 64 * 1024
+    LOG_PATTERN = re.compile(r"error|exception|traceback|fatal|critical|warn", re.IGNORECASE)
+    
+    _session: aiohttp.ClientSession | None = None
+    _by_hash: "OrderedDict[str, tuple[str, str]]" = OrderedDict()  # sha256 -> (text, note)
+    _by_attachment: "OrderedDict[int, str]" = OrderedDict()  # attachment id -> sha256
     
     @staticmethod
-    async def process(query: str, context: list = None, project_context: str = None) -> str:
-        if not openai_client:
-            return "❌ OpenAI API key not configured. Add OPENAI_API_KEY to your .env file."
+    def accepts(filename: str) -> bool:
+        return filename.lower().endswith(ATTACHMENT_EXTENSIONS)
+    
+    @staticmethod
+    async def _download(attachment) -> tuple[bytes, bool]:
+        """Up to ATTACHMENT_MAX_BYTES of the file, and whether it was cut off"""
+        if AttachmentIngester._session is None or AttachmentIngester._session.closed:
+            AttachmentIngester._session = aiohttp.ClientSession()
         
-        system_prompt = """You are a helpful research assistant.
+        buffer = bytearray()
+        async with AttachmentIngester._session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(AttachmentIngester.CHUNK_SIZE):
+                buffer += chunk
+                if len(buffer) >= ATTACHMENT_MAX_BYTES:
+                    return bytes(buffer[:ATTACHMENT_MAX_BYTES]), True
+        return bytes(buffer), False
+    
+    @staticmethod
+    def _fit(lines: list[str], budget: int, keep) -> list[str]:
+        """Lines chosen by keep(index, line) first, then the rest of the budget, in original order"""
+        chosen = set()
+        used = 0
+        for i, line in enumerate(lines):
+            if keep(i, line) and used + len(line) + 1 <= budget:
+                chosen.add(i)
+                used += len(line) + 1
+        return [line for i, line in enumerate(lines) if i in chosen]
+    
+    @staticmethod
+    def sample(text: str, filename: str, max_tokens: int) -> tuple[str, str]:
+        """Cut text down to about max_tokens; returns (text, note for the user)"""
+        if TokenCounter.count(text) <= max_tokens:
+            return text, ""
+        budget = max_tokens * 4  # characters, at ~4 per token
+        lines = text.split("\n")
+        name = filename.lower()
         
-Be concise and practical. Reference project context when relevant.
-For complex reasoning or deep analysis, suggest using !deep instead."""
+        if name.endswith(".csv") and len(lines) > 2:
+            # Header, then every k-th row so the sample spans the whole file
+            average = max(len(text) // len(lines), 1)
+            step = max(1, (len(lines) * average) // budget + 1)
+            kept = AttachmentIngester._fit(lines, budget, lambda i, line: i == 0 or i % step == 0)
+            return "\n".join(kept), f"sampled {len(kept) - 1:,} of {len(lines) - 1:,} rows"
         
-        if project_context:
-            system_prompt += f"\n\n{project_context}"
-        
-        messages = [{
-            "role": "system",
-            "content": system_prompt
-        }, {
-            "role": "user",
-            "content": f"""Query: {query}"""
-        }]
-        
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: openai_client.chat.completions.create(
-                model=GENERAL_MODEL,
-                messages=messages,
-                max_tokens=1500
-            )
-        )
+        if name.endswith(".log"):
+            # Error-looking lines, then as much of the end of the log as still fits
+            errors = AttachmentIngester._fit(lines, budget // 2, lambda i, line: bool(AttachmentIngester.LOG_PATTERN.search(line)))
+            tail, used = [], sum(len(line) + 1 for line in errors)
+            for line in reversed(lines):
+                if used + len(line) + 1 > budget:
+                    break
+                tail.append(line)
+                used += len(line) + 1
+            tail.reverse()
+            return ("\n".join(errors) + "\n[... last lines of the log ...]\n" + "\n".join(tail),
+                    f"kept {len(errors):,} error lines and the last {len(tail):,} lines")
         
-        return response.choices[0].message.content
-
-
-class SimpleCodeAgent:
-    """Handles simple code tasks using Gemini (free tier)"""
+        # Head and tail, with a marker for what was left out
+        head = text[:budget * 2 // 3]
+        tail = text[-(budget // 3):]
+        head = head[:head.rfind("\n")] if "\n" in head else head
+        tail = tail[tail.find("\n") + 1:] if "\n" in tail else tail
+        omitted = len(text) - len(head) - len(tail)
+        return f"{head}\n[... {omitted:,} characters omitted ...]\n{tail}", "kept the beginning and end"
     
     @staticmethod
-    async def process(query: str, context: list = None, project_context: str = None) -> str:
-        if not gemini_client:
-            return "❌ Gemini API key not configured. Add GEMINI_API_KEY to your .env file."
+    async def read(attachment) -> tuple[str, str]:
+        """Text to put in the prompt and a short note for the user"""
+        digest = AttachmentIngester._by_attachment.get(attachment.id)
+        if digest in AttachmentIngester._by_hash:
+            AttachmentIngester._by_attachment.move_to_end(attachment.id)
+            AttachmentIngester._by_hash.move_to_end(digest)
+            text, note = AttachmentIngester._by_hash[digest]
+            return text, "already read" + (f", {note}" if note else "")
         
-        prompt = f"""You are a code assistant for Python data science projects.
-
-Write simple, clean code. For complex implementations or architecture decisions, suggest using !build instead.
-
-{project_context if project_context else ''}
-
-Query: {query}
-
-Provide working code with brief explanations."""
+        data, truncated = await AttachmentIngester._download(attachment)
+        digest = hashlib.sha256(data).hexdigest()
+        AttachmentIngester._by_attachment[attachment.id] = digest
+        if len(AttachmentIngester._by_attachment) > ATTACHMENT_CACHE_SIZE:
+            AttachmentIngester._by_attachment.popitem(last=False)
+        if digest in AttachmentIngester._by_hash:
+            AttachmentIngester._by_hash.move_to_end(digest)
+            text, note = AttachmentIngester._by_hash[digest]
+            return text, "same file as an earlier upload" + (f", {note}" if note else "")
         
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: gemini_client.models.generate_content(
-                model=CODE_MODEL,
-                contents=prompt
-            )
-        )
+        if b"\x00" in data[:8192]:
+            raise ValueError("looks like a binary file")
+        text = data.decode("utf-8", errors="replace")
+        text, note = AttachmentIngester.sample(text, attachment.filename, ATTACHMENT_MAX_TOKENS)
+        if truncated:
+            note = f"stopped at {ATTACHMENT_MAX_BYTES / 1024 / 1024:.1f} MB" + (f", {note}" if note else "")
         
-        return response.text
+        AttachmentIngester._by_hash[digest] = (text, note)
+        if len(AttachmentIngester._by_hash) > ATTACHMENT_CACHE_SIZE:
+            AttachmentIngester._by_hash.popitem(last=False)
+        return text, note
+    
+    @staticmethod
+    async def close():
+        """Close the download session (called when the bot shuts down)"""
+        if AttachmentIngester._session is not None and not AttachmentIngester._session.closed:
+            await AttachmentIngester._session.close()
+        AttachmentIngester._session = None
 
 
 async def extract_query_from_attachments(ctx, query: str = None) -> tuple[str, bool]:
     """
-    Helper function to extract text from .txt attachments.
+    Helper function to extract text from attachments (.txt, .md, .py, .csv, .json, .log).
     Discord auto-converts large pastes to .txt files.
     
     Returns:
         tuple: (combined_query, had_attachment) - query text and whether an attachment was read
     """
     had_attachment = False
+    seen = set()
     
     if ctx.message.attachments:
         for attachment in ctx.message.attachments:
-            if attachment.filename.endswith('.txt'):
+            if AttachmentIngester.accepts(attachment.filename):
                 try:
-                    content = await attachment.read()
-                    attachment_text = content.decode('utf-8')
+                    attachment_text, note = await AttachmentIngester.read(attachment)
+                    # The same file attached twice is only included once
+                    if attachment_text in seen:
+                        continue
+                    seen.add(attachment_text)
                     # Combine with any existing query text
                     if query:
                         query = f"{query}\n\n{attachment_text}"
                     else:
                         query = attachment_text
-                    await ctx.send(f"📎 Read {len(attachment_text):,} characters from `{attachment.filename}`")
+                    await outbox.send(ctx.channel, f"📎 Read {len(attachment_text):,} characters from `{attachment.filename}`"
+                                   + (f" ({note})" if note else ""))
                     had_attachment = True
                 except Exception as e:
-                    await ctx.send(f"⚠️ Could not read attachment: {e}")
+                    await outbox.send(ctx.channel, f"⚠️ Could not read attachment: {e}")
     
     return query, had_attachment
 
@@ -566,11 +3485,11 @@ async def on_ready():
     print(f'')
     print(f'🤖 Multi-AI Research Bot Ready!')
     print(f'   Router: Explicit Commands (!ask, !deep, !gemini)')
-    print(f'   Research: Claude {"✅" if claude_client else "❌"}')
-    print(f'   Build: Claude {"✅" if claude_client else "❌"}')
-    print(f'   General: GPT-4 {"✅" if openai_client else "❌"}')
-    print(f'   Simple Code: Gemini {"✅" if gemini_client else "❌"}')
-    print(f'   Backup: Gemini {"✅" if gemini_client else "❌"}')
+    print(f'   Research: Claude {"✅" if providers["claude"].available else "❌"}')
+    print(f'   Build: Claude {"✅" if providers["claude"].available else "❌"}')
+    print(f'   General: GPT-4 {"✅" if providers["openai"].available else "❌"}')
+    print(f'   Simple Code: Gemini {"✅" if providers["gemini"].available else "❌"}')
+    print(f'   Backup: Gemini {"✅" if providers["gemini"].available else "❌"}')
     print(f'')
     print(f'Monitoring channels:')
     print(f'  Coordination: {COORD_CHANNEL_ID}')
@@ -579,8 +3498,153 @@ async def on_ready():
     print(f'  Findings: {FINDINGS_CHANNEL_ID}')
     print(f'  Task: {TASK_CHANNEL_ID}')
     print(f'  Completed: {COMPLETED_CHANNEL_ID}')
+    
+    await Metrics.start_server()
+    report_startup("ready")
+    
+    # Import provider SDKs in the background so the first command doesn't pay for it
+    asyncio.create_task(preload_providers())
+    
+    # Warm the channel history cache so context assembly doesn't hit the REST API
+    channel_ids = {COORD_CHANNEL_ID, RESEARCH_CHANNEL_ID, BUILD_CHANNEL_ID, FINDINGS_CHANNEL_ID,
+                   TASK_CHANNEL_ID, COMPLETED_CHANNEL_ID, TESTCASE_CHANNEL_ID, ARCHIVE_CHANNEL_ID}
+    warm_channels = [bot.get_channel(channel_id) for channel_id in channel_ids if channel_id]
+    results = await asyncio.gather(
+        *(ChannelHistory.warm(channel) for channel in warm_channels if channel),
+        return_exceptions=True
+    )
+    failed = [r for r in results if isinstance(r, Exception)]
+    print(f'  History cache: {len(results) - len(failed)} channels warmed'
+          + (f', {len(failed)} failed ({failed[0]})' if failed else ''))
+    
+    # Catch up on task posts created or deleted while the bot was offline
+    task_channel = bot.get_channel(TASK_CHANNEL_ID)
+    if task_channel:
+        try:
+            imported, removed = await TaskStore.reconcile(task_channel, bot.user)
+            print(f'  Tasks: {(await TaskStore.counts()).get("active", 0)} active'
+                  + (f', {imported} imported' if imported else '') + (f', {removed} removed' if removed else ''))
+        except Exception as e:
+            print(f'  Tasks: reconciliation failed ({e})')
+
+
+async def preload_providers():
+    """Build the SDK clients of configured providers off the event loop"""
+    configured = [provider for provider in providers.values() if provider.available]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(asyncio.to_thread(p.preload) for p in configured), return_exceptions=True)
+    failed = [(p.name, r) for p, r in zip(configured, results) if isinstance(r, Exception)]
+    print(f'  Providers preloaded in {time.perf_counter() - started:.2f}s: {", ".join(p.name for p in configured) or "none"}'
+          + (f' ({", ".join(f"{name} failed: {e}" for name, e in failed)})' if failed else ''))
+
+
+class MessageChunker:
+    """Incremental, fence-aware splitter of text into Discord-sized chunks.
+    
+    feed() accepts fragments as they arrive and returns the chunks that are complete; close()
+    returns the rest. Splits prefer a paragraph break, then a line, sentence and word boundary
+    in the second half of the window, so work is linear in the input. A chunk that ends inside
+    a ``` code block is closed, and the next one reopens it with the same language.
+    """
+    
+    FENCE_RESERVE = len("\n```")
+    BOUNDARIES = ("\n\n", "\n", ". ", "! ", "? ", " ")
+    
+    def __init__(self, limit: int = 1900):
+        self.limit = limit
+        self.parts: list[str] = []
+        self.size = 0
+        # Code fence state at the start of the pending text
+        self.in_fence = False
+        self.language = ""
+        self.line_start = True
+    
+    @staticmethod
+    def _scan(body: str, in_fence: bool, language: str, line_start: bool) -> tuple[bool, str, bool]:
+        """Fence state after body, starting from the given state"""
+        for i, line in enumerate(body.split("\n")):
+            if (i > 0 or line_start) and line.lstrip().startswith("```"):
+                in_fence = not in_fence
+                language = line.strip()[3:43] if in_fence else ""
+        return in_fence, language, body.endswith("\n")
+    
+    def _prefix(self) -> str:
+        return f"```{self.language}\n" if self.in_fence else ""
+    
+    def _render(self, body: str) -> str:
+        """Wrap a body that starts at the current fence state; advances the state"""
+        prefix = self._prefix()
+        self.in_fence, self.language, self.line_start = self._scan(body, self.in_fence, self.language, self.line_start)
+        if self.in_fence:
+            return prefix + body + ("```" if body.endswith("\n") else "\n```")
+        return prefix + body
+    
+    def _budget(self) -> int:
+        return max(self.limit - len(self._prefix()) - self.FENCE_RESERVE, 1)
+    
+    def _cut(self, text: str, pos: int, budget: int) -> int:
+        """End of the next chunk starting at pos: the best boundary in the back half of the window"""
+        end = pos + budget
+        for boundary in self.BOUNDARIES:
+            found = text.rfind(boundary, pos + budget // 2, end - len(boundary) + 1)
+            if found != -1:
+                return found + len(boundary)
+        return end
+    
+    def _drain(self, final: bool) -> list[str]:
+        if not self.parts:
+            return []
+        text = "".join(self.parts) if len(self.parts) > 1 else self.parts[0]
+        chunks = []
+        pos = 0
+        while len(text) - pos > self._budget():
+            cut = self._cut(text, pos, self._budget())
+            body = text[pos:cut]
+            pos = cut
+            if body.strip():
+                chunks.append(self._render(body))
+        
+        rest = text[pos:]
+        if final:
+            if rest.strip():
+                chunks.append(self._render(rest))
+            rest = ""
+        self.parts = [rest] if rest else []
+        self.size = len(rest)
+        return chunks
+    
+    def feed(self, text: str) -> list[str]:
+        """Add a fragment; returns any chunks that are now complete"""
+        if not text:
+            return []
+        self.parts.append(text)
+        self.size += len(text)
+        # Only join and scan once there is more than a chunk's worth - keeps tiny fragments cheap
+        if self.size <= self.limit:
+            return []
+        return self._drain(final=False)
+    
+    def close(self) -> list[str]:
+        """Return the remaining text as chunks"""
+        return self._drain(final=True)
+    
+    def preview(self) -> str:
+        """The pending text as it would be sent now, without consuming it (for live edits)"""
+        body = "".join(self.parts)
+        if not body.strip():
+            return ""
+        in_fence, _, _ = self._scan(body, self.in_fence, self.language, self.line_start)
+        closing = ("```" if body.endswith("\n") else "\n```") if in_fence else ""
+        return self._prefix() + body + closing
 
 
+def iter_chunks(fragments, limit: int = 1900):
+    """Yield Discord-sized chunks from an iterable of text fragments"""
+    chunker = MessageChunker(limit)
+    for fragment in fragments:
+        yield from chunker.feed(fragment)
+    yield from chunker.close()
+
 
 def split_message(text: str, limit: int = 1900) -> list[str]:
     """
@@ -589,60 +3653,288 @@ def split_message(text: str, limit: int = 1900) -> list[str]:
     """
     if len(text) <= limit:
         return [text]
+    return list(iter_chunks([text], limit))
+
+
+class StreamingReply:
+    """Posts a message and progressively edits it as tokens arrive.
+    
+    Edits are throttled to STREAM_EDIT_INTERVAL; text goes through a MessageChunker, so
+    finished messages are never re-split and only the last one is edited.
+    """
+    
+    def __init__(self, channel, header: str = "", limit: int = 1900, edit_interval: float = None):
+        self.channel = channel
+        self.header = header
+        self.limit = limit
+        self.edit_interval = STREAM_EDIT_INTERVAL if edit_interval is None else edit_interval
+        self.parts: list[str] = []
+        self.chunker = MessageChunker(limit)
+        self.chunks: list[str] = list(self.chunker.feed(header))
+        self.messages: list = []
+        self.sent: list[str] = []
+        self.started = time.monotonic()
+        self.first_token_latency: float | None = None
+        self._last_flush = 0.0
     
-    chunks = []
-    current_chunk = ""
-    code_block_open = False
-    language = ""
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+    
+    async def feed(self, delta: str):
+        """Add generated text, flushing to Discord if the edit interval has passed"""
+        if not delta:
+            return
+        self.parts.append(delta)
+        self.chunks.extend(self.chunker.feed(delta))
+        
+        now = time.monotonic()
+        if self.first_token_latency is None:
+            # Post the first token right away - this is the latency users notice
+            self.first_token_latency = now - self.started
+            await self._flush()
+            request = current_request.get() or {}
+            if "started" in request:
+                Metrics.observe("time_to_first_visible_token_seconds", time.perf_counter() - request["started"],
+                                command=request.get("command", ""))
+        elif now - self._last_flush >= self.edit_interval:
+            await self._flush()
     
-    lines = text.split('\n')
+    async def finish(self) -> str:
+        """Flush the final text and return the full response"""
+        self.chunks.extend(self.chunker.close())
+        await self._flush()
+        return self.text
     
-    for line in lines:
-        # Check for code block toggles
-        if line.strip().startswith('```'):
-            if code_block_open:
-                code_block_open = False
-                language = ""
+    async def _flush(self):
+        self._last_flush = time.monotonic()
+        pending = self.chunker.preview()
+        chunks = self.chunks + [pending] if pending else self.chunks
+        
+        # Messages before the last sent one are final - start at the first that may still change
+        for i in range(max(len(self.sent) - 1, 0), len(chunks)):
+            chunk = chunks[i]
+            if i < len(self.messages):
+                if self.sent[i] != chunk:
+                    with Metrics.timer("discord_send_seconds"):
+                        await self.messages[i].edit(content=chunk)
+                    self.sent[i] = chunk
             else:
-                code_block_open = True
-                # Capture language if present (e.g. ```python)
-                language = line.strip()[3:]
-        
-        # If adding this line exceeds limit
-        if len(current_chunk) + len(line) + 1 > limit:
-            # 1. Close current chunk if it has content
-            if current_chunk:
-                if code_block_open:
-                    current_chunk += "```"
-                chunks.append(current_chunk)
-                current_chunk = ""
-                if code_block_open:
-                    current_chunk += f"```{language}\n"
+                # New messages share the channel's outbox (ordering and rate-limit bucket)
+                self.messages.append(await outbox.send(self.channel, chunk))
+                self.sent.append(chunk)
+
+
+class ChannelOutbox:
+    """Ordered send queue and rate-limit bucket for one Discord channel"""
+    
+    def __init__(self, channel, burst: int, window: float):
+        self.channel = channel
+        self.pending: deque = deque()  # (content, coalesce, group, future)
+        self.wakeup = asyncio.Event()
+        self.window = window
+        self.sent_at: deque = deque(maxlen=burst)  # send times of the last `burst` messages
+        self.blocked_until = 0.0  # set when Discord reports a 429 anyway
+        self.worker: asyncio.Task | None = None
+    
+    def delay(self) -> float:
+        """Seconds until another message fits in the bucket"""
+        now = time.monotonic()
+        wait = self.blocked_until - now
+        if len(self.sent_at) == self.sent_at.maxlen:
+            wait = max(wait, self.sent_at[0] + self.window - now)
+        return max(wait, 0.0)
+
+
+class MessagePipeline:
+    """Outbound message pipeline: one ordered queue per channel, sent concurrently across channels.
+    
+    Small header messages (e.g. "**🔵 Claude:**") are coalesced into the chunk that follows
+    them in the same post, and each channel is paced by a local token bucket so bursts don't turn into 429s.
+    Works with anything that has an async send(content) - a fake transport can be benchmarked.
+    """
+    
+    def __init__(self, burst: int = SEND_BURST, window: float = SEND_WINDOW, limit: int = DISCORD_MESSAGE_LIMIT):
+        self.burst = burst
+        self.window = window
+        self.limit = limit
+        self.outboxes: dict = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+    
+    def _outbox(self, channel) -> ChannelOutbox:
+        key = getattr(channel, "id", None) or id(channel)
+        outbox = self.outboxes.get(key)
+        if outbox is None:
+            outbox = self.outboxes[key] = ChannelOutbox(channel, self.burst, self.window)
+        if outbox.worker is None or outbox.worker.done():
+            outbox.worker = asyncio.create_task(self._run(outbox))
+        return outbox
+    
+    def enqueue(self, channel, content: str, coalesce: bool = False, group: object = None) -> asyncio.Future:
+        """Queue a message; the future resolves to the sent discord.Message.
+        
+        A coalesce=True header is folded into the next queued message only when that message has
+        the same (non-None) group, so it never ends up on top of someone else's output.
+        """
+        future = asyncio.get_running_loop().create_future()
+        outbox = self._outbox(channel)
+        outbox.pending.append((content, coalesce, group, future))
+        outbox.wakeup.set()
+        return future
+    
+    async def send(self, channel, content: str):
+        """Send one message in order with everything else queued for the channel"""
+        return await self.enqueue(channel, content)
+    
+    async def post_many(self, channel, sections: list[tuple[str | None, str | None]]) -> list:
+        """Queue (header, text) sections in order; text is split into Discord-sized chunks.
+        
+        Returns the sent messages (a coalesced header shares its message with the next chunk).
+        """
+        futures = []
+        group = object()  # headers only merge with chunks from this call
+        for header, text in sections:
+            if header:
+                futures.append(self.enqueue(channel, header, coalesce=True, group=group))
+            if text:
+                futures.extend(self.enqueue(channel, chunk, group=group) for chunk in split_message(text) if chunk.strip())
+        return list(await asyncio.gather(*futures))
+    
+    async def post(self, channel, text: str, header: str = None) -> list:
+        """Queue a (possibly long) text with an optional header merged into its first chunk"""
+        return await self.post_many(channel, [(header, text)])
+    
+    async def _run(self, outbox: ChannelOutbox):
+        while True:
+            if not outbox.pending:
+                outbox.wakeup.clear()
+                await outbox.wakeup.wait()
+                continue
             
-            # 2. Handle line that is longer than limit by itself
-            while len(line) > limit - len(current_chunk):
-                space_left = limit - len(current_chunk)
-                
-                part = line[:space_left]
-                line = line[space_left:]
-                
-                current_chunk += part
-                if code_block_open:
-                    current_chunk += "```"
-                chunks.append(current_chunk)
-                
-                current_chunk = ""
-                if code_block_open:
-                    current_chunk += f"```{language}\n"
+            content, coalesce, group, future = outbox.pending.popleft()
+            batch = [future]
+            # Fold headers into what follows them from the same post, as long as it fits in one message
+            while (coalesce and group is not None and outbox.pending and outbox.pending[0][2] is group
+                   and len(content) + 1 + len(outbox.pending[0][0]) <= self.limit):
+                next_content, coalesce, _, next_future = outbox.pending.popleft()
+                content = f"{content}\n{next_content}"
+                batch.append(next_future)
+                self.coalesced += 1
             
-            current_chunk += line + "\n"
-        else:
-            current_chunk += line + "\n"
+            try:
+                message = await self._deliver(outbox, content)
+            except Exception as e:
+                for f in batch:
+                    if not f.done():
+                        f.set_exception(e)
+                continue
             
-    if current_chunk:
-        chunks.append(current_chunk)
+            for f in batch:
+                if not f.done():
+                    f.set_result(message)
+    
+    async def _deliver(self, outbox: ChannelOutbox, content: str):
+        delay = outbox.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        outbox.sent_at.append(time.monotonic())
+        
+        started = time.perf_counter()
+        try:
+            message = await outbox.channel.send(content)
+        except discord.HTTPException as e:
+            if e.status != 429:
+                raise
+            # Our pacing was too optimistic - block the bucket and retry once
+            self.rate_limited += 1
+            retry_after = getattr(e, "retry_after", None) or outbox.window
+            outbox.blocked_until = time.monotonic() + retry_after
+            await asyncio.sleep(retry_after)
+            outbox.sent_at.append(time.monotonic())
+            message = await outbox.channel.send(content)
         
-    return chunks
+        Metrics.observe("discord_send_seconds", time.perf_counter() - started)
+        self.sent += 1
+        return message
+
+
+outbox = MessagePipeline()
+
+
+async def stream_to_channel(channel, header: str, deltas) -> str:
+    """Stream an agent's output into a channel with progressive edits, returning the full text"""
+    reply = StreamingReply(channel, header)
+    async for delta in deltas:
+        await reply.feed(delta)
+    text = await reply.finish()
+    if reply.first_token_latency is not None:
+        print(f"⚡ First token in {reply.first_token_latency:.2f}s ({len(text):,} chars streamed to #{getattr(channel, 'name', channel)})")
+    return text
+
+
+async def post_as_completed(channels: list, title: str, calls: list[tuple[str, str, object]]) -> dict[str, str | None]:
+    """Post a title, then each model's answer to every channel as soon as that model finishes.
+    
+    calls are (provider, header, coroutine). Each model gets its own deadline (CONSENSUS_DEADLINES,
+    else CONSENSUS_DEADLINE); a model that misses it or fails is reported in place of its answer.
+    Returns provider -> response text (None for models that didn't answer).
+    """
+    tasks = {}
+    for provider, header, coro in calls:
+        deadline = CONSENSUS_DEADLINES.get(provider, CONSENSUS_DEADLINE)
+        tasks[asyncio.ensure_future(asyncio.wait_for(coro, deadline))] = (provider, header, deadline)
+    posts = [asyncio.ensure_future(outbox.post_many(channel, [(title, None)])) for channel in channels]
+    responses: dict[str, str | None] = {}
+    
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            provider, header, deadline = tasks[task]
+            try:
+                text = responses[provider] = task.result()
+            except asyncio.TimeoutError:
+                responses[provider] = None
+                text = f"⏱️ *Timed out after {deadline:g}s*"
+            except Exception as e:
+                responses[provider] = None
+                text = f"❌ *Failed:* `{type(e).__name__}` {str(e)[:300]}"
+            # Queued per channel in order, sent to all channels in parallel
+            posts.extend(asyncio.ensure_future(outbox.post_many(channel, [(header, text)])) for channel in channels)
+    
+    await asyncio.gather(*posts)
+    return responses
+
+
+@bot.before_invoke
+async def set_request_context(ctx):
+    """Record who/what is making provider calls for this command (priority, backpressure notices)"""
+    command = ctx.command.qualified_name if ctx.command else ""
+    current_request.set({
+        "command": command,
+        "user": ctx.author.name,
+        "channel": getattr(ctx.channel, "name", str(ctx.channel)),
+        "priority": COMMAND_PRIORITIES.get(command, 2),
+        "notify": functools.partial(outbox.send, ctx.channel),
+        "started": time.perf_counter(),
+        "message_id": ctx.message.id,
+    })
+    
+    request = current_request.get()
+    await UsageLedger.load()
+    UsageLedger.check(request)
+    if request.get("over_budget"):
+        action = "using the cheapest available model" if request.get("downgrade") else "queued behind other requests"
+        await outbox.send(ctx.channel, f"💸 Daily {request['over_budget']} budget reached - {action}. See `!usage`.")
+
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    request = current_request.get() or {}
+    if "started" in request:
+        Metrics.observe("command_seconds", time.perf_counter() - request["started"], command=request.get("command", ""))
 
 
 @bot.event
@@ -656,17 +3948,27 @@ async def on_command_error(ctx, error):
     
     # Print to terminal for logging
     print(f"❌ Error in {ctx.command}: {error_type}: {error_msg}")
+    Metrics.inc("command_errors_total", command=ctx.command.qualified_name if ctx.command else "", error=error_type)
     
     # Handle specific error types with user-friendly messages
     if isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send(f"❌ **Missing argument:** `{error.param.name}`\n"
-                      f"Usage: `!{ctx.command.name} {ctx.command.signature}`")
+        await outbox.send(ctx.channel, f"❌ **Missing argument:** `{error.param.name}`\n"
+                          f"Usage: `!{ctx.command.name} {ctx.command.signature}`")
     
     elif isinstance(error, commands.CommandNotFound):
-        await ctx.send(f"❌ **Unknown command.** Use `!help_bot` to see available commands.")
+        await outbox.send(ctx.channel, f"❌ **Unknown command.** Use `!help_bot` to see available commands.")
     
     elif isinstance(error, commands.CommandOnCooldown):
-        await ctx.send(f"⏳ **Cooldown:** Try again in {error.retry_after:.1f}s")
+        await outbox.send(ctx.channel, f"⏳ **Cooldown:** Try again in {error.retry_after:.1f}s")
+    
+    elif isinstance(original_error, QuotaExceeded):
+        await outbox.send(ctx.channel, f"💸 **Daily {original_error.scope} budget used up** (${original_error.spent:.2f} of "
+                          f"${original_error.budget:.2f}). Cheaper commands (`!ask`, `!code`, `!gemini`) still work. See `!usage`.")
+    
+    elif isinstance(original_error, SchedulerBusy):
+        wait = f" Try again in ~{original_error.retry_after:.0f}s." if original_error.retry_after else " Try again in a moment."
+        await outbox.send(ctx.channel, f"🚦 **{original_error.provider} is at capacity** ({original_error.depth} requests queued).{wait}\n"
+                          f"Use `!queue` to see current load.")
     
     else:
         # Generic error - show type and message
@@ -674,11 +3976,34 @@ async def on_command_error(ctx, error):
         if len(error_msg) > 500:
             error_msg = error_msg[:500] + "..."
         
-        await ctx.send(f"❌ **Error:** `{error_type}`\n```{error_msg}```")
+        await outbox.send(ctx.channel, f"❌ **Error:** `{error_type}`\n```{error_msg}```")
+
+
+@bot.event
+async def on_raw_message_edit(payload):
+    if "content" in payload.data:
+        ChannelHistory.edit(payload.channel_id, payload.message_id, payload.data["content"])
+
+
+@bot.event
+async def on_raw_message_delete(payload):
+    ChannelHistory.remove(payload.channel_id, {payload.message_id})
+    if payload.channel_id == TASK_CHANNEL_ID:
+        await TaskStore.mark_removed({payload.message_id})
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    ChannelHistory.remove(payload.channel_id, set(payload.message_ids))
+    if payload.channel_id == TASK_CHANNEL_ID:
+        await TaskStore.mark_removed(set(payload.message_ids))
 
 
 @bot.event
 async def on_message(message):
+    # Keep the history cache current (including the bot's own replies)
+    ChannelHistory.record(message)
+    
     # Ignore messages from the bot itself
     if message.author == bot.user:
         return
@@ -690,7 +4015,8 @@ async def on_message(message):
     
     # If mentioned, guide user to explicit commands
     if bot.user.mentioned_in(message):
-        await message.channel.send(
+        await outbox.send(
+            message.channel,
             "👋 **Hi! Please use a command to ask me something:**\n\n"
             "• `!ask [question]` - General/Quick (GPT-4 $)\n"
             "• `!deep [question]` - Deep Research (Claude $$$)\n"
@@ -707,67 +4033,51 @@ async def ask_general(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a question or attach a `.txt` file.\nUsage: `!ask [question]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a question or attach a text file.\nUsage: `!ask [question]`")
             return
 
-        await ctx.send("💬 Asking GPT-4...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "💬 Asking GPT-4...")
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(GENERAL_MODEL), query=query)
         
         response = await GeneralAgent.process(query, project_context=project_context)
         
-        chunks = split_message(response)
-        for chunk in chunks:
-            await ctx.send(chunk)
+        await outbox.post(ctx.channel, response)
 
 
 @bot.command(name='auto')
 async def auto_route(ctx, *, query: str = None):
-    """Auto-route query to the best AI using Gemini (FREE routing). Usage: !auto [question]"""
-    
-    if not gemini_client:
-        await ctx.send("❌ Gemini API key not configured. `!auto` requires Gemini for routing.")
-        return
+    """Auto-route query to the best AI (local classifier, Gemini for ambiguous cases). Usage: !auto [question]"""
     
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a question or attach a `.txt` file.\nUsage: `!auto [question]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a question or attach a text file.\nUsage: `!auto [question]`")
             return
 
-        await ctx.send("🔀 Routing query with Gemini (free)...")
+        await outbox.send(ctx.channel, "🔀 Routing query...")
         
         # Use CenterAI to determine the best agent
         agent_type, channel_id = await CenterAI.route_query(query)
         
         # Load project context
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(RESEARCH_MODEL, BUILD_MODEL), query=query)
         
         if agent_type == "research":
-            await ctx.send("🧠 Routed to **Claude** (Research)...")
+            await outbox.send(ctx.channel, "🧠 Routed to **Claude** (Research)...")
             response = await ResearchAgent.process(query, project_context=project_context, mode='core')
             target_channel = bot.get_channel(RESEARCH_CHANNEL_ID)
             
-            chunks = split_message(response)
-            for i, chunk in enumerate(chunks):
-                if i == 0:
-                    await target_channel.send(f"**🔀 Auto-Routed (Research):** *{query[:100]}...*\n\n{chunk}")
-                else:
-                    await target_channel.send(chunk)
+            await outbox.post(target_channel, f"**🔀 Auto-Routed (Research):** *{query[:100]}...*\n\n{response}")
             
-            await ctx.send(f"✅ Response posted in <#{RESEARCH_CHANNEL_ID}>")
+            await outbox.send(ctx.channel, f"✅ Response posted in <#{RESEARCH_CHANNEL_ID}>")
         else:
-            await ctx.send("🏗️ Routed to **Claude** (Build)...")
+            await outbox.send(ctx.channel, "🏗️ Routed to **Claude** (Build)...")
             response = await BuildAgent.process(query, project_context=project_context)
             target_channel = bot.get_channel(BUILD_CHANNEL_ID)
             
-            chunks = split_message(response)
-            for i, chunk in enumerate(chunks):
-                if i == 0:
-                    await target_channel.send(f"**🔀 Auto-Routed (Build):** *{query[:100]}...*\n\n{chunk}")
-                else:
-                    await target_channel.send(chunk)
+            await outbox.post(target_channel, f"**🔀 Auto-Routed (Build):** *{query[:100]}...*\n\n{response}")
             
-            await ctx.send(f"✅ Response posted in <#{BUILD_CHANNEL_ID}>")
+            await outbox.send(ctx.channel, f"✅ Response posted in <#{BUILD_CHANNEL_ID}>")
 
 
 @bot.command(name='deep')
@@ -777,23 +4087,25 @@ async def ask_deep(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a question or attach a `.txt` file.\nUsage: `!deep [question]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a question or attach a text file.\nUsage: `!deep [question]`")
             return
 
-        await ctx.send("🧠 Deep reasoning with Claude...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "🧠 Deep reasoning with Claude...")
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(RESEARCH_MODEL), query=query)
         
-        response = await ResearchAgent.process(query, project_context=project_context, mode='core')
         research_channel = bot.get_channel(RESEARCH_CHANNEL_ID)
+        header = f"**Deep Research (Claude)** responding to: *{query[:100]}...*\n\n"
         
-        chunks = split_message(response)
-        for i, chunk in enumerate(chunks):
-            if i == 0:
-                await research_channel.send(f"**Deep Research (Claude)** responding to: *{query[:100]}...*\n\n{chunk}")
-            else:
-                await research_channel.send(chunk)
+        if STREAMING_ENABLED:
+            await stream_to_channel(
+                research_channel, header,
+                ResearchAgent.stream(query, project_context=project_context, mode='core')
+            )
+        else:
+            response = await ResearchAgent.process(query, project_context=project_context, mode='core')
+            await outbox.post(research_channel, header + response)
         
-        await ctx.send(f"✅ Claude's response posted in <#{RESEARCH_CHANNEL_ID}>")
+        await outbox.send(ctx.channel, f"✅ Claude's response posted in <#{RESEARCH_CHANNEL_ID}>")
 
 
 @bot.command(name='research')
@@ -810,23 +4122,27 @@ async def ask_hardmode(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide an idea or attach a `.txt` file.\nUsage: `!hardmode [idea]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide an idea or attach a text file.\nUsage: `!hardmode [idea]`")
             return
 
-        await ctx.send("🔥 **HARD MODE** - Loading project context and preparing critique...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "🔥 **HARD MODE** - Loading project context and preparing critique...")
+        # Hard mode critiques against the whole canon, not just the sections that match the idea
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(RESEARCH_MODEL),
+                                                                query=query, full_canon=True)
         
-        response = await ResearchAgent.process(query, project_context=project_context, mode='hardmode')
         research_channel = bot.get_channel(RESEARCH_CHANNEL_ID)
+        header = f"**🔥 HARD MODE CRITIQUE** of: *{query[:100]}...*\n\n"
         
-        chunks = split_message(response)
-        for i, chunk in enumerate(chunks):
-            if i == 0:
-                await research_channel.send(f"**🔥 HARD MODE CRITIQUE** of: *{query[:100]}...*\n\n{chunk}")
-            else:
-                await research_channel.send(chunk)
+        if STREAMING_ENABLED:
+            await stream_to_channel(
+                research_channel, header,
+                ResearchAgent.stream(query, project_context=project_context, mode='hardmode')
+            )
+        else:
+            response = await ResearchAgent.process(query, project_context=project_context, mode='hardmode')
+            await outbox.post(research_channel, header + response)
         
-        await ctx.send(f"✅ Hard mode critique posted in <#{RESEARCH_CHANNEL_ID}>")
+        await outbox.send(ctx.channel, f"✅ Hard mode critique posted in <#{RESEARCH_CHANNEL_ID}>")
 
 
 @bot.command(name='code')
@@ -836,17 +4152,15 @@ async def ask_code(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a request or attach a `.txt` file.\nUsage: `!code [request]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a request or attach a text file.\nUsage: `!code [request]`")
             return
 
-        await ctx.send("⚡ Quick code with Gemini (free)...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "⚡ Quick code with Gemini (free)...")
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(CODE_MODEL), query=query)
         
         response = await SimpleCodeAgent.process(query, project_context=project_context)
         
-        chunks = split_message(response)
-        for chunk in chunks:
-            await ctx.send(chunk)
+        await outbox.post(ctx.channel, response)
 
 
 @bot.command(name='build')
@@ -856,23 +4170,25 @@ async def ask_build(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a question or attach a `.txt` file.\nUsage: `!build [question]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a question or attach a text file.\nUsage: `!build [question]`")
             return
 
-        await ctx.send("🏗️ Building with Claude (checking assumptions)...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "🏗️ Building with Claude (checking assumptions)...")
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(BUILD_MODEL), query=query)
         
-        response = await BuildAgent.process(query, project_context=project_context)
         build_channel = bot.get_channel(BUILD_CHANNEL_ID)
+        header = f"**Build Agent (Claude)** responding to: *{query[:100]}...*\n\n"
         
-        chunks = split_message(response)
-        for i, chunk in enumerate(chunks):
-            if i == 0:
-                await build_channel.send(f"**Build Agent (Claude)** responding to: *{query[:100]}...*\n\n{chunk}")
-            else:
-                await build_channel.send(chunk)
+        if STREAMING_ENABLED:
+            await stream_to_channel(
+                build_channel, header,
+                BuildAgent.stream(query, project_context=project_context)
+            )
+        else:
+            response = await BuildAgent.process(query, project_context=project_context)
+            await outbox.post(build_channel, header + response)
         
-        await ctx.send(f"✅ Claude's response posted in <#{BUILD_CHANNEL_ID}>")
+        await outbox.send(ctx.channel, f"✅ Claude's response posted in <#{BUILD_CHANNEL_ID}>")
 
 
 @bot.command(name='gemini')
@@ -883,28 +4199,26 @@ async def ask_gemini(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a question or attach a `.txt` file.\nUsage: `!gemini [question]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a question or attach a text file.\nUsage: `!gemini [question]`")
             return
 
-        await ctx.send("📚 Loading project context...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "📚 Loading project context...")
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(CODE_MODEL), query=query)
         
         response = await GeminiAgent.process(query, project_context=project_context)
         
-        chunks = split_message(response)
-        for chunk in chunks:
-            await ctx.send(chunk)
+        await outbox.post(ctx.channel, response)
 
 
 @bot.command(name='search')
 async def web_search(ctx, *, query: str = None):
     """Web search using Perplexity (NOT YET AVAILABLE). Usage: !search [query]"""
     
-    await ctx.send("⚠️ **Feature Not Available**\n\n"
-                   "`!search` requires a Perplexity API key which is not configured.\n\n"
-                   "**Alternatives:**\n"
-                   "• Use `!ask` or `!deep` - Claude/GPT-4 have training data up to early 2024\n"
-                   "• For current market data, use external sources and paste here")
+    await outbox.send(ctx.channel, "⚠️ **Feature Not Available**\n\n"
+                      "`!search` requires a Perplexity API key which is not configured.\n\n"
+                      "**Alternatives:**\n"
+                      "• Use `!ask` or `!deep` - Claude/GPT-4 have training data up to early 2024\n"
+                      "• For current market data, use external sources and paste here")
 
 
 @bot.command(name='context')
@@ -923,26 +4237,159 @@ async def get_context(ctx, channel_name: str, limit: int = 20):
     
     channel_id = channel_map.get(channel_name.lower())
     if not channel_id:
-        await ctx.send(f"Unknown channel. Use: research, build, coord, general, findings, task, completed")
+        await outbox.send(ctx.channel, f"Unknown channel. Use: research, build, coord, general, findings, task, completed")
         return
     
     channel = bot.get_channel(channel_id)
     messages = []
     
-    async for msg in channel.history(limit=limit):
+    for msg in await ChannelHistory.recent(channel, limit):
         if msg.content:
-            messages.append(f"**{msg.author.name}** ({msg.created_at.strftime('%Y-%m-%d %H:%M')}): {msg.content[:150]}")
+            messages.append(f"**{msg.author}** ({msg.created_at.strftime('%Y-%m-%d %H:%M')}): {msg.content[:150]}")
     
     messages.reverse()
     response = "\n\n".join(messages)
     
     if not response:
-        await ctx.send("No messages found in this channel.")
+        await outbox.send(ctx.channel, "No messages found in this channel.")
+        return
+    
+    await outbox.post(ctx.channel, response)
+
+
+@bot.command(name='stats')
+async def show_stats(ctx):
+    """Show latency percentiles and token counts. Usage: !stats"""
+    
+    def ms(seconds: float) -> str:
+        return f"{seconds * 1000:,.0f} ms" if seconds < 10 else f"{seconds:,.1f} s"
+    
+    lines = ["📈 **Bot Stats** (p50 / p95 / p99):\n"]
+    for name in ("command_seconds", "context_assembly_seconds", "queue_wait_seconds", "provider_latency_seconds",
+                 "time_to_first_token_seconds", "time_to_first_visible_token_seconds", "discord_send_seconds",
+                 "router_seconds"):
+        histogram = Metrics.merged(name)
+        if histogram and histogram.count:
+            lines.append(f"• **{Metrics.HELP[name]}**: {ms(histogram.percentile(0.5))} / "
+                         f"{ms(histogram.percentile(0.95))} / {ms(histogram.percentile(0.99))} "
+                         f"*(n={histogram.count})*")
+    
+    # Per-command breakdown
+    command_series = Metrics.histograms.get("command_seconds", {})
+    if command_series:
+        lines.append("\n**By command:**")
+        for labels, histogram in sorted(command_series.items(), key=lambda item: -item[1].count):
+            command = dict(labels).get("command", "?")
+            lines.append(f"• `!{command}`: {ms(histogram.percentile(0.5))} / {ms(histogram.percentile(0.95))} / "
+                         f"{ms(histogram.percentile(0.99))} *(n={histogram.count})*")
+    
+    # Tokens and errors per model
+    inputs = Metrics.counters.get("llm_input_tokens_total", {})
+    if inputs:
+        outputs = Metrics.counters.get("llm_output_tokens_total", {})
+        cached = Metrics.counters.get("llm_cached_tokens_total", {})
+        errors: dict[str, float] = {}
+        for labels, value in Metrics.counters.get("llm_errors_total", {}).items():
+            model = dict(labels).get("model", "?")
+            errors[model] = errors.get(model, 0) + value
+        lines.append("\n**Tokens by model** (in / out / cached):")
+        for labels, value in sorted(inputs.items()):
+            model = dict(labels).get("model", "?")
+            lines.append(f"• `{model}`: {value:,.0f} / {outputs.get(labels, 0):,.0f} / {cached.get(labels, 0):,.0f}"
+                         + (f" - {errors[model]:.0f} errors" if errors.get(model) else ""))
+    
+    writes = Memory._writes
+    if writes.writes:
+        lines.append(f"\n**Memory writes:** {writes.writes} in {writes.batches} commits "
+                     f"({writes.writes / writes.batches:.1f} per commit)")
+    
+    if len(lines) == 1:
+        await outbox.send(ctx.channel, "📭 **No stats yet.** Run a few commands first.")
+        return
+    
+    await outbox.post(ctx.channel, "\n".join(lines))
+
+
+@bot.command(name='usage')
+async def show_usage(ctx, scope: str = "me"):
+    """Show today's AI spend. Usage: !usage [me|all]"""
+    
+    user = ctx.author.name if scope == "me" else None
+    
+    lines = [f"💸 **AI usage today** ({UsageLedger.today()} UTC)" + (f" for **{user}**" if user else "") + ":\n"]
+    
+    mine = UsageLedger.spent(user=ctx.author.name)
+    total = UsageLedger.spent()
+    lines.append(f"• You: **${mine:.2f}** of ${USAGE_BUDGETS.get('user', 0):.2f}")
+    lines.append(f"• This channel: **${UsageLedger.spent(channel=getattr(ctx.channel, 'name', '')):.2f}** "
+                 f"of ${USAGE_BUDGETS.get('channel', 0):.2f}")
+    lines.append(f"• Everyone: **${total:.2f}** of ${USAGE_BUDGETS.get('total', 0):.2f}")
+    
+    for title, index in (("By command", 3), ("By model", 4)) + ((("By user", 1),) if user is None else ()):
+        rows = UsageLedger.breakdown(index, user)[:8]
+        if rows:
+            lines.append(f"\n**{title}:**")
+            for name, (calls, input_tokens, output_tokens, cached, cost) in rows:
+                lines.append(f"• `{name}`: ${cost:.3f} - {calls} calls, {input_tokens:,} in ({cached:,} cached) / {output_tokens:,} out")
+    
+    history = await UsageLedger.history()
+    if len(history) > 1:
+        lines.append("\n**Last days:** " + " · ".join(f"{day[5:]} ${cost:.2f}" for day, cost, _ in history))
+    
+    await outbox.post(ctx.channel, "\n".join(lines))
+
+
+@bot.command(name='router')
+async def router_stats(ctx):
+    """Show how !auto routing decisions were made and how long they took. Usage: !router"""
+    
+    labels = {"cache": "Recent-decision cache", "local": "Local classifier", "gemini": "Gemini", "default": "Default (no signal)"}
+    lines = ["🔀 **Routing Stats:**\n"]
+    for stage, stats in CenterAI.stats().items():
+        lines.append(f"• **{labels[stage]}**: {stats['count']} decisions "
+                     f"(p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms)")
+    
+    await outbox.send(ctx.channel, "\n".join(lines))
+
+
+@bot.command(name='nocache')
+async def no_cache(ctx, command_name: str = None, *, query: str = None):
+    """Run an AI command without the response cache. Usage: !nocache [command] [question]"""
+    
+    command = bot.get_command(command_name.lstrip('!')) if command_name else None
+    if not command or 'query' not in command.clean_params:
+        await outbox.send(ctx.channel, "❌ **Usage:** `!nocache [command] [question]` - e.g. `!nocache deep why did the test fail?`")
         return
     
-    chunks = split_message(response)
-    for chunk in chunks:
-        await ctx.send(chunk)
+    request = current_request.get()
+    request.update({
+        "command": command.qualified_name,
+        "priority": COMMAND_PRIORITIES.get(command.qualified_name, 2),
+        "no_cache": True,
+    })
+    UsageLedger.check(request)
+    await ctx.invoke(command, query=query)
+
+
+@bot.command(name='queue')
+async def show_queue(ctx):
+    """Show in-flight and queued AI requests per provider. Usage: !queue"""
+    
+    snapshot = scheduler.snapshot()
+    if not snapshot:
+        await outbox.send(ctx.channel, "📭 **No AI requests yet.**")
+        return
+    
+    lines = ["🚦 **AI Request Queues:**\n"]
+    for name, stats in snapshot.items():
+        line = f"• **{name}**: {stats['active']}/{stats['max_concurrent']} running, {stats['queued']} queued"
+        cache = providers[name].cache_stats if name in providers else None
+        if cache and cache["calls"]:
+            line += (f" - prompt cache {cache['hits']}/{cache['calls']} hits, "
+                     f"{cache['cache_read_tokens']:,}/{cache['input_tokens']:,} input tokens cached")
+        lines.append(line)
+    
+    await outbox.send(ctx.channel, "\n".join(lines))
 
 
 @bot.command(name='crosscheck')
@@ -952,32 +4399,19 @@ async def crosscheck(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a question or attach a `.txt` file.\nUsage: `!crosscheck [question]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a question or attach a text file.\nUsage: `!crosscheck [question]`")
             return
 
-        await ctx.send("📚 Loading project context...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "📚 Loading project context...")
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(RESEARCH_MODEL, BUILD_MODEL), query=query)
         
-        await ctx.send(f"🔄 Querying Claude and GPT-4...")
+        await outbox.send(ctx.channel, f"🔄 Querying Claude and GPT-4...")
         
-        # Query both in parallel with project context
-        claude_task = ResearchAgent.process(query, project_context=project_context)
-        gpt_task = BuildAgent.process(query, project_context=project_context)
-        
-        claude_response, gpt_response = await asyncio.gather(claude_task, gpt_task)
-        
-        # Post comparison - Send headers then full responses
-        await ctx.send(f"**Cross-check:** *{query[:100]}...*")
-        
-        await ctx.send("**🔵 Claude's take:**")
-        chunks = split_message(claude_response)
-        for chunk in chunks:
-            await ctx.send(chunk)
-
-        await ctx.send("**🟢 GPT-4's take:**")
-        chunks = split_message(gpt_response)
-        for chunk in chunks:
-            await ctx.send(chunk)
+        # Query both in parallel with project context; each answer is posted as soon as it lands
+        await post_as_completed([ctx.channel], f"**Cross-check:** *{query[:100]}...*", [
+            ("claude", "**🔵 Claude's take:**", ResearchAgent.process(query, project_context=project_context)),
+            ("openai", "**🟢 GPT-4's take:**", BuildAgent.process(query, project_context=project_context)),
+        ])
 
 
 @bot.command(name='consensus')
@@ -987,57 +4421,30 @@ async def consensus(ctx, *, query: str = None):
     async with ctx.typing():
         query, _ = await extract_query_from_attachments(ctx, query)
         if not query:
-            await ctx.send("❌ **Missing query.** Please provide a question or attach a `.txt` file.\nUsage: `!consensus [question]`")
+            await outbox.send(ctx.channel, "❌ **Missing query.** Please provide a question or attach a text file.\nUsage: `!consensus [question]`")
             return
 
-        await ctx.send("📚 Loading project context...")
-        project_context = await ProjectContext.get_full_context(bot, ctx.channel)
+        await outbox.send(ctx.channel, "📚 Loading project context...")
+        project_context = await ProjectContext.get_full_context(bot, ctx.channel, budget=context_budget(RESEARCH_MODEL, BUILD_MODEL, CODE_MODEL), query=query)
         
-        await ctx.send(f"🔄 Querying Claude, GPT-4, and Gemini...")
+        await outbox.send(ctx.channel, f"🔄 Querying Claude, GPT-4, and Gemini...")
         
-        # Query all three in parallel with project context
-        claude_task = ResearchAgent.process(query, project_context=project_context)
-        gpt_task = BuildAgent.process(query, project_context=project_context)
-        gemini_task = GeminiAgent.process(query, project_context=project_context)
-        
-        claude_response, gpt_response, gemini_response = await asyncio.gather(
-            claude_task, gpt_task, gemini_task
-        )
-        
-        # Post to findings channel for record
-        findings_channel = bot.get_channel(FINDINGS_CHANNEL_ID)
-        # Post to findings channel for record - Full Content
+        # Query all three in parallel; each answer goes to the findings channel (for record) and
+        # the current channel as soon as it lands, without waiting for the slowest model
         findings_channel = bot.get_channel(FINDINGS_CHANNEL_ID)
-        await findings_channel.send(f"**🗳️ Consensus Query:** *{query[:100]}...*")
+        responses = await post_as_completed([findings_channel, ctx.channel], f"**🗳️ Consensus Query:** *{query[:100]}...*", [
+            ("claude", "**🔵 Claude:**", ResearchAgent.process(query, project_context=project_context)),
+            ("openai", "**🟢 GPT-4:**", BuildAgent.process(query, project_context=project_context)),
+            ("gemini", "**🟡 Gemini:**", GeminiAgent.process(query, project_context=project_context)),
+        ])
         
-        await findings_channel.send("**🔵 Claude:**")
-        for chunk in split_message(claude_response):
-            await findings_channel.send(chunk)
-            
-        await findings_channel.send("**🟢 GPT-4:**")
-        for chunk in split_message(gpt_response):
-            await findings_channel.send(chunk)
-            
-        await findings_channel.send("**🟡 Gemini:**")
-        for chunk in split_message(gemini_response):
-            await findings_channel.send(chunk)
-        
-        # Summary in current channel - Full Content too
-        await ctx.send(f"**🗳️ Consensus Query:** *{query[:100]}...*")
-        
-        await ctx.send("**🔵 Claude:**")
-        for chunk in split_message(claude_response):
-            await ctx.send(chunk)
-            
-        await ctx.send("**🟢 GPT-4:**")
-        for chunk in split_message(gpt_response):
-            await ctx.send(chunk)
-
-        await ctx.send("**🟡 Gemini:**")
-        for chunk in split_message(gemini_response):
-            await ctx.send(chunk)
+        # Where the models agree and differ, computed locally (no fourth model call)
+        if CONSENSUS_ANALYSIS:
+            report = ConsensusAnalyzer.report(responses, {"claude": "Claude", "openai": "GPT-4", "gemini": "Gemini"})
+            if report:
+                await outbox.post(findings_channel, report)
 
-        await ctx.send(f"📌 Full responses logged in <#{FINDINGS_CHANNEL_ID}>")
+        await outbox.send(ctx.channel, f"📌 Full responses logged in <#{FINDINGS_CHANNEL_ID}>")
 
 
 @bot.command(name='log_finding')
@@ -1046,17 +4453,15 @@ async def log_finding(ctx, *, finding: str = None):
     
     finding, _ = await extract_query_from_attachments(ctx, finding)
     if not finding:
-        await ctx.send("❌ **Missing finding.** Please provide text or attach a `.txt` file.\nUsage: `!log_finding [your finding]`")
+        await outbox.send(ctx.channel, "❌ **Missing finding.** Please provide text or attach a text file.\nUsage: `!log_finding [your finding]`")
         return
     
     findings_channel = bot.get_channel(FINDINGS_CHANNEL_ID)
     timestamp = discord.utils.utcnow().strftime('%Y-%m-%d %H:%M UTC')
     
     full_msg = f"📌 **Finding logged** ({timestamp})\nBy: {ctx.author.name}\n\n{finding}"
-    chunks = split_message(full_msg)
-    for chunk in chunks:
-        await findings_channel.send(chunk)
-    await ctx.send(f"✅ Finding logged to <#{FINDINGS_CHANNEL_ID}>")
+    await outbox.post(findings_channel, full_msg)
+    await outbox.send(ctx.channel, f"✅ Finding logged to <#{FINDINGS_CHANNEL_ID}>")
 
 
 @bot.command(name='channels')
@@ -1084,9 +4489,7 @@ async def list_channels(ctx):
 • <#{ARCHIVE_CHANNEL_ID}> - Archived content
     """
     
-    chunks = split_message(channel_info)
-    for chunk in chunks:
-        await ctx.send(chunk)
+    await outbox.post(ctx.channel, channel_info)
 
 
 @bot.command(name='task')
@@ -1098,57 +4501,125 @@ async def create_task(ctx, *, description: str):
     
     # Create task message
     full_msg = (
-        f"📋 **New Task** ({timestamp})\n"
+        f"{TaskStore.TASK_HEADER} ({timestamp})\n"
         f"Created by: {ctx.author.name}\n\n"
         f"{description}\n\n"
         f"Status: 🔵 **ACTIVE**"
     )
     
-    chunks = split_message(full_msg)
-    task_msg = None
+    messages = await outbox.post(task_channel, full_msg)
+    task_msg = messages[0]
+    await TaskStore.add(task_msg.id, description, ctx.author.name, full_msg)
+    
+    await outbox.send(ctx.channel, f"✅ Task created in <#{TASK_CHANNEL_ID}>\nTask ID: `{task_msg.id}`")
+
+
+@bot.command(name='tasks')
+async def list_tasks(ctx, status: str = "active", author: str = None):
+    """List tasks. Usage: !tasks [active|completed|removed|all] [author]"""
+    
+    status = status.lower()
+    if status not in (*TaskStore.STATUSES, "all"):
+        # "!tasks alice" - an author, not a status
+        status, author = "active", status
+    
+    tasks = await TaskStore.list(None if status == "all" else status, author)
+    counts = await TaskStore.counts()
+    summary = " · ".join(f"{counts.get(name, 0)} {name}" for name in TaskStore.STATUSES)
+    
+    if not tasks:
+        await outbox.send(ctx.channel, f"📭 **No {'' if status == 'all' else status + ' '}tasks"
+                          f"{f' by {author}' if author else ''}.** ({summary})")
+        return
+    
+    icons = {"active": "🔵", "completed": "✅", "removed": "🗑️"}
+    lines = [f"📋 **Tasks** ({summary}):\n"]
+    for task in tasks:
+        first_line = task['description'].split("\n", 1)[0]
+        lines.append(f"{icons.get(task['status'], '•')} `{task['id']}` {first_line[:100]}{'...' if len(first_line) > 100 else ''}\n"
+                     f"    *— {task['author']}, {task['created']}"
+                     + (f" · done by {task['completed_by']} {task['completed']}" if task['completed'] else "") + "*")
     
-    for i, chunk in enumerate(chunks):
-        msg = await task_channel.send(chunk)
-        if i == 0:
-            task_msg = msg
+    await outbox.post(ctx.channel, "\n".join(lines))
+
+
+def split_task_ids(text: str, known: set[int] | None) -> tuple[list[int], str]:
+    """Split "!complete" arguments into (task IDs, result).
     
-    await ctx.send(f"✅ Task created in <#{TASK_CHANNEL_ID}>\nTask ID: `{task_msg.id}`")
+    The first word is always IDs (comma-separated for several). Further numbers only count as IDs
+    while they are in `known` (stored tasks), so a result like "3 bugs fixed" stays intact.
+    With known=None every leading number counts - the candidates worth looking up.
+    """
+    task_ids = []
+    rest = 0  # where the result starts (keeps its line breaks)
+    for i, word in enumerate(re.finditer(r"\S+", text)):
+        parts = [part for part in word.group().split(",") if part]
+        if not parts or not all(part.isdigit() for part in parts):
+            break
+        ids = [int(part) for part in parts]
+        if i > 0 and known is not None and not all(task_id in known for task_id in ids):
+            break
+        task_ids.extend(ids)
+        rest = word.end()
+    return task_ids, text[rest:].strip()
 
 
 @bot.command(name='complete')
-async def complete_task(ctx, task_id: int, *, result: str = "Completed"):
-    """Mark a task as complete. Usage: !complete [task_id] [result]"""
+async def complete_task(ctx, *, args: str = ""):
+    """Mark one or more tasks as complete. Usage: !complete [task_id[,task_id...]] [result]"""
+    
+    candidates, _ = split_task_ids(args, None)
+    known = await TaskStore.known(candidates[1:])  # numbers in the result are never looked up
+    task_ids, result = split_task_ids(args, known)
+    result = result or "Completed"
+    if not task_ids:
+        await outbox.send(ctx.channel, "❌ **Missing task ID.** Usage: `!complete [task_id[,task_id...]] [result]` (see `!tasks`)")
+        return
     
     task_channel = bot.get_channel(TASK_CHANNEL_ID)
     completed_channel = bot.get_channel(COMPLETED_CHANNEL_ID)
     timestamp = discord.utils.utcnow().strftime('%Y-%m-%d %H:%M UTC')
+    done, missing = [], []
     
-    try:
-        # Fetch the original task message
-        task_msg = await task_channel.fetch_message(task_id)
-        original_content = task_msg.content
-        
-        # Post to completed channel
-        full_log = (
-            f"✅ **Task Completed** ({timestamp})\n"
-            f"Completed by: {ctx.author.name}\n\n"
-            f"**Original Task:**\n{original_content}\n\n"
-            f"**Result:**\n{result}"
-        )
-        
-        chunks = split_message(full_log)
-        for chunk in chunks:
-            await completed_channel.send(chunk)
-        
-        # Delete from task channel
-        await task_msg.delete()
-        
-        await ctx.send(f"✅ Task `{task_id}` moved to <#{COMPLETED_CHANNEL_ID}>")
-        
-    except discord.NotFound:
-        await ctx.send(f"❌ Task `{task_id}` not found in <#{TASK_CHANNEL_ID}>")
-    except Exception as e:
-        await ctx.send(f"❌ Error: {str(e)}")
+    for task_id in dict.fromkeys(task_ids):
+        try:
+            task = await TaskStore.get(task_id)
+            if task is None:
+                # Posted before the task store existed - fetch it once and import it
+                task_msg = await task_channel.fetch_message(task_id)
+                author, description = TaskStore.parse_post(task_msg.content)
+                await TaskStore.add(task_id, description, author, task_msg.content, task_msg.created_at)
+                task = await TaskStore.get(task_id)
+            
+            if task['status'] != "active" or not await TaskStore.complete(task_id, ctx.author.name, result):
+                missing.append(task_id)
+                continue
+            
+            # Post to completed channel
+            full_log = (
+                f"✅ **Task Completed** ({timestamp})\n"
+                f"Completed by: {ctx.author.name}\n\n"
+                f"**Original Task:**\n{task['content']}\n\n"
+                f"**Result:**\n{result}"
+            )
+            
+            await outbox.post(completed_channel, full_log)
+            
+            # Delete from task channel without fetching the post first (already gone is fine)
+            with contextlib.suppress(discord.NotFound):
+                await task_channel.get_partial_message(task_id).delete()
+            done.append(task_id)
+            
+        except discord.NotFound:
+            await TaskStore.mark_removed({task_id})
+            missing.append(task_id)
+        except Exception as e:
+            await outbox.send(ctx.channel, f"❌ Error completing `{task_id}`: {str(e)}")
+    
+    if done:
+        await outbox.send(ctx.channel, f"✅ Task{'s' if len(done) > 1 else ''} {', '.join(f'`{i}`' for i in done)} moved to <#{COMPLETED_CHANNEL_ID}>")
+    if missing:
+        await outbox.send(ctx.channel, f"❌ No active task {', '.join(f'`{i}`' for i in missing)} in <#{TASK_CHANNEL_ID}>")
 
 
 @bot.command(name='help_bot')
@@ -1170,19 +4641,26 @@ async def help_bot(ctx):
 • `!build [request]` - Claude for complex implementation ($$$)
 
 **Multi-AI:**
-• `!auto [question]` - Let Gemini route to the right AI (FREE routing)
+• `!auto [question]` - Route to the right AI automatically (FREE routing)
 • `!crosscheck [question]` - Claude + GPT-4 comparison
 • `!consensus [question]` - All 3 AIs (logged to #findings)
 • `!gemini [question]` - Direct Gemini access (FREE)
 
 **Task Management:**
 • `!task [description]` - Create new task
-• `!complete [task_id] [result]` - Mark task complete
+• `!tasks [status] [author]` - List tasks (active by default)
+• `!complete [task_id,task_id ...] [result]` - Mark one or more tasks complete
 
 **Utility:**
 • `!context [channel] [limit]` - View recent messages
 • `!log_finding [text]` - Log to #findings
 • `!channels` - List all channels
+• `!recall [query]` - Search saved memories
+• `!nocache [command] [question]` - Run a command with a fresh (uncached) answer
+• `!usage [me|all]` - Today's AI spend and budgets
+• `!stats` - Latency percentiles and token counts
+• `!queue` - Show AI request queues
+• `!router` - Show !auto routing stats
 • `!help_bot` - This help message
 
 **Cost Guide:**
@@ -1191,9 +4669,7 @@ async def help_bot(ctx):
 • $$$: Claude (!deep, !research, !hardmode, !build)
     """
     
-    chunks = split_message(help_text)
-    for chunk in chunks:
-        await ctx.send(chunk)
+    await outbox.post(ctx.channel, help_text)
 
 
 @bot.command(name='imp')
@@ -1202,21 +4678,21 @@ async def add_memory(ctx, *, content: str = None):
     
     content, _ = await extract_query_from_attachments(ctx, content)
     if not content:
-        await ctx.send("❌ **Missing content.** Please provide text or attach a `.txt` file.\nUsage: `!imp [important note]`")
+        await outbox.send(ctx.channel, "❌ **Missing content.** Please provide text or attach a text file.\nUsage: `!imp [important note]`")
         return
     
-    memory_id = Memory.add(content, ctx.author.name)
-    await ctx.send(f"🧠 **Saved to memory!** (ID: `{memory_id}`)\n> {content[:200]}{'...' if len(content) > 200 else ''}")
+    memory_id = await Memory.add(content, ctx.author.name)
+    await outbox.send(ctx.channel, f"🧠 **Saved to memory!** (ID: `{memory_id}`)\n> {content[:200]}{'...' if len(content) > 200 else ''}")
 
 
 @bot.command(name='memory')
 async def list_memories(ctx):
     """List all saved memories. Usage: !memory"""
     
-    memories = Memory.get_all()
+    memories = await Memory.get_all()
     
     if not memories:
-        await ctx.send("📭 **No memories saved yet.**\nUse `!imp [text]` to save something important.")
+        await outbox.send(ctx.channel, "📭 **No memories saved yet.**\nUse `!imp [text]` to save something important.")
         return
     
     lines = ["🧠 **Saved Memories:**\n"]
@@ -1227,9 +4703,29 @@ async def list_memories(ctx):
     response = "\n".join(lines)
     
     # Chunk if needed
-    chunks = split_message(response)
-    for chunk in chunks:
-        await ctx.send(chunk)
+    await outbox.post(ctx.channel, response)
+
+
+@bot.command(name='recall')
+async def recall_memories(ctx, *, query: str = None):
+    """Search saved memories. Usage: !recall [query]"""
+    
+    if not query:
+        await outbox.send(ctx.channel, "❌ **Missing query.** Usage: `!recall [what to look for]`")
+        return
+    
+    memories = await Memory.recall(query, limit=10)
+    
+    if not memories:
+        await outbox.send(ctx.channel, f"📭 **No memories match** *{query[:100]}*.")
+        return
+    
+    lines = [f"🔎 **Memories matching** *{query[:100]}*:\n"]
+    for mem in memories:
+        updated = f" *(updated {mem['updated']})*" if mem['updated'] else ""
+        lines.append(f"`[{mem['id']}]` {mem['content'][:200]}{'...' if len(mem['content']) > 200 else ''}\n    *— {mem['author']}, {mem['created']}{updated}*\n")
+    
+    await outbox.post(ctx.channel, "\n".join(lines))
 
 
 @bot.command(name='update')
@@ -1237,18 +4733,18 @@ async def update_memory(ctx, memory_id: int = None, *, new_content: str = None):
     """Update a memory's content. Usage: !update [id] [new text]"""
     
     if memory_id is None:
-        await ctx.send("❌ **Missing ID.** Usage: `!update [id] [new text]`")
+        await outbox.send(ctx.channel, "❌ **Missing ID.** Usage: `!update [id] [new text]`")
         return
     
     new_content, _ = await extract_query_from_attachments(ctx, new_content)
     if not new_content:
-        await ctx.send("❌ **Missing new content.** Usage: `!update [id] [new text]`")
+        await outbox.send(ctx.channel, "❌ **Missing new content.** Usage: `!update [id] [new text]`")
         return
     
-    if Memory.update(memory_id, new_content):
-        await ctx.send(f"✅ **Memory `{memory_id}` updated!**\n> {new_content[:200]}{'...' if len(new_content) > 200 else ''}")
+    if await Memory.update(memory_id, new_content):
+        await outbox.send(ctx.channel, f"✅ **Memory `{memory_id}` updated!**\n> {new_content[:200]}{'...' if len(new_content) > 200 else ''}")
     else:
-        await ctx.send(f"❌ Memory with ID `{memory_id}` not found.")
+        await outbox.send(ctx.channel, f"❌ Memory with ID `{memory_id}` not found.")
 
 
 @bot.command(name='forget')
@@ -1256,17 +4752,88 @@ async def delete_memory(ctx, memory_id: int = None):
     """Delete a memory. Usage: !forget [id]"""
     
     if memory_id is None:
-        await ctx.send("❌ **Missing ID.** Usage: `!forget [id]`")
+        await outbox.send(ctx.channel, "❌ **Missing ID.** Usage: `!forget [id]`")
         return
     
-    mem = Memory.get(memory_id)
+    mem = await Memory.get(memory_id)
     if mem:
-        Memory.delete(memory_id)
-        await ctx.send(f"🗑️ **Memory `{memory_id}` deleted:**\n> ~~{mem['content'][:100]}...~~")
+        await Memory.delete(memory_id)
+        await outbox.send(ctx.channel, f"🗑️ **Memory `{memory_id}` deleted:**\n> ~~{mem['content'][:100]}...~~")
+    else:
+        await outbox.send(ctx.channel, f"❌ Memory with ID `{memory_id}` not found.")
+
+
+# ============================================================
+# APPLICATION FACTORY
+# ============================================================
+
+startup_times: dict[str, float] = {}
+
+
+def report_startup(phase: str):
+    """Record seconds since process start for a startup phase ("app" = local init, "ready" = connected)"""
+    if phase in startup_times:
+        return
+    elapsed = time.perf_counter() - STARTUP_STARTED
+    startup_times[phase] = elapsed
+    Metrics.observe("startup_seconds", elapsed, phase=phase)
+    
+    if phase == "app":
+        status = "✅" if elapsed <= STARTUP_BUDGET_SECONDS else "⚠️ over budget"
+        print(f"🚀 Local startup {elapsed:.2f}s (budget {STARTUP_BUDGET_SECONDS:.1f}s) {status}")
     else:
-        await ctx.send(f"❌ Memory with ID `{memory_id}` not found.")
+        print(f"  Online {elapsed:.2f}s after start")
+
+
+async def flush_local_state():
+    """Write buffered local state to disk (called when the bot shuts down)"""
+    await Memory._writes.drain()
+    if UsageLedger._flusher and not UsageLedger._flusher.done():
+        UsageLedger._flusher.cancel()
+    try:
+        await UsageLedger.save()
+    except Exception as e:
+        print(f"⚠️ Could not save usage ledger: {e}")
+
+
+def create_app() -> commands.Bot:
+    """Validate configuration and return the bot, ready to run. Exits with setup instructions if misconfigured."""
+    if not config:
+        print("=" * 60)
+        print("  ❌ Configuration Not Found!")
+        print("=" * 60)
+        print()
+        print("  config.json not found. Please run setup first:")
+        print("    python setup.py")
+        print()
+        print("  Or copy config.example.json to config.json and edit it.")
+        print("=" * 60)
+        sys.exit(1)
+    
+    # Validate Discord token
+    if not os.getenv("DISCORD_BOT_TOKEN"):
+        print("❌ DISCORD_BOT_TOKEN not found in .env file!")
+        print("   Run 'python setup.py' or add it to your .env file.")
+        sys.exit(1)
+    
+    # Validate required channels
+    missing_channels = [ch for ch in REQUIRED_CHANNELS if not channels.get(ch)]
+    if missing_channels:
+        print(f"❌ Missing channel IDs in config.json: {', '.join(missing_channels)}")
+        print("   Run 'python setup.py' to configure channels.")
+        sys.exit(1)
+    
+    report_startup("app")
+    return bot
+
+
+def main():
+    # Load environment variables from .env file
+    load_dotenv()
+    app = create_app()
+    app.run(os.getenv("DISCORD_BOT_TOKEN"))
 
 
 # Run the bot
 if __name__ == "__main__":
-    bot.run(DISCORD_TOKEN)
\ No newline at end of file
+    main()
\ No newline at end of file